@@ -5,10 +5,16 @@ import numpy
 import theano
 
 from MDBN import train_bottom_layer
-from MDBN import train_top
-from MDBN import DBN
+from MDBN import train_bottom_layers
+from MDBN import train_top_cached
+from MDBN import StageCache
+from MDBN import run_ensemble
+from MDBN import dbn_to_arrays
+from MDBN import dbn_from_arrays
+
+from model_io import save_model
+from model_io import load_model
 
-from utils import find_unique_classes
 from utils import load_n_preprocess_data
 
 # batch_size changed from 1 as in M.Liang to 20
@@ -20,38 +26,51 @@ def train_AML_MDBN(datafiles,
                    repeats=10,
                    graph_output=False,
                    output_folder='MDBN_run',
-                   output_file='parameters_and_classes.npz',
-                   rng=None):
+                   output_file='parameters_and_classes',
+                   rng=None,
+                   n_jobs=None,
+                   blas_threads=None,
+                   cache_dir=None):
     """
     :param datafile: path to the dataset
 
     :param batch_size: size of a batch used to train the RBM
+
+    :param n_jobs: number of processes training the modalities in parallel;
+                   by default one per modality
+
+    :param blas_threads: number of BLAS threads of each process; by default
+                   the cores are divided among the processes
+
+    :param cache_dir: if not None, directory of a StageCache: the DBNs whose
+                   data and configuration did not change since a previous
+                   run are loaded from it instead of being trained
     """
 
     if rng is None:
         rng = numpy.random.RandomState(123)
 
+    if cache_dir is not None:
+        cache = StageCache(cache_dir)
+    else:
+        cache = None
+
     #################################
     #     Training the RBM          #
     #################################
 
-    me_DBN, output_ME_t_set, output_ME_v_set = train_ME(datafiles['ME'],
-                                                        rng,
-                                                        holdout=holdout,
-                                                        repeats=repeats,
-                                                        lambda_1=0.01,
-                                                        lambda_2=0.01,
-                                                        graph_output=graph_output,
-                                                        datadir=datadir)
-
-    ge_DBN, output_GE_t_set, output_GE_v_set = train_GE(datafiles['GE'],
-                                                        rng,
-                                                        holdout=holdout,
-                                                        repeats=repeats,
-                                                        lambda_1=0.01,
-                                                        lambda_2=0.1,
-                                                        graph_output=graph_output,
-                                                        datadir=datadir)
+    # the modalities are independent until the joint layer
+    modality_kwargs = dict(holdout=holdout,
+                           repeats=repeats,
+                           graph_output=graph_output,
+                           datadir=datadir)
+    bottom_layers = train_bottom_layers({
+        'ME': (train_ME, datafiles['ME'], dict(modality_kwargs, lambda_1=0.01, lambda_2=0.01)),
+        'GE': (train_GE, datafiles['GE'], dict(modality_kwargs, lambda_1=0.01, lambda_2=0.1))
+    }, rng, n_jobs=n_jobs, blas_threads=blas_threads, cache=cache)
+
+    me_DBN, output_ME_t_set, output_ME_v_set = bottom_layers['ME']
+    ge_DBN, output_GE_t_set, output_GE_v_set = bottom_layers['GE']
 
 #    dm_DBN, output_DM_t_set, output_DM_v_set = train_DM(datafiles['DM'],
 #                                                        rng,
@@ -64,9 +83,9 @@ def train_AML_MDBN(datafiles,
 
     print('*** Training on joint layer ***')
 
-    output_ME_t_set, output_ME_v_set = me_DBN.MLP_output_from_datafile(datafiles['ME'], holdout=holdout, repeats=repeats)
-    output_GE_t_set, output_GE_v_set = ge_DBN.MLP_output_from_datafile(datafiles['GE'], holdout=holdout, repeats=repeats)
-    # output_DM_t_set, output_DM_v_set = dm_DBN.MLP_output_from_datafile(datafiles['DM'], holdout=holdout, repeats=repeats)
+    output_ME_t_set, output_ME_v_set = me_DBN.MLP_output_from_datafile(datafiles['ME'], holdout=holdout, datadir=datadir)
+    output_GE_t_set, output_GE_v_set = ge_DBN.MLP_output_from_datafile(datafiles['GE'], holdout=holdout, datadir=datadir)
+    # output_DM_t_set, output_DM_v_set = dm_DBN.MLP_output_from_datafile(datafiles['DM'], holdout=holdout)
 
     joint_train_set = theano.shared(numpy.concatenate([
     #               output_ME_t_set, output_GE_t_set, output_DM_t_set],axis=1), borrow=True)
@@ -79,12 +98,13 @@ def train_AML_MDBN(datafiles,
     else:
         joint_val_set = None
 
-    top_DBN = train_top(batch_size, graph_output, joint_train_set, joint_val_set, rng)
+    top_DBN = train_top_cached(cache, batch_size, graph_output, joint_train_set, joint_val_set,
+                               rng, repeats=repeats)
 
     # Identifying the classes
 
-    ME_output, _ = me_DBN.MLP_output_from_datafile(datafiles['ME'])
-    GE_output, _ = ge_DBN.MLP_output_from_datafile(datafiles['GE'])
+    ME_output, _ = me_DBN.MLP_output_from_datafile(datafiles['ME'], datadir=datadir)
+    GE_output, _ = ge_DBN.MLP_output_from_datafile(datafiles['GE'], datadir=datadir)
 #    DM_output, _ = dm_DBN.MLP_output_from_datafile(datafiles['DM'])
 
 #    joint_output = theano.shared(numpy.concatenate([ME_output, GE_output, DM_output],axis=1), borrow=True)
@@ -100,82 +120,57 @@ def train_AML_MDBN(datafiles,
 def save_network(classes, ge_DBN, me_DBN, dm_DBN, top_DBN, holdout, output_file, output_folder, repeats):
     if not os.path.isdir(output_folder):
         os.makedirs(output_folder)
-    root_dir = os.getcwd()
-    os.chdir(output_folder)
-    numpy.savez(output_file,
-                holdout=holdout,
-                repeats=repeats,
-
-                me_config={
-                    'number_of_nodes': me_DBN.number_of_nodes(),
-                    'epochs': [8000],
-                    'learning_rate': [0.005],
-                    'batch_size': 20,
-                    'k': 10
-                },
-                ge_config={
-                    'number_of_nodes': ge_DBN.number_of_nodes(),
-                    'epochs': [8000, 800],
-                    'learning_rate': [0.005, 0.1],
-                    'batch_size': 20,
-                    'k': 1
-                },
-#                dm_config={
-#                    'number_of_nodes': dm_DBN.number_of_nodes(),
-#                    'epochs': [8000, 800],
-#                    'learning_rate': [0.005, 0.1],
-#                    'batch_size': 20,
-#                    'k': 1
-#                },
-                top_config={
-                    'number_of_nodes': top_DBN.number_of_nodes(),
-                    'epochs': [800, 800],
-                    'learning_rate': [0.1, 0.1],
-                    'batch_size': 20,
-                    'k': 1
-                },
-                classes=classes,
-                me_params=[{p.name: p.get_value()} for p in me_DBN.params],
-                ge_params=[{p.name: p.get_value()} for p in ge_DBN.params],
-#                dm_params=[{p.name: p.get_value()} for p in dm_DBN.params],
-                top_params=[{p.name: p.get_value()} for p in top_DBN.params]
-                )
-    os.chdir(root_dir)
+
+    me_config = {
+        'number_of_nodes': me_DBN.number_of_nodes(),
+        'epochs': [8000],
+        'learning_rate': [0.005],
+        'batch_size': 20,
+        'k': 10
+    }
+    ge_config = {
+        'number_of_nodes': ge_DBN.number_of_nodes(),
+        'epochs': [8000, 800],
+        'learning_rate': [0.005, 0.1],
+        'batch_size': 20,
+        'k': 1
+    }
+    top_config = {
+        'number_of_nodes': top_DBN.number_of_nodes(),
+        'epochs': [800, 800],
+        'learning_rate': [0.1, 0.1],
+        'batch_size': 20,
+        'k': 1
+    }
+#    dm_config = {
+#        'number_of_nodes': dm_DBN.number_of_nodes(),
+#        'epochs': [8000, 800],
+#        'learning_rate': [0.005, 0.1],
+#        'batch_size': 20,
+#        'k': 1
+#    }
+
+    networks = {
+        'me': (me_config, dbn_to_arrays(me_DBN)),
+        'ge': (ge_config, dbn_to_arrays(ge_DBN)),
+        'top': (top_config, dbn_to_arrays(top_DBN))
+#        'dm': (dm_config, dbn_to_arrays(dm_DBN)),
+    }
+    save_model(os.path.join(output_folder, os.path.splitext(output_file)[0]),
+               networks,
+               arrays={'classes': classes},
+               metadata={'holdout': holdout, 'repeats': repeats,
+                         # order of the modalities in the joint layer
+                         'modalities': ['me', 'ge']})
 
 def load_network(input_file, input_folder):
-    root_dir = os.getcwd()
-    # TODO: check if the input_folder exists
-    os.chdir(input_folder)
-    npz = numpy.load(input_file)
-
-    config = npz['me_config'].tolist()
-    params = npz['me_params']
-    layer_sizes = config['number_of_nodes']
-    me_DBN = DBN(n_ins=layer_sizes[0], hidden_layers_sizes=layer_sizes[1:-1], n_outs=layer_sizes[-1],
-                  W_list=[params[0]['W']],b_list=[params[1]['b']])
-
-    config = npz['ge_config'].tolist()
-    params = npz['ge_params']
-    layer_sizes = config['number_of_nodes']
-    ge_DBN = DBN(n_ins=layer_sizes[0], hidden_layers_sizes=layer_sizes[1:-1], n_outs=layer_sizes[-1],
-                  W_list=[params[0]['W'],params[2]['W']],b_list=[params[1]['b'],params[3]['b']])
-
-#    config = npz['dm_config'].tolist()
-#    params = npz['dm_params']
-#    layer_sizes = config['number_of_nodes']
-#    dm_DBN = DBN(n_ins=layer_sizes[0], hidden_layers_sizes=layer_sizes[1:-1], n_outs=layer_sizes[-1],
-#                  W_list=[params[0]['W'],params[2]['W']],b_list=[params[1]['b'],params[3]['b']])
-
-    config = npz['top_config'].tolist()
-    params = npz['top_params']
-    layer_sizes = config['number_of_nodes']
-    top_DBN = DBN(n_ins=layer_sizes[0], hidden_layers_sizes=layer_sizes[1:-1], n_outs=layer_sizes[-1],
-                  gauss=False,
-                  W_list=[params[0]['W'],params[2]['W']],b_list=[params[1]['b'],params[3]['b']])
-
-    os.chdir(root_dir)
-
-#    return (me_DBN, ge_DBN, dm_DBN, top_DBN)
+    networks, _, _ = load_model(os.path.join(input_folder, os.path.splitext(input_file)[0]))
+
+    me_DBN = dbn_from_arrays(networks['me'][1])
+    ge_DBN = dbn_from_arrays(networks['ge'][1])
+    top_DBN = dbn_from_arrays(networks['top'][1])
+#    dm_DBN = dbn_from_arrays(networks['dm'][1])
+
     return (me_DBN, ge_DBN, None, top_DBN)
 
 def train_DM(datafile,
@@ -191,13 +186,17 @@ def train_DM(datafile,
              holdout=0.1,
              repeats=10,
              graph_output=False,
+             checkpoint_file=None,
+             convergence_monitor=None,
+             optimizer=None,
+             lr_schedule=None,
+             centering=None,
              datadir='data'):
     print('*** Training on DM ***')
 
     train_set, validation_set = load_n_preprocess_data(datafile,
                                                        clip=clip,
                                                        holdout=holdout,
-                                                       repeats=repeats,
 #                                                       transform_fn=numpy.power,
 #                                                       exponent=1.0/6.0,
                                                        datadir=datadir)
@@ -211,7 +210,13 @@ def train_DM(datafile,
                               lambda_1=lambda_1,
                               lambda_2=lambda_2,
                               rng=rng,
-                              graph_output=graph_output)
+                              graph_output=graph_output,
+                              repeats=repeats,
+                              checkpoint_file=checkpoint_file,
+                              convergence_monitor=convergence_monitor,
+                              optimizer=optimizer,
+                              lr_schedule=lr_schedule,
+                              centering=centering)
 
 def train_GE(datafile,
              rng,
@@ -226,13 +231,17 @@ def train_GE(datafile,
              holdout=0.1,
              repeats=10,
              graph_output=False,
+             checkpoint_file=None,
+             convergence_monitor=None,
+             optimizer=None,
+             lr_schedule=None,
+             centering=None,
              datadir='data'):
     print('*** Training on GE ***')
 
     train_set, validation_set = load_n_preprocess_data(datafile,
                                                        clip=clip,
                                                        holdout=holdout,
-                                                       repeats=repeats,
                                                        datadir=datadir)
 
     return train_bottom_layer(train_set, validation_set,
@@ -244,7 +253,13 @@ def train_GE(datafile,
                               lambda_1=lambda_1,
                               lambda_2=lambda_2,
                               rng=rng,
-                              graph_output=graph_output)
+                              graph_output=graph_output,
+                              repeats=repeats,
+                              checkpoint_file=checkpoint_file,
+                              convergence_monitor=convergence_monitor,
+                              optimizer=optimizer,
+                              lr_schedule=lr_schedule,
+                              centering=centering)
 
 def train_ME(datafile,
              rng,
@@ -259,13 +274,17 @@ def train_ME(datafile,
              holdout=0.1,
              repeats=10,
              graph_output=False,
+             checkpoint_file=None,
+             convergence_monitor=None,
+             optimizer=None,
+             lr_schedule=None,
+             centering=None,
              datadir='data'):
     print('*** Training on ME ***')
 
     train_set, validation_set = load_n_preprocess_data(datafile,
                                                        clip=clip,
                                                        holdout=holdout,
-                                                       repeats=repeats,
                                                        datadir=datadir)
 
     return train_bottom_layer(train_set, validation_set,
@@ -277,7 +296,13 @@ def train_ME(datafile,
                                 lambda_1=lambda_1,
                                 lambda_2=lambda_2,
                                 rng=rng,
-                                graph_output=graph_output)
+                                graph_output=graph_output,
+                                repeats=repeats,
+                                checkpoint_file=checkpoint_file,
+                                convergence_monitor=convergence_monitor,
+                                optimizer=optimizer,
+                                lr_schedule=lr_schedule,
+                                centering=centering)
 
 def prepare_AML_TCGA_datafiles(datadir='data'):
     datafiles = {
@@ -294,24 +319,20 @@ if __name__ == '__main__':
     output_dir = 'MDBN_run'
     run_start_date = datetime.datetime.now()
     run_start_date_str = run_start_date.strftime("%Y-%m-%d_%H%M")
-    results = []
-    for i in range(1):
-        dbn_output = train_AML_MDBN(datafiles,
-                                    output_folder=output_dir,
-                                    output_file='Exp_%s_run_%d.npz' %
-                                                               (run_start_date_str, i),
-                                    holdout=0.0, repeats=1)
-        results.append(find_unique_classes((dbn_output > 0.5) * numpy.ones_like(dbn_output)))
+    n_runs = 1
+    seeds = range(123, 123 + n_runs)
+    results, consensus = run_ensemble(train_AML_MDBN, datafiles, seeds,
+                                      output_folder=output_dir,
+                                      run_name='Exp_%s' % run_start_date_str,
+                                      holdout=0.0, repeats=1)
+    results = [results[seed] for seed in seeds]
 
     current_date_time = datetime.datetime.now()
     print('*** Run started at %s' % run_start_date.strftime("%H:%M:%S on %B %d, %Y"))
     print('*** Run completed at %s' % current_date_time.strftime("%H:%M:%S on %B %d, %Y"))
 
-    root_dir = os.getcwd()
-    os.chdir(output_dir)
-    numpy.savez('Results_%s.npz' % run_start_date_str,
+    numpy.savez(os.path.join(output_dir, 'Results_%s.npz' % run_start_date_str),
                 results=results)
-    os.chdir(root_dir)
 
 #    train_ME(datafiles['ME'],graph_output=True)
 #    train_GE(datafiles['GE'],graph_output=True)
\ No newline at end of file
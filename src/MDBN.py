@@ -26,19 +26,42 @@ All rights reserved.
 
 from __future__ import print_function, division
 
+import os
+import hashlib
+import multiprocessing
+
+import numpy
+import scipy.sparse
+
 from dbn import DBN
+from utils import find_unique_classes
+from utils import write_atomically
+from utils import preprocessed_data_cache
 
-def train_top(batch_size, graph_output, joint_train_set, joint_val_set, rng):
+# environment variables read by the BLAS libraries at load time
+BLAS_THREADS_VARIABLES = ['OMP_NUM_THREADS',
+                          'MKL_NUM_THREADS',
+                          'OPENBLAS_NUM_THREADS']
+
+def train_top(batch_size, graph_output, joint_train_set, joint_val_set, rng, repeats=1,
+              checkpoint_file=None,
+              k=1,
+              hidden_layers_sizes=[24],
+              n_outs=3,
+              pretraining_epochs=[800, 800],
+              pretrain_lr=[0.1, 0.1]):
     top_DBN = DBN(numpy_rng=rng, n_ins=joint_train_set.get_value().shape[1],
                   gauss=False,
-                  hidden_layers_sizes=[24],
-                  n_outs=3)
+                  hidden_layers_sizes=hidden_layers_sizes,
+                  n_outs=n_outs)
     top_DBN.training(joint_train_set,
-                     batch_size, k=1,
-                     pretraining_epochs=[800, 800],
-                     pretrain_lr=[0.1, 0.1],
+                     batch_size, k=k,
+                     pretraining_epochs=pretraining_epochs,
+                     pretrain_lr=pretrain_lr,
 		     validation_set_x=joint_val_set,
-                     graph_output=graph_output)
+                     graph_output=graph_output,
+                     repeats=repeats,
+                     checkpoint_file=checkpoint_file)
     return top_DBN
 
 
@@ -50,13 +73,22 @@ def train_bottom_layer(train_set, validation_set,
                        lambda_1 = 0.0,
                        lambda_2 = 0.1,
                        rng=None,
-                       graph_output=False
+                       graph_output=False,
+                       gauss=True,
+                       repeats=1,
+                       checkpoint_file=None,
+                       convergence_monitor=None,
+                       optimizer=None,
+                       lr_schedule=None,
+                       centering=None
                     ):
     print('Visible nodes: %i' % train_set.get_value().shape[1])
     print('Output nodes: %i' % layers_sizes[-1])
     dbn = DBN(numpy_rng=rng, n_ins=train_set.get_value().shape[1],
+                  gauss=gauss,
                   hidden_layers_sizes=layers_sizes[:-1],
-                  n_outs=layers_sizes[-1])
+                  n_outs=layers_sizes[-1],
+                  sparse_input=scipy.sparse.issparse(train_set.get_value(borrow=True)))
 
     dbn.training(train_set,
                  batch_size, k=k,
@@ -65,7 +97,13 @@ def train_bottom_layer(train_set, validation_set,
                  lambda_1=lambda_1,
                  lambda_2=lambda_2,
 		 validation_set_x=validation_set,
-                 graph_output=graph_output)
+                 graph_output=graph_output,
+                 repeats=repeats,
+                 checkpoint_file=checkpoint_file,
+                 convergence_monitor=convergence_monitor,
+                 optimizer=optimizer,
+                 lr_schedule=lr_schedule,
+                 centering=centering)
 
     output_train_set = dbn.get_output(train_set)
     if validation_set is not None:
@@ -74,3 +112,428 @@ def train_bottom_layer(train_set, validation_set,
         output_val_set = None
 
     return dbn, output_train_set, output_val_set
+
+def process_pool(n_jobs, blas_threads=None):
+    """
+    Create a pool of n_jobs worker processes, each using at most
+    blas_threads BLAS threads (by default the cores are divided among the
+    workers).
+    """
+    if blas_threads is None:
+        blas_threads = max(1, multiprocessing.cpu_count() // n_jobs)
+
+    # the workers inherit the limits when they load numpy and Theano; new
+    # processes are spawned where possible, as a forked process keeps the
+    # BLAS thread pool of the parent
+    saved_environ = dict((var, os.environ.get(var)) for var in BLAS_THREADS_VARIABLES)
+    for var in BLAS_THREADS_VARIABLES:
+        os.environ[var] = str(blas_threads)
+    try:
+        if hasattr(multiprocessing, 'get_context'):
+            return multiprocessing.get_context('spawn').Pool(n_jobs)
+        else:
+            return multiprocessing.Pool(n_jobs)
+    finally:
+        for var, value in saved_environ.items():
+            if value is None:
+                del os.environ[var]
+            else:
+                os.environ[var] = value
+
+def train_bottom_layer_job(train_fn, datafile, seed, kwargs):
+    """
+    Train a modality in a worker process. The DBN holds Theano functions
+    and is returned to the parent as plain arrays, together with the
+    datasets preprocessed by the job, which the parent adds to its own
+    cache (see utils.preprocessed_data) instead of parsing them again.
+    """
+    # minibatches are shuffled with the global generator
+    numpy.random.seed(seed)
+    known_keys = set(preprocessed_data_cache)
+    dbn, output_train_set, output_val_set = train_fn(datafile,
+                                                     numpy.random.RandomState(seed),
+                                                     **kwargs)
+    preprocessed = dict((key, value) for key, value in preprocessed_data_cache.items()
+                        if key not in known_keys)
+    return dbn_to_arrays(dbn), output_train_set, output_val_set, preprocessed
+
+def dbn_to_arrays(dbn):
+    return {
+        'number_of_nodes': dbn.number_of_nodes(),
+        'gauss': dbn.gauss,
+        'sparse_input': dbn.sparse_input,
+        'W': [layer.W.get_value(borrow=True) for layer in dbn.sigmoid_layers],
+        'b': [layer.b.get_value(borrow=True) for layer in dbn.sigmoid_layers],
+        'vbias': [rbm.vbias.get_value(borrow=True) for rbm in dbn.rbm_layers]
+    }
+
+def dbn_from_arrays(dbn_arrays):
+    layer_sizes = dbn_arrays['number_of_nodes']
+    dbn = DBN(n_ins=layer_sizes[0], hidden_layers_sizes=layer_sizes[1:-1], n_outs=layer_sizes[-1],
+              gauss=dbn_arrays['gauss'], sparse_input=dbn_arrays['sparse_input'],
+              W_list=dbn_arrays['W'], b_list=dbn_arrays['b'])
+    for rbm, vbias in zip(dbn.rbm_layers, dbn_arrays['vbias']):
+        rbm.vbias.set_value(vbias, borrow=True)
+    return dbn
+
+class StageCache(object):
+    """
+    On-disk cache of the results of the stages of the multimodal pipeline.
+    Each result is stored in a .npz file named after a digest of everything
+    the stage depends on: the content of its input data and its
+    configuration. A stage is recomputed only if one of them changed.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.file_digests = {}
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def file_digest(self, path):
+        """Digest of the content of a file, computed once per version"""
+        stat = os.stat(path)
+        version = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+        if version not in self.file_digests:
+            digest = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+            self.file_digests[version] = digest.hexdigest()
+        return self.file_digests[version]
+
+    def key(self, stage, *parts):
+        """
+        Digest of the name of a stage and of its inputs: numpy arrays are
+        hashed by content, dictionaries by their sorted items and anything
+        else by its repr.
+        """
+        digest = hashlib.sha1()
+
+        def update(part):
+            if isinstance(part, numpy.ndarray):
+                part = numpy.ascontiguousarray(part)
+                digest.update(repr((part.dtype.str, part.shape)).encode('utf-8'))
+                digest.update(part.view(numpy.uint8).data)
+            elif isinstance(part, dict):
+                for item in sorted(part.items()):
+                    update(item)
+            elif isinstance(part, (list, tuple)):
+                digest.update(('%s%d' % (type(part).__name__, len(part))).encode('utf-8'))
+                for item in part:
+                    update(item)
+            else:
+                digest.update(repr(part).encode('utf-8'))
+
+        update(stage)
+        for part in parts:
+            update(part)
+        return '%s_%s' % (stage, digest.hexdigest())
+
+    def load(self, key):
+        """Return the arrays stored under key, or None if there are none"""
+        path = os.path.join(self.cache_dir, key + '.npz')
+        if not os.path.isfile(path):
+            return None
+        with numpy.load(path) as npz:
+            return dict((name, npz[name]) for name in npz.files)
+
+    def save(self, key, **arrays):
+        path = os.path.join(self.cache_dir, key + '.npz')
+        write_atomically(path, lambda f: numpy.savez(f, **arrays))
+
+    def checkpoint_file(self, key):
+        """
+        Path of the training checkpoint of the stage key (see
+        DBN.save_checkpoint): an interrupted stage resumes from it and it is
+        removed by save_dbn once the stage is complete
+        """
+        return os.path.join(self.cache_dir, key + '.checkpoint.npz')
+
+    def load_dbn(self, key):
+        """
+        Return the DBN and the extra arrays stored under key, or None if
+        there are none
+        """
+        arrays = self.load(key)
+        if arrays is None:
+            return None
+        number_of_nodes = arrays.pop('number_of_nodes').tolist()
+        n_layers = len(number_of_nodes) - 1
+        dbn_arrays = {
+            'number_of_nodes': number_of_nodes,
+            'gauss': bool(arrays.pop('gauss')),
+            'sparse_input': bool(arrays.pop('sparse_input')),
+            'W': [arrays.pop('W_%d' % i) for i in range(n_layers)],
+            'b': [arrays.pop('b_%d' % i) for i in range(n_layers)],
+            'vbias': [arrays.pop('vbias_%d' % i) for i in range(n_layers)]
+        }
+        return dbn_from_arrays(dbn_arrays), arrays
+
+    def save_dbn(self, key, dbn_arrays, **arrays):
+        for i in range(len(dbn_arrays['W'])):
+            arrays['W_%d' % i] = dbn_arrays['W'][i]
+            arrays['b_%d' % i] = dbn_arrays['b'][i]
+            arrays['vbias_%d' % i] = dbn_arrays['vbias'][i]
+        self.save(key,
+                  number_of_nodes=dbn_arrays['number_of_nodes'],
+                  gauss=dbn_arrays['gauss'],
+                  sparse_input=dbn_arrays['sparse_input'],
+                  **arrays)
+        if os.path.isfile(self.checkpoint_file(key)):
+            os.remove(self.checkpoint_file(key))
+
+def bottom_layer_stage_key(cache, name, train_fn, datafile, seed, kwargs):
+    """
+    Cache key of the training of a modality: the content of its data file,
+    the training function with its default arguments and those of the
+    functions it trains the DBN with, the arguments that affect the result
+    and the seed.
+    """
+    datadir = kwargs.get('datadir', 'data')
+    config = dict((arg, value) for arg, value in kwargs.items()
+                  if arg not in ('datadir', 'graph_output', 'checkpoint_file'))
+    return cache.key('bottom_%s' % name,
+                     cache.file_digest(os.path.join(datadir, datafile)),
+                     train_fn.__name__,
+                     getattr(train_fn, '__defaults__', None),
+                     train_bottom_layer.__defaults__,
+                     DBN.training.__defaults__,
+                     config,
+                     seed)
+
+def train_top_cached(cache, batch_size, graph_output, joint_train_set, joint_val_set,
+                     rng, repeats=1, **kwargs):
+    """
+    train_top with its result cached by the content of the joint datasets
+    and by the hyperparameters of the joint layer, i.e. the keyword
+    arguments passed on to train_top and its defaults. The DBN is trained
+    with a generator seeded from rng, so that the cache key does not
+    depend on the state of rng.
+    """
+    seed = rng.randint(2 ** 30)
+    if cache is None:
+        return train_top(batch_size, graph_output, joint_train_set, joint_val_set,
+                         numpy.random.RandomState(seed), repeats=repeats, **kwargs)
+
+    if joint_val_set is not None:
+        joint_val_data = joint_val_set.get_value(borrow=True)
+    else:
+        joint_val_data = None
+    key = cache.key('top',
+                    joint_train_set.get_value(borrow=True),
+                    joint_val_data,
+                    train_top.__defaults__,
+                    DBN.training.__defaults__,
+                    kwargs,
+                    batch_size, repeats, seed)
+    cached = cache.load_dbn(key)
+    if cached is not None:
+        print('*** Joint layer loaded from the stage cache')
+        return cached[0]
+
+    top_DBN = train_top(batch_size, graph_output, joint_train_set, joint_val_set,
+                        numpy.random.RandomState(seed), repeats=repeats,
+                        checkpoint_file=cache.checkpoint_file(key), **kwargs)
+    cache.save_dbn(key, dbn_to_arrays(top_DBN))
+    return top_DBN
+
+def train_bottom_layers(jobs, rng, n_jobs=None, blas_threads=None, cache=None):
+    """
+    Train the DBNs of independent modalities, each in its own process.
+
+    :param jobs: a dictionary mapping the name of each modality to a tuple
+                 (train_fn, datafile, kwargs), where train_fn is a module
+                 level function such as train_GE, called as
+                 train_fn(datafile, rng, **kwargs)
+
+    :param rng: random number generator used to draw the seed of each
+                modality
+
+    :param n_jobs: number of worker processes; by default one per modality.
+                   With 1 the modalities are trained in this process
+
+    :param blas_threads: number of BLAS threads of each worker; by default
+                   the available cores are divided among the workers
+
+    :param cache: a StageCache; the modalities whose data and configuration
+                   are unchanged since a previous run are loaded from it
+                   instead of being trained, and the interrupted trainings
+                   resume from their last checkpoint
+
+    :return: a dictionary mapping the name of each modality to the tuple
+             (dbn, output_train_set, output_val_set) returned by train_fn
+    """
+    names = sorted(jobs.keys())
+    seeds = dict((name, rng.randint(2 ** 30)) for name in names)
+
+    results = {}
+    if cache is not None:
+        keys = {}
+        for name in names:
+            train_fn, datafile, kwargs = jobs[name]
+            keys[name] = bottom_layer_stage_key(cache, name, train_fn, datafile,
+                                                seeds[name], kwargs)
+            cached = cache.load_dbn(keys[name])
+            if cached is not None:
+                print('*** %s loaded from the stage cache' % name)
+                dbn, arrays = cached
+                results[name] = (dbn, arrays['output_train_set'],
+                                 arrays.get('output_val_set'))
+        names = [name for name in names if name not in results]
+        # the interrupted trainings resume from their checkpoints
+        jobs = dict((name, (train_fn, datafile,
+                            dict(kwargs, checkpoint_file=cache.checkpoint_file(keys[name]))))
+                    for name, (train_fn, datafile, kwargs) in jobs.items())
+
+    if n_jobs is None:
+        n_jobs = len(names)
+    n_jobs = min(n_jobs, len(names))
+
+    trained = {}
+    if n_jobs <= 1:
+        for name in names:
+            train_fn, datafile, kwargs = jobs[name]
+            # seeded as in train_bottom_layer_job, so that the result does
+            # not depend on n_jobs
+            numpy.random.seed(seeds[name])
+            trained[name] = train_fn(datafile, numpy.random.RandomState(seeds[name]), **kwargs)
+    else:
+        pool = process_pool(n_jobs, blas_threads)
+        try:
+            async_results = {}
+            for name in names:
+                train_fn, datafile, kwargs = jobs[name]
+                async_results[name] = pool.apply_async(train_bottom_layer_job,
+                                                       (train_fn, datafile, seeds[name], kwargs))
+            pool.close()
+
+            for name in names:
+                dbn_arrays, output_train_set, output_val_set, preprocessed = \
+                    async_results[name].get()
+                preprocessed_data_cache.update(preprocessed)
+                trained[name] = (dbn_from_arrays(dbn_arrays), output_train_set, output_val_set)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    if cache is not None:
+        for name, (dbn, output_train_set, output_val_set) in trained.items():
+            arrays = {'output_train_set': output_train_set}
+            if output_val_set is not None:
+                arrays['output_val_set'] = output_val_set
+            cache.save_dbn(keys[name], dbn_to_arrays(dbn), **arrays)
+
+    results.update(trained)
+    return results
+
+class ConsensusMatrix(object):
+    """
+    Co-clustering consensus of an ensemble of runs: the entry (i, j) is
+    the fraction of runs in which the samples i and j are in the same
+    class. It is updated one run at a time.
+    """
+    def __init__(self):
+        self.co_clustered = None
+        self.n_runs = 0
+
+    def add(self, classified_samples):
+        classified_samples = numpy.asarray(classified_samples)
+        if self.co_clustered is None:
+            n_samples = classified_samples.shape[0]
+            self.co_clustered = numpy.zeros((n_samples, n_samples), dtype=numpy.int32)
+        self.co_clustered += classified_samples[:, None] == classified_samples[None, :]
+        self.n_runs += 1
+
+    def matrix(self):
+        return self.co_clustered / max(self.n_runs, 1)
+
+    def save(self, output_file, seeds):
+        # written under a temporary name and then renamed, so that the
+        # file on disk is always a complete consensus
+        write_atomically(output_file,
+                         lambda f: numpy.savez(f,
+                                               consensus=self.matrix(),
+                                               co_clustered=self.co_clustered,
+                                               n_runs=self.n_runs,
+                                               seeds=seeds))
+
+def ensemble_run_job(job):
+    """
+    Train a multimodal DBN in a worker process of run_ensemble and return
+    the classes found for its seed.
+    """
+    train_fn, datafiles, seed, output_folder, output_file, kwargs = job
+    # minibatches are shuffled with the global generator
+    numpy.random.seed(seed)
+    dbn_output = train_fn(datafiles,
+                          rng=numpy.random.RandomState(seed),
+                          output_folder=output_folder,
+                          output_file=output_file,
+                          **kwargs)
+    return seed, find_unique_classes((dbn_output > 0.5) * numpy.ones_like(dbn_output))
+
+def run_ensemble(train_fn, datafiles, seeds, output_folder, run_name,
+                 n_jobs=None, blas_threads=None, **kwargs):
+    """
+    Train a multimodal DBN for each seed, in a pool of processes, and
+    compute the co-clustering consensus of the classes found.
+
+    Each finished run saves its classes in <run_name>_seed_<seed>.npz, and
+    the consensus of the runs finished so far is kept up to date in
+    <run_name>_consensus.npz, so that a long ensemble can be inspected or
+    interrupted at any time.
+
+    :param train_fn: a module level function such as train_AML_MDBN
+    :param datafiles: the datafiles passed to train_fn
+    :param seeds: the seeds of the runs; each run uses its own RandomState,
+                  which also seeds the Theano random streams of its DBNs
+    :param output_folder: directory where the results are stored
+    :param run_name: prefix of the names of the output files
+    :param n_jobs: number of worker processes; by default one per core. With
+                   1 the runs are done in this process, one after another,
+                   each training its modalities in parallel
+    :param blas_threads: number of BLAS threads of each worker
+    :param kwargs: further arguments of train_fn
+    :return: a dictionary mapping each seed to the classes found by
+             find_unique_classes, and the ConsensusMatrix
+    """
+    if not os.path.isdir(output_folder):
+        os.makedirs(output_folder)
+
+    seeds = list(seeds)
+    jobs = [(train_fn, datafiles, seed, output_folder,
+             '%s_seed_%d_network' % (run_name, seed), kwargs)
+            for seed in seeds]
+
+    if n_jobs is None:
+        n_jobs = multiprocessing.cpu_count()
+    n_jobs = min(n_jobs, len(jobs))
+
+    if n_jobs <= 1:
+        pool = None
+        finished_runs = (ensemble_run_job(job) for job in jobs)
+    else:
+        # the workers are daemonic processes: they can not start the pool
+        # of train_bottom_layers, so they train their modalities in turn
+        jobs = [job[:-1] + (dict(job[-1], n_jobs=1),) for job in jobs]
+        pool = process_pool(n_jobs, blas_threads)
+        finished_runs = pool.imap_unordered(ensemble_run_job, jobs)
+
+    results = {}
+    consensus = ConsensusMatrix()
+    try:
+        for seed, (classified_samples, distance_matrix) in finished_runs:
+            numpy.savez(os.path.join(output_folder, '%s_seed_%d.npz' % (run_name, seed)),
+                        classified_samples=classified_samples,
+                        distance_matrix=distance_matrix)
+            results[seed] = (classified_samples, distance_matrix)
+            consensus.add(classified_samples)
+            consensus.save(os.path.join(output_folder, '%s_consensus.npz' % run_name),
+                           sorted(results.keys()))
+            print('*** Run with seed %d done (%d of %d)' % (seed, len(results), len(seeds)))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    return results, consensus
@@ -42,16 +42,16 @@ class MNIST(object):
         if not os.path.isdir(datadir):
             os.mkdir(datadir)
 
-        root_dir = os.getcwd()
-        os.chdir(datadir)
+        datapath = os.path.join(datadir, datafile)
+        targetpath = os.path.join(datadir, targetfile)
 
         # Read the images
-        if not os.path.isfile(datafile):
+        if not os.path.isfile(datapath):
             print('Downloading the data file from http://yann.lecun.com/exdb/mnist')
             testfile = urllib.URLopener()
-            testfile.retrieve("http://yann.lecun.com/exdb/mnist/"+datafile, datafile)
+            testfile.retrieve("http://yann.lecun.com/exdb/mnist/"+datafile, datapath)
 
-        with gzip.open(datafile, 'rb') as file:
+        with gzip.open(datapath, 'rb') as file:
             data = file.read()
             header = struct.unpack(">IIII", data[:16])
             n_images = header[1]
@@ -66,12 +66,12 @@ class MNIST(object):
                 self.images[i] = list(image)
 
         # Read the labels
-        if not os.path.isfile(targetfile):
+        if not os.path.isfile(targetpath):
             print('Downloading the target file from http://yann.lecun.com/exdb/mnist')
             testfile = urllib.URLopener()
-            testfile.retrieve("http://yann.lecun.com/exdb/mnist/"+targetfile, targetfile)
+            testfile.retrieve("http://yann.lecun.com/exdb/mnist/"+targetfile, targetpath)
 
-        with gzip.open(targetfile, 'rb') as file:
+        with gzip.open(targetpath, 'rb') as file:
             data = file.read()
             header = struct.unpack(">II", data[:8])
             n_labels = header[1]
@@ -84,7 +84,6 @@ class MNIST(object):
 
             self.n_levels = numpy.int(numpy.max(self.labels)-numpy.min(self.labels)+1)
 
-        os.chdir(root_dir)
         return n_images
 
     def normalize(self, X):
@@ -0,0 +1,212 @@
+"""
+Copyright (c) 2016 Gianluca Gerard
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+from __future__ import print_function, division
+
+import numpy
+
+# Convergence monitors decide when the pretraining of a layer of a DBN can
+# stop. DBN.training evaluates the monitor every `frequency` epochs,
+# passing a dictionary of functions that compute the metrics of the layer
+# being trained on demand:
+#
+#   'reconstruction_error': mean training cost of the last epochs
+#   'free_energy_gap': mean free energy of the validation set minus the
+#                      one of the training set (only with a validation set)
+#   'hidden_activations': activations of the hidden units for a fixed
+#                         subset of the training set
+
+
+class ConvergenceMonitor(object):
+    """
+    Stop the training when the metric has not improved for patience
+    epochs. An improvement must be larger than min_delta times the best
+    value so far.
+    """
+    metric = None
+
+    def __init__(self, patience=200, frequency=10, min_delta=0.001):
+        """
+        :param patience: number of epochs without improvement after which
+                         the training stops
+        :param frequency: number of epochs between two evaluations
+        :param min_delta: relative improvement considered significant
+        """
+        self.patience = patience
+        self.frequency = frequency
+        self.min_delta = min_delta
+        self.reset()
+
+    def options(self):
+        """The arguments of the constructor"""
+        return {'patience': self.patience,
+                'frequency': self.frequency,
+                'min_delta': self.min_delta}
+
+    def __repr__(self):
+        # stable across runs, it is part of the keys of the stage cache
+        return '%s(%s)' % (type(self).__name__,
+                           ', '.join('%s=%r' % item for item in sorted(self.options().items())))
+
+    def reset(self):
+        """Forget the history, called at the beginning of each layer"""
+        self.best = numpy.inf
+        self.best_epoch = 0
+
+    def due(self, epoch, n_epochs=1):
+        """True if the monitor must be evaluated after the last n_epochs up to epoch"""
+        return epoch // self.frequency > (epoch - n_epochs) // self.frequency
+
+    def measure(self, metrics):
+        """The value of the monitored metric, lower is better"""
+        return metrics[self.metric]()
+
+    def update(self, epoch, metrics):
+        """
+        Evaluate the metric at the end of epoch.
+
+        :param epoch: the number of epochs run
+        :param metrics: a dictionary of functions computing the metrics
+        :return: True if the training must stop
+        """
+        value = self.measure(metrics)
+        if value is None:
+            return False
+        if self.best == numpy.inf or value < self.best - self.min_delta * abs(self.best):
+            self.best = value
+            self.best_epoch = epoch
+        elif epoch - self.best_epoch >= self.patience:
+            print('No improvement of the %s since epoch %d, stopping at epoch %d' %
+                  (self.metric, self.best_epoch, epoch))
+            return True
+        return False
+
+    def get_state(self):
+        """The state of the monitor as a dictionary of numbers, for checkpoints"""
+        return {'best': self.best, 'best_epoch': self.best_epoch}
+
+    def set_state(self, state):
+        self.best = float(state['best'])
+        self.best_epoch = int(state['best_epoch'])
+
+
+class ReconstructionErrorMonitor(ConvergenceMonitor):
+    """Stop when the reconstruction error of the training set stops decreasing"""
+    metric = 'reconstruction_error'
+
+
+class FreeEnergyGapMonitor(ConvergenceMonitor):
+    """
+    Stop when the free energy gap between the validation and the training
+    set has been growing for patience epochs, i.e. when the RBM starts to
+    overfit. The gap is smoothed by an exponential moving average.
+    """
+    metric = 'free_energy_gap'
+
+    def __init__(self, patience=200, frequency=10, min_delta=0.0, smoothing=0.5):
+        """
+        :param smoothing: weight of the past in the moving average of the gap
+        """
+        self.smoothing = smoothing
+        super(FreeEnergyGapMonitor, self).__init__(patience=patience,
+                                                   frequency=frequency,
+                                                   min_delta=min_delta)
+
+    def options(self):
+        options = super(FreeEnergyGapMonitor, self).options()
+        options['smoothing'] = self.smoothing
+        return options
+
+    def reset(self):
+        super(FreeEnergyGapMonitor, self).reset()
+        self.average = None
+
+    def measure(self, metrics):
+        gap = metrics[self.metric]()
+        if self.average is None:
+            self.average = gap
+        else:
+            self.average = self.smoothing * self.average + (1 - self.smoothing) * gap
+        return self.average
+
+    def get_state(self):
+        state = super(FreeEnergyGapMonitor, self).get_state()
+        if self.average is not None:
+            state['average'] = self.average
+        return state
+
+    def set_state(self, state):
+        super(FreeEnergyGapMonitor, self).set_state(state)
+        self.average = float(state['average']) if 'average' in state else None
+
+
+class HiddenActivationMonitor(ConvergenceMonitor):
+    """
+    Stop when the mean absolute change of the hidden activations between
+    two evaluations has stayed below tolerance for patience epochs.
+    """
+    metric = 'hidden_activations'
+
+    def __init__(self, patience=100, frequency=10, tolerance=0.001):
+        """
+        :param tolerance: mean absolute change considered negligible
+        """
+        self.tolerance = tolerance
+        super(HiddenActivationMonitor, self).__init__(patience=patience,
+                                                      frequency=frequency)
+
+    def options(self):
+        return {'patience': self.patience,
+                'frequency': self.frequency,
+                'tolerance': self.tolerance}
+
+    def reset(self):
+        super(HiddenActivationMonitor, self).reset()
+        self.previous = None
+        self.stable_since = None
+
+    def update(self, epoch, metrics):
+        activations = metrics[self.metric]()
+        previous, self.previous = self.previous, activations
+        if previous is None:
+            return False
+        change = numpy.mean(numpy.abs(activations - previous))
+        if change >= self.tolerance:
+            self.stable_since = None
+        elif self.stable_since is None:
+            self.stable_since = epoch
+        elif epoch - self.stable_since >= self.patience:
+            print('The hidden activations are stable since epoch %d, stopping at epoch %d' %
+                  (self.stable_since, epoch))
+            return True
+        return False
+
+    def get_state(self):
+        # the activations are measured again after a resume
+        if self.stable_since is None:
+            return {}
+        return {'stable_since': self.stable_since}
+
+    def set_state(self, state):
+        self.previous = None
+        self.stable_since = int(state['stable_since']) if 'stable_since' in state else None
@@ -30,17 +30,23 @@ import timeit
 import sys
 import os
 
-import matplotlib.pyplot as plt
-
 import numpy
+import scipy.sparse
 import theano
 from theano import tensor
+from theano import sparse
 #from theano.tensor.shared_randomstreams import RandomStreams
 from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 #from theano.compile.nanguardmode import NanGuardMode
 
+from snapshot_writer import SnapshotWriter
 from utils import get_minibatches_idx
+from utils import get_fused_minibatches_idx
 from utils import load_n_preprocess_data
+from utils import load_n_preprocess_sparse_data
+from utils import dot_maybe_sparse
+from utils import rows_maybe_sparse
+from utils import write_atomically
 
 from rbm import RBM
 from rbm import GRBM
@@ -48,6 +54,18 @@ from mlp import HiddenLayer
 
 from MNIST import MNIST
 
+def rng_state_to_arrays(prefix, state):
+    """The state of a numpy.random.RandomState as a dictionary of arrays"""
+    return {prefix + '_keys': state[1],
+            prefix + '_pos': state[2],
+            prefix + '_gauss': numpy.array([state[3], state[4]])}
+
+def rng_state_from_arrays(prefix, arrays):
+    """Inverse of rng_state_to_arrays"""
+    gauss = arrays[prefix + '_gauss']
+    return ('MT19937', arrays[prefix + '_keys'], int(arrays[prefix + '_pos']),
+            int(gauss[0]), float(gauss[1]))
+
 class DBN(object):
     """Deep Belief Network
 
@@ -64,7 +82,7 @@ class DBN(object):
     def __init__(self, numpy_rng=None, theano_rng=None, n_ins=784,
                  gauss=True,
                  hidden_layers_sizes=[400], n_outs=40,
-                 W_list=None, b_list=None):
+                 W_list=None, b_list=None, sparse_input=False):
         """This class is made to support a variable number of layers.
 
         :type numpy_rng: numpy.random.RandomState
@@ -96,9 +114,20 @@ class DBN(object):
         :type b_list: list of numpy.ndarray
         :param b_list: the list of biases vectors for each layer of the MLP; if
                        None each vector is randomly initialized
+
+        :type sparse_input: bool
+        :param sparse_input: True if the input of the DBN is a sparse CSR
+                       matrix; the first layer is then computed with sparse x
+                       dense products (only with a Bernoullian first layer)
         """
 
+        assert not (sparse_input and gauss)
+
         self.n_ins = n_ins
+        self.gauss = gauss
+        self.sparse_input = sparse_input
+        self.output_fns = {}
+        self.layer_fns = {}
         self.sigmoid_layers = []
         self.rbm_layers = []
         self.params = []
@@ -116,7 +145,10 @@ class DBN(object):
         # allocate symbolic variables for the data
 
         # the data is presented as rasterized images
-        self.x = tensor.matrix('x')
+        if sparse_input:
+            self.x = sparse.csr_matrix('x', dtype=theano.config.floatX)
+        else:
+            self.x = tensor.matrix('x')
 
         # The DBN is an MLP, for which all weights of intermediate
         # layers are shared with a different RBM.  We will first
@@ -223,30 +255,83 @@ class DBN(object):
         :param layer: the index of the layer; if None it defaults to the
                       last layer of the network
 
-        :return: a theano.function object or None if the input is None
+        :return: a numpy.ndarray with the output of the layer or None if
+                 the input is None
         '''
         if input is not None:
-            fn = theano.function(inputs=[],
-                                 outputs=self.sigmoid_layers[layer].output,
-                                 givens={
-                                     self.x: input
-                                 })
-            return fn()
+            if isinstance(input, theano.compile.SharedVariable):
+                input = input.get_value(borrow=True)
+            return self.get_output_fn(layer)(input)
         else:
             return None
 
-    def training_functions(self, train_set_x, batch_size, k,
-                           lambda_1 = 0.0, lambda_2 = 0.1,
-                           monitor=False):
-        '''Generates a list of functions, for performing one step of
-        gradient descent at a given layer. The function will require
-        as input the minibatch index, and to train an RBM you just
-        need to iterate, calling the corresponding function on all
-        minibatch indexes.
+    def get_output_fn(self, layer=-1):
+        '''
+        Return the compiled function computing the output of the MLP layer
+        of index layer. The function takes the input samples as argument
+        and it is compiled only the first time it is requested.
+
+        :type layer: int
+        :param layer: the index of the layer; if None it defaults to the
+                      last layer of the network
+
+        :return: a theano.function object
+        '''
+        layer = layer % self.n_layers
+        if layer not in self.output_fns:
+            self.output_fns[layer] = theano.function(
+                inputs=[self.x],
+                outputs=self.sigmoid_layers[layer].output,
+                allow_input_downcast=True,
+                name='output_layer_%d' % layer)
+        return self.output_fns[layer]
+
+    def propagate_layer(self, input, layer):
+        '''
+        Return the output of the MLP layer of index layer when the layer is
+        presented the output of the layer below (or the input of the network
+        for the first layer).
+
+        :type input: numpy.ndarray, scipy.sparse.csr_matrix or a shared variable
+        :param input: the input of the layer, one sample per row
+
+        :type layer: int
+        :param layer: the index of the layer
+
+        :return: a numpy.ndarray with the output of the layer
+        '''
+        if isinstance(input, theano.compile.SharedVariable):
+            input = input.get_value(borrow=True)
+        layer = layer % self.n_layers
+        if layer not in self.layer_fns:
+            sigmoid_layer = self.sigmoid_layers[layer]
+            layer_input = sigmoid_layer.input.type('layer_input')
+            self.layer_fns[layer] = theano.function(
+                inputs=[layer_input],
+                outputs=sigmoid_layer.activation(
+                    dot_maybe_sparse(layer_input, sigmoid_layer.W) + sigmoid_layer.b),
+                allow_input_downcast=True,
+                name='propagate_layer_%d' % layer)
+        return self.layer_fns[layer](input)
+
+    def layer_training_functions(self, i, train_set_x, batch_size, k,
+                                 lambda_1 = 0.0, lambda_2 = 0.1,
+                                 monitor=False, fused=False, optimizer=None,
+                                 centering=None):
+        '''Generates the functions for performing one step of
+        gradient descent at layer i and for computing the free energies.
+        The training function will require as input the minibatch index,
+        and to train the RBM you just need to iterate, calling the function
+        on all minibatch indexes.
+
+        :type i: int
+        :param i: the index of the layer
 
         :type train_set_x: theano.tensor.TensorType
-        :param train_set_x: Shared var. that contains all datapoints used
-                            for training the DBN
+        :param train_set_x: Shared var. that contains the input of layer i
+                            for all the datapoints used for training, i.e.
+                            the training set for the first layer or the
+                            output of the layer below for the other layers
 
         :type batch_size: int
         :param batch_size: size of a [mini]batch
@@ -265,6 +350,22 @@ class DBN(object):
         :type monitor: bool
         :param monitor: set to true to enable theano debugging Monitoring Mode;
                         default is false
+
+        :type fused: bool
+        :param fused: set to true to compile also the function running
+                      several epochs with a single call (see
+                      RBM.fused_training_function); default is false
+
+        :type optimizer: optimizers.Momentum
+        :param optimizer: the rule updating the parameter speeds; None for
+                      the momentum
+
+        :type centering: str
+        :param centering: None, 'data' or 'enhanced' to train the centered
+                      RBM (see RBM.center_gradients)
+
+        :return: the training function, the free energy function and the
+                 fused training function or None if fused is false
         '''
 
         # index to a [mini]batch
@@ -275,61 +376,188 @@ class DBN(object):
         # TODO: deal with batch_size of 1
         assert batch_size > 1
 
-        train_fns = []
-        free_energy_gap_fns = []
-        for i, rbm in enumerate(self.rbm_layers):
-            # get the cost and the updates list
-            # using CD-k here (persisent=None) for training each RBM.
-            # TODO: change cost function to reconstruction error
-            if isinstance(rbm, GRBM):
-                cost, updates = rbm.get_cost_updates(learning_rate,
-                                                     lambda_1=lambda_1,
-                                                     lambda_2 = lambda_2,
-                                                     batch_size=batch_size,
-                                                     persistent=None, k=k)
-            else:
-                cost, updates = rbm.get_cost_updates(learning_rate,
-                                                     weightcost = 0.0002,
-                                                     batch_size=batch_size,
-                                                     persistent=None, k=k)
-
-            # compile the theano function
-            if monitor:
-                mode = theano.compile.MonitorMode(pre_func=self.inspect_inputs)
-            else:
-                mode = theano.config.mode
+        rbm = self.rbm_layers[i]
+        # get the cost and the updates list
+        # using CD-k here (persisent=None) for training each RBM.
+        # TODO: change cost function to reconstruction error
+        if isinstance(rbm, GRBM):
+            cost, updates = rbm.get_cost_updates(learning_rate,
+                                                 lambda_1=lambda_1,
+                                                 lambda_2 = lambda_2,
+                                                 batch_size=batch_size,
+                                                 persistent=None, k=k,
+                                                 optimizer=optimizer,
+                                                 centering=centering)
+        else:
+            cost, updates = rbm.get_cost_updates(learning_rate,
+                                                 weightcost = 0.0002,
+                                                 batch_size=batch_size,
+                                                 persistent=None, k=k,
+                                                 optimizer=optimizer,
+                                                 centering=centering)
+
+        # compile the theano function
+        if monitor:
+            mode = theano.compile.MonitorMode(pre_func=self.inspect_inputs)
+        else:
+            mode = theano.config.mode
+
+        # The input of the RBM is replaced by the materialised input of
+        # the layer so that the frozen layers below are not evaluated
+        # at each minibatch
+        train_fn = theano.function(
+            inputs=[indexes, momentum, theano.In(learning_rate)],
+            outputs=cost,
+            updates=updates,
+            givens={
+                    rbm.input: rows_maybe_sparse(train_set_x, indexes),
+                    rbm.momentum: momentum
+            },
+            # optimizers such as Adam do not use the momentum
+            on_unused_input='ignore',
+            mode = mode
+#           mode=NanGuardMode(nan_is_error=True, inf_is_error=True, big_is_error=True)
+        )
+
+        train_sample = rbm.input.type('train_smaple')
+        test_sample = rbm.input.type('validation_smaple')
+
+        feg = rbm.free_energies(train_sample, test_sample)
+
+        free_energy_gap_fn = theano.function(
+            inputs=[train_sample, test_sample],
+            outputs=feg,
+            mode=mode
+        )
+
+        if fused:
+            fused_train_fn = rbm.fused_training_function(train_set_x,
+                                                         cost, updates,
+                                                         inputs=[theano.In(learning_rate)],
+                                                         mode=mode)
+        else:
+            fused_train_fn = None
 
-            fn = theano.function(
-                inputs=[indexes, momentum, theano.In(learning_rate)],
-                outputs=cost,
-                updates=updates,
-                givens={
-                        self.x: train_set_x[indexes],
-                        rbm.momentum: momentum
-                },
-                mode = mode
-    #           mode=NanGuardMode(nan_is_error=True, inf_is_error=True, big_is_error=True)
-            )
+        return train_fn, free_energy_gap_fn, fused_train_fn
 
-            # append `fn` to the list of functions
-            train_fns.append(fn)
+    def save_checkpoint(self, checkpoint_file, layer, epoch, monitor_state=None,
+                        first_stream=None):
+        '''
+        Atomically write the state of the pretraining to checkpoint_file:
+        the parameters, the speeds and the offsets of all the RBMs, the
+        persistent chains, the state of their optimizers, the random number generators, the
+        epoch of the layer being trained and the state of its convergence
+        monitor. The file is first written next to checkpoint_file and then
+        renamed, so an interrupted write leaves the previous checkpoint
+        intact.
+
+        :type checkpoint_file: str
+        :param checkpoint_file: the path of the checkpoint
+
+        :type layer: int
+        :param layer: the index of the layer being trained
 
-            train_sample = tensor.matrix('train_smaple', dtype=theano.config.floatX)
-            test_sample = tensor.matrix('validation_smaple', dtype=theano.config.floatX)
+        :type epoch: int
+        :param epoch: the number of epochs of layer already run
 
-            feg = rbm.free_energies(train_sample, test_sample)
+        :type monitor_state: dict
+        :param monitor_state: the state of the convergence monitor (see
+                              ConvergenceMonitor.get_state)
 
-            # Obtain the input of layer i as the output of the previous
-            # layer
-            fn = theano.function(
-                inputs=[train_sample, test_sample],
-                outputs=feg,
-                mode=mode
-            )
+        :type first_stream: int
+        :param first_stream: the index of the first random stream of the
+                             Theano generator used by the training
+                             functions of layer; None if they are not
+                             compiled yet
+        '''
+        arrays = {
+            'layer': layer,
+            'epoch': epoch
+        }
+        if monitor_state is not None:
+            for name, value in monitor_state.items():
+                arrays['monitor_' + name] = value
+        for i, rbm in enumerate(self.rbm_layers):
+            for j, (param, speed) in enumerate(zip(rbm.params, rbm.params_speed)):
+                arrays['param_%d_%d' % (i, j)] = param.get_value(borrow=True)
+                arrays['speed_%d_%d' % (i, j)] = speed.get_value(borrow=True)
+            if rbm.persistent_chain is not None:
+                arrays['persistent_chain_%d' % i] = rbm.persistent_chain.get_value(borrow=True)
+            for j, state in enumerate(rbm.optimizer_state):
+                arrays['optimizer_%d_%d' % (i, j)] = state.get_value(borrow=True)
+            for j, offset in enumerate(rbm.offsets):
+                arrays['offset_%d_%d' % (i, j)] = offset.get_value(borrow=True)
+
+        # shuffling of the minibatches
+        arrays.update(rng_state_to_arrays('numpy_random', numpy.random.get_state()))
+        # generators shared by the RBMs
+        rbm = self.rbm_layers[min(layer, self.n_layers - 1)]
+        arrays.update(rng_state_to_arrays('numpy_rng', rbm.numpy_rng.get_state()))
+        arrays['theano_rstate'] = rbm.theano_rng.rstate
+        if first_stream is not None:
+            # the entries of MRG_RandomStreams.state_updates are tuples
+            # starting with the shared state of the stream
+            for n, entry in enumerate(rbm.theano_rng.state_updates[first_stream:]):
+                arrays['theano_stream_%d' % n] = entry[0].get_value(borrow=True)
+
+        write_atomically(checkpoint_file, lambda f: numpy.savez(f, **arrays))
+
+    def load_checkpoint(self, checkpoint_file):
+        '''
+        Restore the parameters, the speeds, the offsets and the persistent
+        chains of all the RBMs saved by save_checkpoint.
 
-            free_energy_gap_fns.append(fn)
+        :type checkpoint_file: str
+        :param checkpoint_file: the path of the checkpoint
 
-        return train_fns, free_energy_gap_fns
+        :return: a dictionary with the content of the checkpoint, to be
+                 passed to restore_training_state
+        '''
+        with numpy.load(checkpoint_file) as npz:
+            checkpoint = dict((name, npz[name]) for name in npz.files)
+        for i, rbm in enumerate(self.rbm_layers):
+            for j, (param, speed) in enumerate(zip(rbm.params, rbm.params_speed)):
+                param.set_value(checkpoint['param_%d_%d' % (i, j)], borrow=True)
+                speed.set_value(checkpoint['speed_%d_%d' % (i, j)], borrow=True)
+            if 'persistent_chain_%d' % i in checkpoint and rbm.persistent_chain is not None:
+                rbm.persistent_chain.set_value(checkpoint['persistent_chain_%d' % i],
+                                               borrow=True)
+            for j, offset in enumerate(rbm.offsets):
+                if 'offset_%d_%d' % (i, j) in checkpoint:
+                    offset.set_value(checkpoint['offset_%d_%d' % (i, j)], borrow=True)
+        checkpoint['layer'] = int(checkpoint['layer'])
+        checkpoint['epoch'] = int(checkpoint['epoch'])
+        checkpoint['monitor_state'] = dict((name[len('monitor_'):], checkpoint[name])
+                                           for name in checkpoint
+                                           if name.startswith('monitor_'))
+        return checkpoint
+
+    def restore_training_state(self, checkpoint, first_stream=None):
+        '''
+        Restore the random number generators and the state of the
+        optimizer saved by save_checkpoint. The generators are restored
+        before the training functions of the layer are compiled, and the
+        random streams and the optimizer state created with those functions
+        after, passing first_stream.
+        '''
+        rbm = self.rbm_layers[min(checkpoint['layer'], self.n_layers - 1)]
+        if first_stream is None:
+            numpy.random.set_state(rng_state_from_arrays('numpy_random', checkpoint))
+            rbm.numpy_rng.set_state(rng_state_from_arrays('numpy_rng', checkpoint))
+            rbm.theano_rng.rstate = checkpoint['theano_rstate']
+        else:
+            for n, entry in enumerate(rbm.theano_rng.state_updates[first_stream:]):
+                if 'theano_stream_%d' % n in checkpoint:
+                    entry[0].set_value(checkpoint['theano_stream_%d' % n], borrow=True)
+            if 'theano_stream_0' in checkpoint:
+                # the checkpoint was saved after the streams of the layer
+                # were created, which advanced the generator again since it
+                # was restored
+                rbm.theano_rng.rstate = checkpoint['theano_rstate']
+            for j, state in enumerate(rbm.optimizer_state):
+                if 'optimizer_%d_%d' % (checkpoint['layer'], j) in checkpoint:
+                    state.set_value(checkpoint['optimizer_%d_%d' % (checkpoint['layer'], j)],
+                                    borrow=True)
 
     def training(self, train_set_x,
                  batch_size, k,
@@ -337,7 +565,11 @@ class DBN(object):
                  lambda_1 = 0.0,
                  lambda_2 = 0.1,
                  validation_set_x=None,
-                 monitor=False, graph_output=False):
+                 monitor=False, graph_output=False,
+                 fused_epochs=0, repeats=1, graph_dir='.',
+                 checkpoint_file=None, checkpoint_frequency=100,
+                 convergence_monitor=None, optimizer=None, lr_schedule=None,
+                 centering=None, monitor_frequency=None, monitor_samples=None):
         '''
         Run the DBN pretraining.
 
@@ -374,58 +606,141 @@ class DBN(object):
                         default is false
 
         :type graph_output: bool
-        :param graph_output: set to true to enable graphical output;
-                        default is false
+        :param graph_output: set to true to plot the output of the layer
+                        being trained at each validation check; the plots
+                        are written to graph_dir in the background (see
+                        SnapshotWriter); default is false
+
+        :type fused_epochs: int
+        :param fused_epochs: if greater than 0, the number of epochs run
+                        with a single call of the compiled training function;
+                        a call never goes past an evaluation of the
+                        convergence monitor, while the validation checks
+                        falling inside a call are evaluated at its end;
+                        default is 0
+
+        :type repeats: int
+        :param repeats: number of times each sample of the training set is
+                        visited in an epoch; the samples are repeated
+                        through the minibatch indexes, so a single copy of
+                        the training set is kept in memory; default is 1
+
+        :type graph_dir: str
+        :param graph_dir: the directory of the plots written when
+                        graph_output is true; default is the current directory
+
+        :type checkpoint_file: str
+        :param checkpoint_file: if not None, the state of the pretraining
+                        is saved to this file every checkpoint_frequency
+                        epochs and at the end of each layer (see
+                        DBN.save_checkpoint); if the file exists when the
+                        training starts, the training continues from the
+                        saved state; default is None
+
+        :type checkpoint_frequency: int
+        :param checkpoint_frequency: number of epochs between two
+                        checkpoints; default is 100
+
+        :type convergence_monitor: convergence.ConvergenceMonitor
+        :param convergence_monitor: if not None, the monitor deciding when
+                        each layer has converged; the training of a layer
+                        stops at the latest after pretraining_epochs[i]
+                        epochs; default is None
+
+        :type optimizer: optimizers.Momentum
+        :param optimizer: the rule updating the parameter speeds of the
+                        RBMs, e.g. optimizers.RMSprop() or optimizers.Adam();
+                        None for the momentum
+
+        :type lr_schedule: callable
+        :param lr_schedule: if not None, the learning rate of each epoch is
+                        lr_schedule(pretrain_lr[i], epoch), e.g.
+                        optimizers.ExponentialDecay(0.999); the epochs run
+                        with a single fused call share the learning rate of
+                        the first one; default is None
+
+        :type centering: str
+        :param centering: None for the plain gradient, 'data' or 'enhanced'
+                        to train each RBM as a centered RBM, whose visible
+                        offsets start from the mean of the input of the
+                        layer (see RBM.center_gradients); default is None
+
+        :type monitor_frequency: int
+        :param monitor_frequency: number of epochs between two validation
+                        checks, printing the cost and the free energy gap;
+                        None for half the epochs of the layer, at most 20;
+                        default is None
+
+        :type monitor_samples: int
+        :param monitor_samples: number of training and validation samples
+                        used for the free energy gap and the hidden
+                        activations; None for the size of the validation
+                        set and 1000 samples respectively; default is None
 
         :return:
         '''
 
         print('... getting the pretraining functions')
-        print('Training set sample size %i' % train_set_x.get_value().shape[0])
+        print('Training set sample size %i (each repeated %i times)' %
+              (train_set_x.get_value().shape[0], repeats))
         if validation_set_x is not None:
             print('Validation set sample size %i' % validation_set_x.get_value().shape[0])
 
-        training_fns, free_energy_gap_fns = self.training_functions(train_set_x=train_set_x,
-                                                                       batch_size=batch_size,
-                                                                       k=k,
-                                                                       lambda_1=lambda_1,
-                                                                       lambda_2=lambda_2,
-                                                                       monitor=monitor)
-
         print('... pre-training the model')
         start_time = timeit.default_timer()
         # train layer-wise
 
         if graph_output:
-            plt.ion()
+            writer = SnapshotWriter(graph_dir)
 
         n_data = train_set_x.get_value().shape[0]
 
-        if validation_set_x is not None:
-            t_set = train_set_x.get_value(borrow=True)
-            v_set = validation_set_x.get_value(borrow=True)
-
-        # early-stopping parameters
-
-        patience_increase = 2  # wait this much longer when a new best is
-        # found
-        improvement_threshold = 0.995  # a relative improvement of this much is
-        # considered significant
-
-        # go through this many
-        # minibatches before checking the network
-        # on the validation set; in this case we
-        # check every epoch
+        # input of the layer being trained
+        layer_train_set = train_set_x
+        layer_validation_set = validation_set_x
 
-        idx_minibatches, minibatches = get_minibatches_idx(n_data,
-                                                           batch_size,
-                                                           shuffle=True)
-
-        n_train_batches = idx_minibatches[-1] + 1
+        checkpoint = None
+        if checkpoint_file is not None and os.path.isfile(checkpoint_file):
+            checkpoint = self.load_checkpoint(checkpoint_file)
+            print('... resuming the pretraining of layer %i from epoch %i' %
+                  (checkpoint['layer'], checkpoint['epoch']))
 
         for i in range(self.n_layers):
-            if graph_output:
-                plt.figure(i+1)
+            if i > 0:
+                # The layers below are frozen: their output on the whole
+                # training and validation set is computed once and the RBM
+                # of layer i is trained directly on it
+                layer_train_set = theano.shared(
+                    self.propagate_layer(layer_train_set, i-1), borrow=True)
+                if validation_set_x is not None:
+                    layer_validation_set = theano.shared(
+                        self.propagate_layer(layer_validation_set, i-1), borrow=True)
+
+            if checkpoint is not None:
+                if i < checkpoint['layer']:
+                    # restored from the checkpoint
+                    continue
+                self.restore_training_state(checkpoint)
+
+            if centering is not None and (checkpoint is None or checkpoint['epoch'] == 0):
+                self.rbm_layers[i].init_offsets(layer_train_set.get_value(borrow=True))
+
+            first_stream = len(self.rbm_layers[i].theano_rng.state_updates)
+            training_fn, free_energy_gap_fn, fused_training_fn = \
+                self.layer_training_functions(i,
+                                              train_set_x=layer_train_set,
+                                              batch_size=batch_size,
+                                              k=k,
+                                              lambda_1=lambda_1,
+                                              lambda_2=lambda_2,
+                                              monitor=monitor,
+                                              fused=fused_epochs > 0,
+                                              optimizer=optimizer,
+                                              centering=centering)
+
+            t_set = layer_train_set.get_value(borrow=True)
+            if validation_set_x is not None:
+                v_set = layer_validation_set.get_value(borrow=True)
 
             if isinstance(self.rbm_layers[i], GRBM):
                 momentum = 0.0
@@ -433,82 +748,126 @@ class DBN(object):
                 momentum = 0.6
 
             # go through training epochs
-            best_cost = numpy.inf
             epoch = 0
             done_looping = False
+            if convergence_monitor is not None:
+                convergence_monitor.reset()
 
-            patience = pretraining_epochs[i]  # look as this many examples regardless
-            validation_frequency = min(20 * n_train_batches, patience // 2)
-            print('Validation frequency: %d' % validation_frequency)
+            # the cost and the free energy gap are printed every
+            # validation_frequency epochs
+            if monitor_frequency is None:
+                validation_frequency = max(1, min(20, pretraining_epochs[i] // 2))
+            else:
+                validation_frequency = monitor_frequency
+            print('Validation frequency: %d epochs' % validation_frequency)
+
+            if checkpoint is not None:
+                self.restore_training_state(checkpoint, first_stream)
+                epoch = checkpoint['epoch']
+                if convergence_monitor is not None:
+                    convergence_monitor.set_state(checkpoint['monitor_state'])
+                checkpoint = None
+
+            def free_energy_gap():
+                if validation_set_x is None:
+                    raise ValueError('The free energy gap requires a validation set')
+                if monitor_samples is not None:
+                    input_t_set = t_set[:monitor_samples]
+                    input_v_set = v_set[:monitor_samples]
+                elif i == 0:
+                    input_t_set = t_set
+                    input_v_set = v_set
+                else:
+                    input_t_set = t_set[:v_set.shape[0]]
+                    input_v_set = v_set
+                free_energy_train, free_energy_test = free_energy_gap_fn(input_t_set,
+                                                                         input_v_set)
+                return free_energy_test.mean() - free_energy_train.mean()
+
+            def hidden_activations():
+                # always the same samples, so that the changes are comparable
+                n_samples = 1000 if monitor_samples is None else monitor_samples
+                return self.propagate_layer(layer_train_set.get_value(borrow=True)[:n_samples], i)
 
             while (epoch < pretraining_epochs[i]) and (not done_looping):
-                epoch = epoch + 1
-
-                idx_minibatches, minibatches = get_minibatches_idx(n_data,
-                                                                   batch_size,
-                                                                   shuffle=True)
+                first_epoch = epoch + 1
 
                 # go through the training set
-                if not isinstance(self.rbm_layers[i], GRBM) and epoch == 6:
+                if not isinstance(self.rbm_layers[i], GRBM) and first_epoch >= 6:
                     momentum = 0.9
 
-                for mb, minibatch in enumerate(minibatches):
-                    current_cost = training_fns[i](indexes=minibatch,
-                                                momentum=momentum,
-                                                lr=pretrain_lr[i])
-                    # iteration number
-                    iter = (epoch - 1) * n_train_batches + mb
-
-                    if (iter + 1) % validation_frequency == 0:
-                        print('Pre-training cost (layer %i, epoch %d): ' % (i, epoch), end=' ')
-                        print(current_cost)
-
-                        # Plot the output
-                        if graph_output:
-                            plt.clf()
-                            training_output = self.get_output(train_set_x, i)
-                            plt.imshow(training_output, cmap='gray')
-                            plt.axis('tight')
-                            plt.title('epoch %d' % (epoch))
-                            plt.draw()
-                            plt.pause(1.0)
-
-                        # if we got the best validation score until now
-                        if current_cost < best_cost:
-                            # improve patience if loss improvement is good enough
-                            if (
-                                    current_cost < best_cost *
-                                    improvement_threshold
-                            ):
-                                patience = max(patience, iter * patience_increase)
-
-                            best_cost = current_cost
-                            best_iter = iter
-
-                            if validation_set_x is not None:
-                                # Compute the free energy gap
-                                if i == 0:
-                                    input_t_set = t_set
-                                    input_v_set = v_set
-                                else:
-                                    input_t_set = self.get_output(
-                                                    t_set[range(v_set.shape[0])], i-1)
-                                    input_v_set = self.get_output(v_set, i-1)
-
-                                free_energy_train, free_energy_test = free_energy_gap_fns[i](
-                                                    input_t_set,
-                                                    input_v_set)
-                                free_energy_gap = free_energy_test.mean() - free_energy_train.mean()
-
-                                print('Free energy gap (layer %i, epoch %i): ' % (i, epoch), end=' ')
-                                print(free_energy_gap)
-
-                    if patience <= iter:
-                        done_looping = True
-                        break
-
-            if graph_output:
-                plt.close()
+                if lr_schedule is None:
+                    lr = pretrain_lr[i]
+                else:
+                    lr = lr_schedule(pretrain_lr[i], first_epoch)
+
+                if fused_training_fn is None:
+                    n_epochs = 1
+                    _, minibatches = get_minibatches_idx(n_data,
+                                                         batch_size,
+                                                         shuffle=True,
+                                                         repeats=repeats)
+                    costs = [training_fn(indexes=minibatch,
+                                         momentum=momentum,
+                                         lr=lr)
+                             for minibatch in minibatches]
+                else:
+                    # a single call never straddles the switch of the momentum
+                    # or an evaluation of the convergence monitor
+                    n_epochs = min(fused_epochs, pretraining_epochs[i] - epoch)
+                    if first_epoch < 6:
+                        n_epochs = min(n_epochs, 6 - first_epoch)
+                    if convergence_monitor is not None:
+                        frequency = convergence_monitor.frequency
+                        n_epochs = min(n_epochs, frequency - epoch % frequency)
+
+                    idx_matrix, sizes = get_fused_minibatches_idx(n_data,
+                                                                  batch_size,
+                                                                  n_epochs=n_epochs,
+                                                                  repeats=repeats)
+                    costs = list(fused_training_fn(idx_matrix, sizes, momentum, lr))
+
+                epoch = first_epoch + n_epochs - 1
+                mean_cost = numpy.mean(costs)
+
+                if epoch // validation_frequency > (first_epoch - 1) // validation_frequency:
+                    print('Pre-training cost (layer %i, epoch %d): ' % (i, epoch), end=' ')
+                    print(mean_cost)
+
+                    # Plot the output
+                    if graph_output:
+                        # only the rows that are plotted are propagated
+                        plotted_input = layer_train_set.get_value(borrow=True)
+                        plotted_input = plotted_input[::writer.row_step(plotted_input.shape[0])]
+                        writer.plot('dbn_layer_%d_epoch_%d.png' % (i, epoch),
+                                    [self.propagate_layer(plotted_input, i)],
+                                    title='layer %d, epoch %d' % (i, epoch))
+
+                    if validation_set_x is not None:
+                        print('Free energy gap (layer %i, epoch %i): ' % (i, epoch), end=' ')
+                        print(free_energy_gap())
+
+                if convergence_monitor is not None and convergence_monitor.due(epoch, n_epochs):
+                    metrics = {
+                        'reconstruction_error': lambda: mean_cost,
+                        'free_energy_gap': free_energy_gap,
+                        'hidden_activations': hidden_activations
+                    }
+                    done_looping = convergence_monitor.update(epoch, metrics)
+
+                if checkpoint_file is not None and not done_looping and \
+                        epoch // checkpoint_frequency > (first_epoch - 1) // checkpoint_frequency:
+                    self.save_checkpoint(checkpoint_file, i, epoch,
+                                         convergence_monitor.get_state()
+                                         if convergence_monitor is not None else None,
+                                         first_stream)
+
+            if checkpoint_file is not None:
+                # the next layer starts from scratch
+                self.save_checkpoint(checkpoint_file, i + 1, 0)
+
+        if graph_output:
+            writer.close()
 
         end_time = timeit.default_timer()
 
@@ -524,14 +883,21 @@ class DBN(object):
                                  transform_fn=None,
                                  exponent=1.0,
                                  datadir='data'):
-        train_set, validation_set = load_n_preprocess_data(datafile,
-                                                           holdout=holdout,
-                                                           clip=clip,
-                                                           transform_fn=transform_fn,
-                                                           exponent=exponent,
-                                                           repeats=repeats,
-                                                           shuffle=False,
-                                                           datadir=datadir)
+        if self.sparse_input:
+            train_set, validation_set = load_n_preprocess_sparse_data(datafile,
+                                                                      holdout=holdout,
+                                                                      repeats=repeats,
+                                                                      shuffle=False,
+                                                                      datadir=datadir)
+        else:
+            train_set, validation_set = load_n_preprocess_data(datafile,
+                                                               holdout=holdout,
+                                                               clip=clip,
+                                                               transform_fn=transform_fn,
+                                                               exponent=exponent,
+                                                               repeats=repeats,
+                                                               shuffle=False,
+                                                               datadir=datadir)
 
         return (self.get_output(train_set), self.get_output(validation_set))
 
@@ -558,7 +924,8 @@ class DBN(object):
         '''
         print(" output(s) value(s):", [output[0] for output in fn.outputs])
 
-def train_top(batch_size, graph_output, joint_train_set, joint_val_set, rng):
+def train_top(batch_size, graph_output, joint_train_set, joint_val_set, rng, repeats=1,
+              checkpoint_file=None):
     top_DBN = DBN(numpy_rng=rng, n_ins=joint_train_set.get_value().shape[1],
                   gauss=False,
                   hidden_layers_sizes=[24],
@@ -568,7 +935,9 @@ def train_top(batch_size, graph_output, joint_train_set, joint_val_set, rng):
                      pretraining_epochs=[800, 800],
                      pretrain_lr=[0.1, 0.1],
                      validation_set_x=joint_val_set,
-                     graph_output=graph_output)
+                     graph_output=graph_output,
+                     repeats=repeats,
+                     checkpoint_file=checkpoint_file)
     return top_DBN
 
 
@@ -580,7 +949,14 @@ def train_bottom_layer(train_set, validation_set,
                        lambda_1 = 0.0,
                        lambda_2 = 0.1,
                        rng=None,
-                       graph_output=False
+                       graph_output=False,
+                       gauss=True,
+                       repeats=1,
+                       checkpoint_file=None,
+                       convergence_monitor=None,
+                       optimizer=None,
+                       lr_schedule=None,
+                       centering=None
                     ):
 
     if rng is None:
@@ -589,8 +965,10 @@ def train_bottom_layer(train_set, validation_set,
     print('Visible nodes: %i' % train_set.get_value().shape[1])
     print('Output nodes: %i' % layers_sizes[-1])
     dbn = DBN(numpy_rng=rng, n_ins=train_set.get_value().shape[1],
+                  gauss=gauss,
                   hidden_layers_sizes=layers_sizes[:-1],
-                  n_outs=layers_sizes[-1])
+                  n_outs=layers_sizes[-1],
+                  sparse_input=scipy.sparse.issparse(train_set.get_value(borrow=True)))
 
     dbn.training(train_set,
                  batch_size, k=k,
@@ -599,7 +977,13 @@ def train_bottom_layer(train_set, validation_set,
                  lambda_1=lambda_1,
                  lambda_2=lambda_2,
                  validation_set_x=validation_set,
-                 graph_output=graph_output)
+                 graph_output=graph_output,
+                 repeats=repeats,
+                 checkpoint_file=checkpoint_file,
+                 convergence_monitor=convergence_monitor,
+                 optimizer=optimizer,
+                 lr_schedule=lr_schedule,
+                 centering=centering)
 
     output_train_set = dbn.get_output(train_set)
     if validation_set is not None:
@@ -0,0 +1,227 @@
+"""
+Copyright (c) 2016 Gianluca Gerard
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+from __future__ import print_function, division
+
+import sys
+import json
+import time
+import threading
+import argparse
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    import Queue as queue
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    import queue
+
+import numpy
+
+from numpy_mdbn import load_numpy_mdbn
+
+# Long running classification server: the multimodal DBN is loaded once
+# and the requests arriving at the same time are scored together, with a
+# single matrix product per layer.
+
+
+class MicroBatcher(object):
+    """
+    Collect the requests submitted by concurrent threads and score them in
+    batches. A batch is scored as soon as it holds max_batch_size samples,
+    or max_latency seconds after its first request arrived.
+    """
+    def __init__(self, mdbn, max_batch_size=256, max_latency=0.005):
+        self.mdbn = mdbn
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='MicroBatcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def check_inputs(self, inputs):
+        """
+        Convert the inputs of a request to matrices and check their shapes.
+
+        :return: the inputs as numpy.ndarrays and the number of samples
+        """
+        checked = {}
+        n_samples = None
+        for name in self.mdbn.modalities:
+            if name not in inputs:
+                raise ValueError('Missing modality %s' % name)
+            dbn = self.mdbn.dbns[name]
+            input = numpy.atleast_2d(numpy.asarray(inputs[name], dtype=dbn.W[0].dtype))
+            if input.ndim != 2 or input.shape[1] != dbn.n_ins:
+                raise ValueError('Modality %s expects samples with %d features' %
+                                 (name, dbn.n_ins))
+            if n_samples is None:
+                n_samples = input.shape[0]
+            elif input.shape[0] != n_samples:
+                raise ValueError('All the modalities must have the same number of samples')
+            checked[name] = input
+        return checked, n_samples
+
+    def submit(self, inputs):
+        """
+        Score the samples of a request, waiting for its batch to be done.
+
+        :param inputs: a dictionary mapping each modality to its samples
+        :return: the activations of the top layer and the binarized pattern
+        """
+        inputs, n_samples = self.check_inputs(inputs)
+        request = {
+            'inputs': inputs,
+            'n_samples': n_samples,
+            'done': threading.Event(),
+            'result': None,
+            'error': None
+        }
+        self.requests.put(request)
+        request['done'].wait()
+        if request['error'] is not None:
+            raise request['error']
+        return request['result']
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            n_samples = batch[0]['n_samples']
+            deadline = time.time() + self.max_latency
+            while n_samples < self.max_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                n_samples += request['n_samples']
+            self.score(batch)
+
+    def score(self, batch):
+        try:
+            inputs = dict((name, numpy.concatenate([request['inputs'][name] for request in batch]))
+                          for name in self.mdbn.modalities)
+            output, pattern = self.mdbn.classify(inputs)
+            start = 0
+            for request in batch:
+                end = start + request['n_samples']
+                request['result'] = (output[start:end], pattern[start:end])
+                start = end
+        except Exception as e:
+            for request in batch:
+                request['error'] = e
+        finally:
+            for request in batch:
+                request['done'].set()
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_request_handler(batcher):
+
+    class ClassificationRequestHandler(BaseHTTPRequestHandler):
+        """
+        POST /classify with a JSON object {"inputs": {modality: samples}},
+        where samples is a list of preprocessed samples (or a single one),
+        returns {"activations": [...], "pattern": [...]}.
+        GET /info returns the modalities and their number of features.
+        """
+        def send_json(self, code, content):
+            body = json.dumps(content).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != '/info':
+                self.send_json(404, {'error': 'Unknown path %s' % self.path})
+                return
+            mdbn = batcher.mdbn
+            self.send_json(200, {
+                'modalities': mdbn.modalities,
+                'n_ins': dict((name, mdbn.dbns[name].n_ins) for name in mdbn.modalities),
+                'n_outs': mdbn.top_dbn.stacked_layers_sizes[-1]
+            })
+
+        def do_POST(self):
+            if self.path != '/classify':
+                self.send_json(404, {'error': 'Unknown path %s' % self.path})
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(length).decode('utf-8'))
+                output, pattern = batcher.submit(request['inputs'])
+            except (ValueError, KeyError, TypeError) as e:
+                self.send_json(400, {'error': str(e)})
+                return
+            except Exception as e:
+                self.send_json(500, {'error': str(e)})
+                return
+            self.send_json(200, {'activations': output.tolist(),
+                                 'pattern': pattern.astype(int).tolist()})
+
+        def log_message(self, format, *args):
+            # the default handler logs every request on stderr
+            pass
+
+    return ClassificationRequestHandler
+
+def serve(model_dir, port=8000, max_batch_size=256, max_latency=0.005):
+    """
+    Load the multimodal DBN saved in model_dir and serve it on
+    http://127.0.0.1:<port> until interrupted.
+    """
+    batcher = MicroBatcher(load_numpy_mdbn(model_dir),
+                           max_batch_size=max_batch_size,
+                           max_latency=max_latency)
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_request_handler(batcher))
+    print('Serving %s on http://127.0.0.1:%d' % (model_dir, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Classify patients with a trained MDBN')
+    parser.add_argument('model_dir', help='directory of the model written by save_network')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch-size', type=int, default=256,
+                        help='maximum number of samples scored together')
+    parser.add_argument('--max-latency', type=float, default=0.005,
+                        help='maximum time in seconds a request waits for its batch')
+    args = parser.parse_args()
+    serve(args.model_dir, port=args.port,
+          max_batch_size=args.max_batch_size, max_latency=args.max_latency)
+    sys.exit(0)
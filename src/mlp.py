@@ -33,6 +33,8 @@ from theano import tensor
 from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 #from theano.compile.nanguardmode import NanGuardMode
 
+from utils import dot_maybe_sparse
+
 class HiddenLayer(object):
     def __init__(self, rng, input, n_in, n_out, W=None, b=None,
                  activation=tensor.tanh):
@@ -100,7 +102,7 @@ class HiddenLayer(object):
 
         self.activation = activation
 
-        lin_output = tensor.dot(input, self.W) + self.b
+        lin_output = dot_maybe_sparse(input, self.W) + self.b
         self.output = (
             lin_output if self.activation is None
             else self.activation(lin_output)
@@ -0,0 +1,242 @@
+"""
+Copyright (c) 2016 Gianluca Gerard
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+from __future__ import print_function, division
+
+import os
+import json
+import shutil
+import tempfile
+
+import numpy
+
+# Model format: a directory with one .npy file per array and a
+# manifest.json describing the networks. The arrays are stored raw, so
+# that they can be memory-mapped, and nothing is pickled. The module only
+# depends on numpy, so the models can be read without Theano.
+#
+# The paths of the arrays in the manifest are relative to the model
+# directory. save_model writes the arrays of each version of a model in a
+# subdirectory of its own and then atomically replaces the manifest, which
+# is the only pointer to the current version (see save_model).
+#
+# This format replaces the single .npz file written by save_network in the
+# scripts up to now, which stored the configurations and the parameters as
+# pickled objects. load_model still reads those files (see load_npz_model)
+# when no model directory is found; save_model always writes the new
+# format.
+
+MANIFEST = 'manifest.json'
+FORMAT_VERSION = 1
+
+
+def json_default(value):
+    # numpy scalars and arrays found in the configurations
+    if isinstance(value, numpy.generic):
+        return value.item()
+    if isinstance(value, numpy.ndarray):
+        return value.tolist()
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+def save_model(model_dir, networks, arrays=None, metadata=None):
+    """
+    Save a set of networks in model_dir.
+
+    :param model_dir: the directory of the model; the model it holds, if
+                      any, is replaced
+    :param networks: a dictionary mapping the name of each network to a
+                     tuple (config, dbn_arrays), where config is a JSON
+                     serializable dictionary and dbn_arrays has the keys
+                     number_of_nodes, gauss, sparse_input and the lists of
+                     arrays W, b and vbias, one array per layer
+    :param arrays: a dictionary of further arrays, e.g. the classes
+    :param metadata: a JSON serializable dictionary with the run settings
+    """
+    if arrays is None:
+        arrays = {}
+    if metadata is None:
+        metadata = {}
+
+    # the arrays are written in a new version directory, which is renamed
+    # once it is complete, and the manifest pointing to them atomically
+    # replaces the previous one: a reader always finds a complete model,
+    # either the previous or the new one
+    model_dir = os.path.abspath(model_dir)
+    if not os.path.isdir(model_dir):
+        os.makedirs(model_dir)
+    tmp_dir = tempfile.mkdtemp(dir=model_dir, prefix='version.', suffix='.tmp')
+    version_dir = tmp_dir[:-len('.tmp')]
+
+    def save_array(file_name, array):
+        numpy.save(os.path.join(tmp_dir, file_name), numpy.ascontiguousarray(array))
+        return os.path.basename(version_dir) + '/' + file_name
+
+    manifest = {
+        'format': FORMAT_VERSION,
+        'metadata': metadata,
+        'networks': {},
+        'arrays': {}
+    }
+    for name, (config, dbn_arrays) in networks.items():
+        layers = []
+        for i in range(len(dbn_arrays['W'])):
+            layers.append(dict((param, save_array('%s_%s_%d.npy' % (name, param, i),
+                                                  dbn_arrays[param][i]))
+                               for param in ('W', 'b', 'vbias')))
+        manifest['networks'][name] = {
+            'config': config,
+            'number_of_nodes': list(dbn_arrays['number_of_nodes']),
+            'gauss': bool(dbn_arrays['gauss']),
+            'sparse_input': bool(dbn_arrays['sparse_input']),
+            'layers': layers
+        }
+    for name, array in arrays.items():
+        manifest['arrays'][name] = save_array('%s.npy' % name, array)
+    os.rename(tmp_dir, version_dir)
+
+    manifest_file = os.path.join(model_dir, MANIFEST)
+    previous_files = []
+    if os.path.isfile(manifest_file):
+        with open(manifest_file) as f:
+            previous_files = manifest_files(json.load(f))
+
+    fd, tmp_manifest = tempfile.mkstemp(dir=model_dir, prefix=MANIFEST + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True, default=json_default)
+        os.rename(tmp_manifest, manifest_file)
+    except BaseException:
+        if os.path.exists(tmp_manifest):
+            os.remove(tmp_manifest)
+        raise
+
+    # the previous version is removed once nothing points to it. A reader
+    # that read the previous manifest just before it was replaced and has
+    # not opened the arrays yet fails to load them, and the versions written
+    # by concurrent calls that lost the race for the manifest are left
+    # behind
+    for file_name in previous_files:
+        path = os.path.join(model_dir, file_name)
+        version = os.path.dirname(file_name)
+        if version and version != os.path.basename(version_dir):
+            shutil.rmtree(os.path.join(model_dir, version), ignore_errors=True)
+        elif not version and os.path.isfile(path):
+            # a model written before the version directories
+            os.remove(path)
+
+def manifest_files(manifest):
+    """Return the paths of the arrays listed in a manifest"""
+    files = []
+    for network in manifest['networks'].values():
+        for layer in network['layers']:
+            files += [layer['W'], layer['b'], layer['vbias']]
+    files += list(manifest['arrays'].values())
+    return files
+
+def load_model(model_dir, mmap_mode='r'):
+    """
+    Load a model saved by save_model. By default the arrays are
+    memory-mapped read only, so that only the pages actually used are read.
+    If model_dir does not exist but model_dir.npz does, the model is read
+    from the .npz file of the previous format (see load_npz_model).
+
+    :return: a dictionary mapping the name of each network to a tuple
+             (config, dbn_arrays), a dictionary with the further arrays and
+             the metadata
+    """
+    npz_file = model_dir.rstrip(os.sep) + '.npz'
+    if not os.path.isdir(model_dir) and os.path.isfile(npz_file):
+        return load_npz_model(npz_file)
+
+    with open(os.path.join(model_dir, MANIFEST)) as f:
+        manifest = json.load(f)
+    if manifest.get('format') != FORMAT_VERSION:
+        raise ValueError('Unsupported model format in %s' % model_dir)
+
+    def load_array(file_name):
+        return numpy.load(os.path.join(model_dir, file_name), mmap_mode=mmap_mode)
+
+    networks = {}
+    for name, network in manifest['networks'].items():
+        layers = network['layers']
+        dbn_arrays = {
+            'number_of_nodes': network['number_of_nodes'],
+            'gauss': network['gauss'],
+            'sparse_input': network['sparse_input'],
+            'W': [load_array(layer['W']) for layer in layers],
+            'b': [load_array(layer['b']) for layer in layers],
+            'vbias': [load_array(layer['vbias']) for layer in layers]
+        }
+        networks[name] = (network['config'], dbn_arrays)
+
+    arrays = dict((name, load_array(file_name))
+                  for name, file_name in manifest['arrays'].items())
+
+    return networks, arrays, manifest['metadata']
+
+def load_npz_model(npz_file, bernoulli_networks=('top',)):
+    """
+    Load a model from the .npz file written by the previous save_network:
+    for each network a <name>_config dictionary and a <name>_params list
+    with a {name: array} dictionary for each parameter, W and b of each
+    layer in turn, together with holdout, repeats and classes. The visible
+    biases were not saved and are set to zero, as in the DBNs rebuilt from
+    those files.
+
+    :param npz_file: the path of the .npz file
+    :param bernoulli_networks: the networks whose input units are binary;
+                               the input of the others is Gaussian, unless
+                               their config has sparse_input set
+    :return: the same as load_model
+    """
+    # the configurations and the parameters are pickled objects
+    with numpy.load(npz_file, allow_pickle=True, encoding='latin1') as npz:
+        contents = dict((key, npz[key]) for key in npz.files)
+
+    networks = {}
+    for key in contents:
+        if not key.endswith('_config'):
+            continue
+        name = key[:-len('_config')]
+        config = contents[key].tolist()
+        params = list(contents[name + '_params'])
+        W = [numpy.asarray(param['W']) for param in params[0::2]]
+        b = [numpy.asarray(param['b']) for param in params[1::2]]
+        sparse_input = bool(config.get('sparse_input', False))
+        dbn_arrays = {
+            'number_of_nodes': list(config['number_of_nodes']),
+            'gauss': name not in bernoulli_networks and not sparse_input,
+            'sparse_input': sparse_input,
+            'W': W,
+            'b': b,
+            'vbias': [numpy.zeros(w.shape[0], dtype=w.dtype) for w in W]
+        }
+        networks[name] = (config, dbn_arrays)
+
+    arrays = {}
+    if 'classes' in contents:
+        arrays['classes'] = contents['classes']
+    metadata = dict((name, contents[name].item())
+                    for name in ('holdout', 'repeats') if name in contents)
+
+    return networks, arrays, metadata
@@ -0,0 +1,126 @@
+"""
+Copyright (c) 2016 Gianluca Gerard
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+from __future__ import print_function, division
+
+import numpy
+from scipy.special import expit
+
+from model_io import load_model
+
+# Inference only version of the multimodal DBN: the sigmoid layers of the
+# trained networks are evaluated with numpy, without importing Theano and
+# without compiling any function.
+
+
+class NumpyDBN(object):
+    """
+    The MLP of a trained DBN, computing the same output as DBN.get_output.
+    """
+    def __init__(self, dbn_arrays):
+        """
+        :param dbn_arrays: the arrays of the network, as returned by
+                           MDBN.dbn_to_arrays or model_io.load_model
+        """
+        self.W = dbn_arrays['W']
+        self.b = dbn_arrays['b']
+        self.stacked_layers_sizes = list(dbn_arrays['number_of_nodes'][1:])
+        self.n_ins = dbn_arrays['number_of_nodes'][0]
+        self.n_layers = len(self.W)
+        self.sparse_input = dbn_arrays['sparse_input']
+
+    def number_of_nodes(self):
+        return [self.n_ins] + self.stacked_layers_sizes
+
+    def get_output(self, input, layer=-1):
+        """
+        Return the output of the layer of index layer.
+
+        :param input: a matrix with one sample per row (a scipy.sparse matrix
+                      for a network with sparse input) or a single sample
+        :param layer: the index of the layer; by default the last one
+        :return: a numpy.ndarray with one row per sample
+        """
+        layer = layer % self.n_layers
+        if not hasattr(input, 'tocsr'):
+            input = numpy.atleast_2d(numpy.asarray(input, dtype=self.W[0].dtype))
+        output = input
+        for W, b in zip(self.W[:layer + 1], self.b[:layer + 1]):
+            # a sparse input times a dense matrix is a dense matrix
+            output = expit(numpy.asarray(output.dot(W)) + b)
+        return output
+
+
+class NumpyMDBN(object):
+    """
+    A trained multimodal DBN: a DBN per modality whose outputs are
+    concatenated and given as input to the top DBN.
+    """
+    def __init__(self, networks, modalities, top='top'):
+        """
+        :param networks: a dictionary mapping the name of each network to
+                         its arrays (see NumpyDBN)
+        :param modalities: the names of the modalities, in the order in
+                         which their outputs are concatenated
+        :param top: the name of the top network
+        """
+        self.modalities = list(modalities)
+        self.dbns = dict((name, NumpyDBN(networks[name])) for name in self.modalities)
+        self.top_dbn = NumpyDBN(networks[top])
+
+    def joint_input(self, inputs):
+        """
+        :param inputs: a dictionary mapping each modality to its (already
+                       preprocessed) samples, one per row, in the same order
+                       for all the modalities
+        :return: the input of the top DBN
+        """
+        return numpy.concatenate([self.dbns[name].get_output(inputs[name])
+                                  for name in self.modalities], axis=1)
+
+    def get_output(self, inputs):
+        """Return the activations of the top layer, one row per sample"""
+        return self.top_dbn.get_output(self.joint_input(inputs))
+
+    def classify(self, inputs):
+        """
+        Return the activations of the top layer and the binarized pattern
+        used by utils.find_unique_classes to identify the classes.
+        """
+        output = self.get_output(inputs)
+        return output, (output > 0.5) * numpy.ones_like(output)
+
+def load_numpy_mdbn(model_dir, mmap_mode='r'):
+    """
+    Load a multimodal DBN saved by save_network for inference.
+
+    :param model_dir: the directory written by model_io.save_model
+    :param mmap_mode: passed to numpy.load; by default the weights are
+                      memory-mapped read only
+    :return: a NumpyMDBN
+    """
+    networks, _, metadata = load_model(model_dir, mmap_mode=mmap_mode)
+    if 'modalities' not in metadata:
+        raise ValueError('The model in %s does not list the order of its modalities' % model_dir)
+    return NumpyMDBN(dict((name, dbn_arrays) for name, (_, dbn_arrays) in networks.items()),
+                     metadata['modalities'])
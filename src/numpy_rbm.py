@@ -0,0 +1,440 @@
+"""
+Copyright (c) 2016 Gianluca Gerard
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+from __future__ import print_function, division
+
+import numpy
+import scipy.sparse
+from scipy.special import expit
+
+
+def softplus(x):
+    return numpy.logaddexp(0, x)
+
+
+def dense_value(data_set):
+    """The array of the shared variable data_set, which must be dense"""
+    data = data_set.get_value(borrow=True)
+    if scipy.sparse.issparse(data):
+        raise ValueError('The numpy backend does not support sparse input')
+    return data
+
+
+class NumpyRBMTrainer(object):
+    """CD-k/PCD-k training of an RBM or GRBM with plain numpy BLAS calls.
+
+    The trainer implements the same update rule of RBM.get_cost_updates and
+    RBM.compute_rbm_grad (momentum, lambda_1/lambda_2 multipliers and L1
+    weight-cost on the current weights) but it does not build nor compile
+    any Theano graph. All the intermediate results are stored in buffers
+    allocated once at construction time.
+
+    The parameters are updated in place on the arrays returned by
+    get_value(borrow=True), therefore the RBM shared variables always
+    reflect the current state of the training.
+    """
+    def __init__(self, rbm,
+                 batch_size,
+                 k=1,
+                 lambda_1=0.0,
+                 lambda_2=0.0,
+                 weightcost=0.0,
+                 persistent=False,
+                 n_chains=None,
+                 chain_block=None,
+                 gaussian=False,
+                 error_free=True,
+                 numpy_rng=None):
+        """
+        :param rbm: the RBM (or GRBM) whose parameters are trained
+
+        :param batch_size: size of the batch of samples used for training
+
+        :param k: number of Gibbs steps to do in CD-k/PCD-k
+
+        :param lambda_1: parameter for tuning weigths updates in CD-k/PCD-k
+
+        :param lambda_2: parameter for tuning weigths updates in CD-k/PCD-k
+
+        :param weightcost: L1 weight-decay (see Hinton 2010
+            "A Practical Guide to Training Restricted Boltzmann
+            Machines" section 10)
+
+        :param persistent: True for PCD-k, False for CD-k
+
+        :param n_chains: number of persistent chains used by PCD-k; by
+            default batch_size
+
+        :param chain_block: number of persistent chains advanced at each
+            update; by default all of them (see RBM.get_cost_updates)
+
+        :param gaussian: True if the visible units are Gaussian (GRBM)
+
+        :param error_free: for Gaussian visible units, True if the mean field
+            is used in place of a sample of the visible units
+
+        :param numpy_rng: numpy random number generator used for sampling
+        """
+        if numpy_rng is None:
+            numpy_rng = numpy.random.RandomState(1234)
+
+        self.rbm = rbm
+        self.batch_size = batch_size
+        self.k = k
+        self.lambda_1 = lambda_1
+        self.lambda_2 = lambda_2
+        self.weightcost = weightcost
+        self.gaussian = gaussian
+        self.error_free = error_free
+        self.numpy_rng = numpy_rng
+
+        self.W = rbm.W.get_value(borrow=True)
+        self.hbias = rbm.hbias.get_value(borrow=True)
+        self.vbias = rbm.vbias.get_value(borrow=True)
+        self.W_speed = rbm.W_speed.get_value(borrow=True)
+        self.hbias_speed = rbm.hbias_speed.get_value(borrow=True)
+        self.vbias_speed = rbm.vbias_speed.get_value(borrow=True)
+
+        n_visible, n_hidden = self.W.shape
+        dtype = self.W.dtype
+        self.dtype = dtype
+
+        if persistent:
+            if n_chains is None:
+                n_chains = batch_size
+            if chain_block is None:
+                chain_block = n_chains
+            assert n_chains % chain_block == 0
+            self.persistent_chain = numpy.zeros((n_chains, n_hidden), dtype=dtype)
+            n_negative = chain_block
+        else:
+            self.persistent_chain = None
+            n_negative = batch_size
+        self.chain_block = chain_block
+        self.bit_i_idx = 0
+
+        if persistent and chain_block < n_chains:
+            # mean-field of each chain at its last update
+            self.chain_index = 0
+            self.chains_filled = 0
+            self.chains_v_mean = numpy.zeros((n_chains, n_visible), dtype=dtype)
+            self.chains_h_mean = numpy.zeros((n_chains, n_hidden), dtype=dtype)
+
+        # buffers for the positive and negative phase
+        self.ph_mean = numpy.empty((batch_size, n_hidden), dtype=dtype)
+        self.h_sample = numpy.empty((n_negative, n_hidden), dtype=dtype)
+        self.nh_mean = numpy.empty((n_negative, n_hidden), dtype=dtype)
+        self.pre_sigmoid_nv = numpy.empty((n_negative, n_visible), dtype=dtype)
+        self.nv_mean = numpy.empty((n_negative, n_visible), dtype=dtype)
+        self.nv_sample = numpy.empty((n_negative, n_visible), dtype=dtype)
+
+        # buffers for the gradients and the updates
+        self.W_grad = numpy.empty((n_visible, n_hidden), dtype=dtype)
+        self.W_tmp = numpy.empty((n_visible, n_hidden), dtype=dtype)
+        self.W_denom = numpy.empty((n_visible, n_hidden), dtype=dtype)
+        self.hbias_grad = numpy.empty(n_hidden, dtype=dtype)
+        self.vbias_grad = numpy.empty(n_visible, dtype=dtype)
+
+    def sample(self, mean, out):
+        """Draw a Bernoulli sample with probabilities mean into out"""
+        numpy.less(self.numpy_rng.random_sample(mean.shape), mean, out=out)
+        return out
+
+    def propup(self, vis, out):
+        numpy.dot(vis, self.W, out=out)
+        out += self.hbias
+        return expit(out, out=out)
+
+    def propdown(self, hid, pre_out, out):
+        numpy.dot(hid, self.W.T, out=pre_out)
+        pre_out += self.vbias
+        if self.gaussian:
+            out[...] = pre_out
+            return out
+        return expit(pre_out, out=out)
+
+    def free_energy(self, v_sample):
+        wx_b = numpy.dot(v_sample, self.W) + self.hbias
+        hidden_term = softplus(wx_b).sum(axis=1)
+        if self.gaussian:
+            vbias_term = 0.5 * numpy.square(v_sample - self.vbias).sum(axis=1)
+            return -hidden_term + vbias_term
+        vbias_term = numpy.dot(v_sample, self.vbias)
+        return -hidden_term - vbias_term
+
+    def free_energy_gap(self, train, test):
+        """Computes the free energy gap F(x_test) - F(x_train)"""
+        return numpy.mean(self.free_energy(test)) - numpy.mean(self.free_energy(train))
+
+    def sample_h_given_v(self, v_sample):
+        '''Returns [pre_sigmoid_h, h_mean, h_sample] as RBM.sample_h_given_v'''
+        pre_sigmoid_h = numpy.dot(v_sample, self.W) + self.hbias
+        h_mean = expit(pre_sigmoid_h)
+        h_sample = self.sample(h_mean, numpy.empty_like(h_mean))
+        return [pre_sigmoid_h, h_mean, h_sample]
+
+    def gibbs_hvh(self, n):
+        '''One step of Gibbs sampling starting from the hidden state stored
+        in self.h_sample[:n]'''
+        h_sample = self.h_sample[:n]
+        pre_sigmoid_nv = self.pre_sigmoid_nv[:n]
+        nv_mean = self.nv_mean[:n]
+        nv_sample = self.nv_sample[:n]
+        nh_mean = self.nh_mean[:n]
+
+        self.propdown(h_sample, pre_sigmoid_nv, nv_mean)
+        if self.gaussian:
+            if self.error_free:
+                nv_sample[...] = nv_mean
+            else:
+                numpy.add(nv_mean,
+                          self.numpy_rng.standard_normal(nv_mean.shape),
+                          out=nv_sample, casting='unsafe')
+            # For Gaussian Bernoulli we use a mean field approximation
+            # of the intermediate visible state
+            self.propup(nv_mean, nh_mean)
+        else:
+            self.sample(nv_mean, nv_sample)
+            self.propup(nv_sample, nh_mean)
+        self.sample(nh_mean, h_sample)
+
+    def train_batch(self, x, lr, momentum):
+        """
+        Performs one step of CD-k/PCD-k on the minibatch x.
+
+        :param x: numpy.ndarray with the minibatch, one sample per row
+
+        :param lr: learning rate
+
+        :param momentum: momentum used to update the parameter speeds
+
+        :return: the monitoring cost, the pseudo-likelihood for PCD and the
+                 reconstruction cost for CD
+        """
+        n = x.shape[0]
+        ph_mean = self.ph_mean[:n]
+
+        # positive phase
+        self.propup(x, ph_mean)
+        if self.persistent_chain is None:
+            n_negative = n
+            self.sample(ph_mean, self.h_sample[:n])
+        else:
+            n_negative = self.chain_block
+            start = self.chain_start()
+            self.h_sample[...] = self.persistent_chain[start:start + n_negative]
+
+        # negative phase
+        for _ in range(self.k):
+            self.gibbs_hvh(n_negative)
+
+        nv_mean = self.nv_mean[:n_negative]
+        nh_mean = self.nh_mean[:n_negative]
+
+        W_grad = self.W_grad
+        numpy.dot(x.T, ph_mean, out=W_grad)
+        if self.persistent_chain is None:
+            # gradients as in RBM.compute_rbm_grad
+            W_grad -= numpy.dot(nv_mean.T, nh_mean, out=self.W_tmp)
+            W_grad /= self.batch_size
+            numpy.mean(ph_mean - nh_mean, axis=0, out=self.hbias_grad)
+            numpy.mean(x - nv_mean, axis=0, out=self.vbias_grad)
+        else:
+            # gradients as in RBM.compute_pcd_grad
+            W_stat, h_stat, v_stat = self.negative_stats(nv_mean, nh_mean)
+            W_grad /= n
+            W_grad -= W_stat
+            numpy.subtract(ph_mean.mean(axis=0), h_stat, out=self.hbias_grad)
+            numpy.subtract(x.mean(axis=0), v_stat, out=self.vbias_grad)
+        if self.weightcost != 0.0:
+            numpy.multiply(self.W, self.weightcost, out=self.W_tmp)
+            W_grad -= self.W_tmp
+
+        # W_denom = 1 + 2 * lr * lambda_1 / (|W| + epsilon)
+        epsilon = 0.001
+        W_denom = self.W_denom
+        if self.lambda_1 != 0.0:
+            numpy.abs(self.W, out=W_denom)
+            W_denom += epsilon
+            numpy.divide(2 * lr * self.lambda_1, W_denom, out=W_denom)
+            W_denom += 1
+            W_grad /= W_denom
+        else:
+            W_denom.fill(1)
+
+        # Theano updates are simultaneous, hence the parameters are
+        # updated with the speeds of the previous step
+        numpy.divide(1 - 2 * lr * self.lambda_2, W_denom, out=self.W_tmp)
+        self.W *= self.W_tmp
+        self.W += lr * self.W_speed
+        self.hbias += lr * self.hbias_speed
+        self.vbias += lr * self.vbias_speed
+
+        for grad, speed in [(W_grad, self.W_speed),
+                            (self.hbias_grad, self.hbias_speed),
+                            (self.vbias_grad, self.vbias_speed)]:
+            # speed = grad + (speed - grad) * momentum
+            speed -= grad
+            speed *= momentum
+            speed += grad
+
+        if self.persistent_chain is not None:
+            self.persistent_chain[start:start + n_negative] = self.h_sample
+            if self.chain_block < self.persistent_chain.shape[0]:
+                self.chain_index = (start + n_negative) % self.persistent_chain.shape[0]
+            return self.get_pseudo_likelihood_cost(x)
+        else:
+            return self.get_reconstruction_cost(x, self.pre_sigmoid_nv[:n])
+
+    def chain_start(self):
+        """Index of the first persistent chain advanced by the next update"""
+        if self.chain_block < self.persistent_chain.shape[0]:
+            return self.chain_index
+        return 0
+
+    def negative_stats(self, nv_mean, nh_mean):
+        """
+        Negative statistics averaged over the pool of persistent chains, as
+        in RBM.get_cost_updates and RBM.chain_blocks_stats.
+        """
+        n_chains = self.persistent_chain.shape[0]
+        if self.chain_block == n_chains:
+            return (numpy.dot(nv_mean.T, nh_mean, out=self.W_tmp) / n_chains,
+                    nh_mean.mean(axis=0),
+                    nv_mean.mean(axis=0))
+
+        start = self.chain_index
+        stop = start + self.chain_block
+        self.chains_v_mean[start:stop] = nv_mean
+        self.chains_h_mean[start:stop] = nh_mean
+        self.chains_filled = min(self.chains_filled + self.chain_block, n_chains)
+
+        numpy.dot(self.chains_v_mean.T, self.chains_h_mean, out=self.W_tmp)
+        self.W_tmp /= self.chains_filled
+        return (self.W_tmp,
+                self.chains_h_mean.sum(axis=0) / self.chains_filled,
+                self.chains_v_mean.sum(axis=0) / self.chains_filled)
+
+    def get_pseudo_likelihood_cost(self, x):
+        """Stochastic approximation to the pseudo-likelihood"""
+        n_visible = self.W.shape[0]
+        xi = numpy.round(x)
+        fe_xi = self.free_energy(xi)
+        xi[:, self.bit_i_idx] = 1 - xi[:, self.bit_i_idx]
+        fe_xi_flip = self.free_energy(xi)
+        self.bit_i_idx = (self.bit_i_idx + 1) % n_visible
+        return -numpy.mean(n_visible * softplus(fe_xi - fe_xi_flip))
+
+    def get_reconstruction_cost(self, x, pre_sigmoid_nv):
+        """Same reconstruction cost of RBM.get_reconstruction_cost and
+        GRBM.get_reconstruction_cost"""
+        if self.gaussian:
+            return numpy.mean(numpy.square(expit(pre_sigmoid_nv) - x))
+        # cross-entropy written in terms of softplus for numerical stability
+        cross_entropy = x * softplus(-pre_sigmoid_nv) + (1 - x) * softplus(pre_sigmoid_nv)
+        return cross_entropy.sum(axis=1).mean()
+
+    def train_function(self, train_set_x, lr):
+        """
+        Returns a function with the same signature of the train_rbm
+        function compiled in RBM.learn_model.
+
+        :param train_set_x: shared variable with the training set
+
+        :param lr: learning rate
+        """
+        data = dense_value(train_set_x)
+
+        def train_rbm(indexes, momentum):
+            return self.train_batch(data[indexes], lr, momentum)
+
+        return train_rbm
+
+    def monitoring_function(self, train_set_x, validation_set_x, n_samples=None):
+        """
+        Returns a function with the same signature and outputs of the
+        monitor_rbm function compiled by RBM.monitoring_function.
+        """
+        validation_data = dense_value(validation_set_x)
+        if n_samples is None or n_samples > validation_data.shape[0]:
+            n_samples = validation_data.shape[0]
+        train_sample = dense_value(train_set_x)[:n_samples]
+        validation_sample = validation_data[:n_samples]
+
+        def monitor_rbm():
+            h_validation = expit(numpy.dot(validation_sample, self.W) + self.hbias)
+            h_train = expit(numpy.dot(train_sample, self.W) + self.hbias)
+            pre_sigmoid_nv = numpy.dot(h_validation, self.W.T) + self.vbias
+            reconstruction_error = self.get_reconstruction_cost(validation_sample,
+                                                                pre_sigmoid_nv)
+            feg = self.free_energy_gap(train_sample, validation_sample)
+            return [reconstruction_error, feg, h_validation, h_train]
+
+        return monitor_rbm
+
+    def fused_function(self, train_set_x, lr):
+        """
+        Returns a function with the same signature of the fused_train_rbm
+        function compiled by RBM.fused_training_function: it takes a matrix
+        of indexes, one minibatch per row, the sizes of the minibatches and
+        the momentum and it returns the costs of all the minibatches as an
+        array.
+        """
+        data = dense_value(train_set_x)
+
+        def fused_train_rbm(idx_matrix, sizes, momentum):
+            costs = numpy.empty(idx_matrix.shape[0], dtype=self.dtype)
+            for b, indexes in enumerate(idx_matrix):
+                costs[b] = self.train_batch(data[indexes[:sizes[b]]], lr, momentum)
+            return costs
+
+        return fused_train_rbm
+
+    def pseudo_likelihood(self, x, bits):
+        """Same pseudo-likelihood of RBM.get_pseudo_likelihood"""
+        n_visible = self.W.shape[0]
+        xi = numpy.round(x)
+
+        wx_b = numpy.dot(xi, self.W) + self.hbias
+        vbias_term = numpy.dot(xi, self.vbias)
+        fe_xi = -softplus(wx_b).sum(axis=1) - vbias_term
+
+        delta = 1 - 2 * xi[:, bits]
+        wx_b_flip = wx_b[:, None, :] + delta[:, :, None] * self.W[bits][None, :, :]
+        fe_xi_flip = -softplus(wx_b_flip).sum(axis=2) - \
+                     vbias_term[:, None] - delta * self.vbias[bits]
+
+        return -n_visible * numpy.mean(softplus(fe_xi[:, None] - fe_xi_flip))
+
+    def pseudo_likelihood_function(self, data_set):
+        """
+        Returns a function with the same signature of the pl_rbm function
+        compiled by RBM.pseudo_likelihood_function.
+        """
+        if self.gaussian:
+            raise ValueError('The pseudo-likelihood is not supported by the GRBM')
+        data = dense_value(data_set)
+
+        def pl_rbm(indexes, bits):
+            return self.pseudo_likelihood(data[indexes], bits)
+
+        return pl_rbm
@@ -0,0 +1,186 @@
+"""
+Copyright (c) 2016 Gianluca Gerard
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+from __future__ import print_function, division
+
+import numpy
+import theano
+from theano import tensor
+
+# Update rules of the parameter speeds of an RBM (see
+# RBM.get_cost_updates). At each minibatch the parameters move by the
+# speeds of the previous minibatch:
+#
+#   param = param * multiplier + param_speed * lr
+#
+# and the optimizer computes the new speed from the gradient of the
+# log-likelihood. Optimizers that keep additional per-parameter state
+# register it in rbm.optimizer_state, so that it is saved in the
+# checkpoints.
+
+
+class Momentum(object):
+    """
+    The classical momentum:
+
+        speed = gradient + (speed - gradient) * momentum
+    """
+    def options(self):
+        return {}
+
+    def __repr__(self):
+        # stable across runs, it is part of the keys of the stage cache
+        return '%s(%s)' % (type(self).__name__,
+                           ', '.join('%s=%r' % item for item in sorted(self.options().items())))
+
+    def state_variable(self, rbm, param_speed, name, shape=None):
+        """
+        A new shared variable, initialised to zero, of the shape of
+        param_speed or of the given shape
+        """
+        if shape is None:
+            shape = param_speed.get_value(borrow=True).shape
+        state = theano.shared(numpy.zeros(shape, dtype=theano.config.floatX),
+                              name='%s_%s' % (param_speed.name, name),
+                              borrow=True)
+        rbm.optimizer_state.append(state)
+        return state
+
+    def speed_update(self, rbm, gradient, param_speed, momentum, updates):
+        """
+        Return the new value of param_speed.
+
+        :param rbm: the RBM being trained
+        :param gradient: the gradient of the parameter
+        :param param_speed: the shared variable with the speed of the parameter
+        :param momentum: the symbolic momentum
+        :param updates: the updates of the training function, to which the
+                        optimizer adds the updates of its own state
+        """
+        return gradient + (param_speed - gradient) * momentum
+
+
+class RMSprop(Momentum):
+    """
+    Momentum on the gradient divided by a running average of its
+    magnitude, so that each weight moves at a similar pace:
+
+        mean_square = decay * mean_square + (1 - decay) * gradient ** 2
+        step = gradient / (sqrt(mean_square) + epsilon)
+        speed = step + (speed - step) * momentum
+
+    The learning rate is then the typical change of a weight at each
+    minibatch, e.g. 0.001.
+    """
+    def __init__(self, decay=0.9, epsilon=1e-6):
+        self.decay = decay
+        self.epsilon = epsilon
+
+    def options(self):
+        return {'decay': self.decay, 'epsilon': self.epsilon}
+
+    def speed_update(self, rbm, gradient, param_speed, momentum, updates):
+        floatX = theano.config.floatX
+        mean_square = self.state_variable(rbm, param_speed, 'mean_square')
+        new_mean_square = tensor.cast(self.decay, floatX) * mean_square + \
+                          tensor.cast(1 - self.decay, floatX) * tensor.sqr(gradient)
+        updates[mean_square] = new_mean_square
+        step = gradient / (tensor.sqrt(new_mean_square) + tensor.cast(self.epsilon, floatX))
+        return step + (param_speed - step) * momentum
+
+
+class Adam(Momentum):
+    """
+    Adam (Kingma and Ba, 2015): the speed is the bias corrected running
+    average of the gradient divided by the one of its magnitude. The
+    momentum passed to the training function is ignored, beta1 takes its
+    place.
+    """
+    def __init__(self, beta1=0.9, beta2=0.999, epsilon=1e-8):
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.epsilon = epsilon
+
+    def options(self):
+        return {'beta1': self.beta1, 'beta2': self.beta2, 'epsilon': self.epsilon}
+
+    def speed_update(self, rbm, gradient, param_speed, momentum, updates):
+        floatX = theano.config.floatX
+        first_moment = self.state_variable(rbm, param_speed, 'first_moment')
+        second_moment = self.state_variable(rbm, param_speed, 'second_moment')
+        n_steps = self.state_variable(rbm, param_speed, 'n_steps', shape=())
+
+        new_first_moment = tensor.cast(self.beta1, floatX) * first_moment + \
+                           tensor.cast(1 - self.beta1, floatX) * gradient
+        new_second_moment = tensor.cast(self.beta2, floatX) * second_moment + \
+                            tensor.cast(1 - self.beta2, floatX) * tensor.sqr(gradient)
+        new_n_steps = n_steps + 1
+        updates[first_moment] = new_first_moment
+        updates[second_moment] = new_second_moment
+        updates[n_steps] = new_n_steps
+
+        first_correction = 1 - tensor.cast(self.beta1, floatX) ** new_n_steps
+        second_correction = 1 - tensor.cast(self.beta2, floatX) ** new_n_steps
+        return (new_first_moment / first_correction) / \
+               (tensor.sqrt(new_second_moment / second_correction) +
+                tensor.cast(self.epsilon, floatX))
+
+
+# Learning rate schedules: called with the initial learning rate and the
+# epoch (from 1), they return the learning rate of the epoch.
+
+class ExponentialDecay(object):
+    """lr * rate ** (epoch - 1)"""
+    def __init__(self, rate=0.999):
+        self.rate = rate
+
+    def __call__(self, lr, epoch):
+        return lr * self.rate ** (epoch - 1)
+
+    def __repr__(self):
+        return 'ExponentialDecay(rate=%r)' % self.rate
+
+
+class InverseTimeDecay(object):
+    """lr / (1 + decay * (epoch - 1))"""
+    def __init__(self, decay=0.01):
+        self.decay = decay
+
+    def __call__(self, lr, epoch):
+        return lr / (1 + self.decay * (epoch - 1))
+
+    def __repr__(self):
+        return 'InverseTimeDecay(decay=%r)' % self.decay
+
+
+class StepDecay(object):
+    """lr multiplied by factor every step epochs"""
+    def __init__(self, factor=0.5, step=1000):
+        self.factor = factor
+        self.step = step
+
+    def __call__(self, lr, epoch):
+        return lr * self.factor ** ((epoch - 1) // self.step)
+
+    def __repr__(self):
+        return 'StepDecay(factor=%r, step=%r)' % (self.factor, self.step)
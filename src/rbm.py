@@ -28,7 +28,7 @@ from __future__ import print_function, division
 
 import timeit
 import os
-import matplotlib.pyplot as plt
+from collections import OrderedDict
 
 import numpy
 import theano
@@ -41,7 +41,19 @@ from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 
 import scipy.misc
 from MNIST import MNIST
+from snapshot_writer import SnapshotWriter
 from utils import get_minibatches_idx
+from utils import get_fused_minibatches_idx
+from utils import dot_maybe_sparse
+from utils import rows_maybe_sparse
+from utils import as_dense
+from utils import mean_of_rows
+from numpy_rbm import NumpyRBMTrainer
+from optimizers import Momentum
+
+# Largest number of visible units flipped by default by the
+# pseudo-likelihood monitor (see RBM.pseudo_likelihood_bits)
+PL_MAX_BITS = 100
 
 class RBM(object):
     """Restricted Boltzmann Machine (RBM)  """
@@ -139,6 +151,7 @@ class RBM(object):
         self.Wt = W.T
         self.hbias = hbias
         self.vbias = vbias
+        self.numpy_rng = numpy_rng
         self.theano_rng = theano_rng
         # **** WARNING: It is not a good idea to put things in this list
         # other than shared variables created in this function.
@@ -163,10 +176,26 @@ class RBM(object):
 
         self.params_speed = [self.W_speed, self.hbias_speed, self.vbias_speed]
 
+        # storage of the persistent chains, allocated by training when PCD
+        # is used
+        self.persistent_chain = None
+
+        # additional state of the optimizer, allocated by get_cost_updates
+        self.optimizer_state = []
+
+        # offsets of the visible and hidden units used by the centered
+        # gradient (see RBM.center_gradients)
+        self.offsets = [
+            theano.shared(numpy.zeros(n_visible, dtype=theano.config.floatX),
+                          name='visible_offset', borrow=True),
+            theano.shared(numpy.full(n_hidden, 0.5, dtype=theano.config.floatX),
+                          name='hidden_offset', borrow=True)
+        ]
+
     def free_energy(self, v_sample):
         ''' Function to compute the free energy '''
-        wx_b = tensor.dot(v_sample, self.W) + self.hbias
-        vbias_term = tensor.dot(v_sample, self.vbias)
+        wx_b = dot_maybe_sparse(v_sample, self.W) + self.hbias
+        vbias_term = dot_maybe_sparse(v_sample, self.vbias)
         hidden_term = tensor.sum(nnet.softplus(wx_b), axis=1)
         return -hidden_term - vbias_term
 
@@ -195,7 +224,7 @@ class RBM(object):
         reconstruction cost function)
 
         '''
-        pre_sigmoid_activation = tensor.dot(vis, self.W) + self.hbias
+        pre_sigmoid_activation = dot_maybe_sparse(vis, self.W) + self.hbias
         return [pre_sigmoid_activation, nnet.sigmoid(pre_sigmoid_activation)]
 
     def sample_h_given_v(self, v0_sample):
@@ -263,7 +292,11 @@ class RBM(object):
                          weightcost = 0.0,
                          batch_size=None,
                          persistent=None,
-                         symbolic_grad=False
+                         chain_block=None,
+                         symbolic_grad=False,
+                         optimizer=None,
+                         centering=None,
+                         offset_rate=0.01
                          ):
         """This functions implements one step of CD-k or PCD-k
 
@@ -288,8 +321,27 @@ class RBM(object):
         :param batch_size: size of the batch of samples used for training
 
         :param persistent: None for CD. For PCD, shared variable
-            containing archived state of Gibbs chain. This must be a shared
-            variable of size (batch size, number of hidden units).
+            containing archived state of the pool of Gibbs chains. This must
+            be a shared variable of size (number of chains, number of hidden
+            units); the number of chains is independent of the batch size
+            and the negative statistics are averaged over the whole pool.
+
+        :param chain_block: None to advance all the persistent chains at
+            each update. Otherwise the number of chains advanced at each
+            update, cycling through the pool in blocks; the number of chains
+            must be a multiple of chain_block. The negative statistics of the
+            chains not advanced are those of their last update.
+
+        :param optimizer: the rule updating the parameter speeds, an
+            object of the optimizers module; None for optimizers.Momentum
+
+        :param centering: None for the plain gradient, 'data' for the
+            gradient of the centered RBM (see RBM.center_gradients) with
+            offsets tracking the mean of the data, 'enhanced' for offsets
+            tracking the average of the data and model means (enhanced
+            gradient)
+
+        :param offset_rate: the rate of the running average of the offsets
 
         :return: Returns a proxy for the cost and the updates dictionary. The
         dictionary contains the update rules for weights and biases but
@@ -307,8 +359,11 @@ class RBM(object):
         # for PCD, we initialize from the archived state of the chain
         if persistent is None:
             chain_start = ph_sample
-        else:
+        elif chain_block is None:
             chain_start = persistent
+        else:
+            self.init_chain_blocks(persistent, chain_block)
+            chain_start = persistent[self.chain_index:self.chain_index + chain_block]
         # perform actual negative phase
         # in order to implement CD-k/PCD-k we need to scan over the
         # function that implements one gibbs step k times.
@@ -340,9 +395,23 @@ class RBM(object):
 
         if symbolic_grad:
             gradients = self.compute_symbolic_grad(chain_end)
-        else:
+        elif persistent is None:
             gradients = self.compute_rbm_grad(batch_size, ph_mean, nh_means[-1], nv_means[-1],
                                               weightcost)
+        else:
+            if chain_block is None:
+                n_chains = tensor.cast(persistent.shape[0], dtype=theano.config.floatX)
+                negative_stats = [tensor.dot(nv_means[-1].T, nh_means[-1]) / n_chains,
+                                  tensor.mean(nh_means[-1], axis=0),
+                                  tensor.mean(nv_means[-1], axis=0)]
+            else:
+                negative_stats = self.chain_blocks_stats(nv_means[-1], nh_means[-1],
+                                                         chain_block, updates)
+            gradients = self.compute_pcd_grad(ph_mean, negative_stats, weightcost)
+
+        if centering is not None:
+            gradients = self.center_gradients(gradients, ph_mean, centering,
+                                              offset_rate, updates)
 
         epsilon = 0.001
         # ISSUE: it returns Inf when Wij is small
@@ -355,18 +424,31 @@ class RBM(object):
             (1 - 2 * lr * lambda_2) / (1 + 2 * lr * lambda_1 / (tensor.abs_(self.W) + epsilon)),
             1,1]
 
+        if optimizer is None:
+            optimizer = Momentum()
+        # the state of the optimizer of the last compiled updates
+        self.optimizer_state = []
+        # make sure that the momentum is of the right dtype
+        momentum = tensor.cast(self.momentum, dtype=theano.config.floatX)
+
         for gradient, param, multiplier, param_speed in zip(
                 gradients, self.params, multipliers, self.params_speed):
-            # make sure that the momentum is of the right dtype
-            updates[param_speed] = gradient + (param_speed - gradient) * \
-                                   tensor.cast(self.momentum, dtype=theano.config.floatX)
+            updates[param_speed] = optimizer.speed_update(self, gradient, param_speed,
+                                                          momentum, updates)
             # make sure that the learning rate is of the right dtype
             updates[param] = param * tensor.cast(multiplier, dtype=theano.config.floatX) + \
                              param_speed * tensor.cast(lr, dtype=theano.config.floatX)
 
         if persistent:
             # Note that this works only if persistent is a shared variable
-            updates[persistent] = nh_samples[-1]
+            if chain_block is None:
+                updates[persistent] = nh_samples[-1]
+            else:
+                updates[persistent] = tensor.set_subtensor(
+                    persistent[self.chain_index:self.chain_index + chain_block],
+                    nh_samples[-1])
+                updates[self.chain_index] = (self.chain_index + chain_block) % \
+                                            persistent.shape[0]
             # pseudo-likelihood is a better proxy for PCD
             monitoring_cost = self.get_pseudo_likelihood_cost(updates)
         else:
@@ -408,16 +490,159 @@ class RBM(object):
                         Boltzmann Machines" (2010))
         :return: a list with the gradients for each parameter in self.params
         """
-        W_grad = (tensor.dot(self.input.T, ph_mean) -
+        W_grad = (dot_maybe_sparse(self.input.T, ph_mean) -
                   tensor.dot(nv_mean.T, nh_mean)) / \
                  tensor.cast(batch_size, dtype=theano.config.floatX) - \
-                 tensor.cast(weightcost, dtype=theano.config.floatX) * \
-                 self.W.get_value(borrow=True)
+                 tensor.cast(weightcost, dtype=theano.config.floatX) * self.W
         hbias_grad = tensor.mean(ph_mean - nh_mean, axis=0)
-        vbias_grad = tensor.mean(self.input - nv_mean, axis=0)
+        vbias_grad = mean_of_rows(self.input) - tensor.mean(nv_mean, axis=0)
         gradients = [W_grad, hbias_grad, vbias_grad]
         return gradients
 
+    def center_gradients(self, gradients, ph_mean, centering, offset_rate, updates):
+        """
+        Transform the gradients of W, hbias and vbias into the gradients of
+        the centered RBM, where the energy is computed on v - visible_offset
+        and h - hidden_offset, expressed in the uncentered parameters (see
+        Montavon and Muller, "Deep Boltzmann Machines and the Centering
+        Trick" (2012) and Melchior et al., "How to Center Deep Boltzmann
+        Machines" (2016)). The model is unchanged, only the direction of the
+        updates is better conditioned.
+
+        The offsets are running averages of the mean of the data
+        (centering='data') or of the average of the mean of the data and of
+        the model (centering='enhanced', the enhanced gradient of Cho et al.
+        (2011)); their updates are added to updates.
+
+        :param gradients: the gradients of self.params
+        :param ph_mean: symbolic variable with p(h_i=1|v0) for the samples
+                        of the minibatch
+        :param centering: 'data' or 'enhanced'
+        :param offset_rate: the rate of the running average of the offsets
+        :param updates: the updates of the training function
+        :return: a list with the centered gradients
+        """
+        floatX = theano.config.floatX
+        W_grad, hbias_grad, vbias_grad = gradients
+        visible_offset, hidden_offset = self.offsets
+
+        # hbias_grad and vbias_grad are the differences between the mean of
+        # the data and the mean of the model
+        centered_W_grad = W_grad - tensor.outer(visible_offset, hbias_grad) - \
+                          tensor.outer(vbias_grad, hidden_offset)
+        centered_hbias_grad = hbias_grad - tensor.dot(visible_offset, centered_W_grad)
+        centered_vbias_grad = vbias_grad - tensor.dot(centered_W_grad, hidden_offset)
+
+        visible_mean = as_dense(mean_of_rows(self.input))
+        hidden_mean = tensor.mean(ph_mean, axis=0)
+        if centering == 'enhanced':
+            visible_mean = visible_mean - vbias_grad / 2
+            hidden_mean = hidden_mean - hbias_grad / 2
+        elif centering != 'data':
+            raise ValueError('Unknown centering %s' % centering)
+        rate = tensor.cast(offset_rate, dtype=floatX)
+        updates[visible_offset] = tensor.cast((1 - rate) * visible_offset + rate * visible_mean,
+                                              dtype=floatX)
+        updates[hidden_offset] = tensor.cast((1 - rate) * hidden_offset + rate * hidden_mean,
+                                             dtype=floatX)
+
+        return [centered_W_grad, centered_hbias_grad, centered_vbias_grad]
+
+    def init_offsets(self, data):
+        """
+        Set the offset of the visible units to the mean of data and the one
+        of the hidden units to 0.5, before training a centered RBM.
+
+        :param data: the training set, a numpy.ndarray or a scipy.sparse matrix
+        """
+        visible_mean = numpy.asarray(data.mean(axis=0)).ravel()
+        self.offsets[0].set_value(visible_mean.astype(theano.config.floatX), borrow=True)
+        self.offsets[1].set_value(numpy.full(self.n_hidden, 0.5, dtype=theano.config.floatX),
+                                  borrow=True)
+
+    def init_chain_blocks(self, persistent, chain_block):
+        """
+        Allocate the shared variables used to advance the pool of persistent
+        chains in blocks: the index of the next block and the mean-field of
+        the visible and hidden units of each chain at its last update.
+
+        :param persistent: shared variable with the pool of persistent chains
+
+        :param chain_block: number of chains advanced at each update
+        """
+        n_chains = persistent.get_value(borrow=True).shape[0]
+        assert n_chains % chain_block == 0
+
+        floatX = theano.config.floatX
+        self.chain_index = theano.shared(0, name='chain_index')
+        self.chains_filled = theano.shared(0, name='chains_filled')
+        self.chains_v_mean = theano.shared(numpy.zeros((n_chains, self.n_visible), dtype=floatX),
+                                           name='chains_v_mean', borrow=True)
+        self.chains_h_mean = theano.shared(numpy.zeros((n_chains, self.n_hidden), dtype=floatX),
+                                           name='chains_h_mean', borrow=True)
+
+    def chain_blocks_stats(self, nv_mean, nh_mean, chain_block, updates):
+        """
+        Compute the negative statistics over the pool of persistent chains
+        after the update of the block of chains just advanced.
+
+        The statistics are recomputed from the mean-field of all the chains
+        of the pool, so no rounding error accumulates across the passes over
+        the pool; the chains not updated yet have a null mean-field and do
+        not contribute to the sums.
+
+        :param nv_mean: p(v_j=1|hk) for the chains of the block
+
+        :param nh_mean: p(h_i=1|vk) for the chains of the block
+
+        :param chain_block: number of chains advanced at each update
+
+        :param updates: the updates dictionary, extended with the updates of
+                        the shared variables of the pool
+
+        :return: the negative statistics for W, hbias and vbias averaged
+                 over the chains updated at least once
+        """
+        start = self.chain_index
+        stop = self.chain_index + chain_block
+        chains_v_mean = tensor.set_subtensor(self.chains_v_mean[start:stop], nv_mean)
+        chains_h_mean = tensor.set_subtensor(self.chains_h_mean[start:stop], nh_mean)
+
+        W_stat = tensor.dot(chains_v_mean.T, chains_h_mean)
+        h_stat = chains_h_mean.sum(axis=0)
+        v_stat = chains_v_mean.sum(axis=0)
+        chains_filled = tensor.minimum(self.chains_filled + chain_block,
+                                       self.chains_v_mean.shape[0])
+
+        updates[self.chains_v_mean] = chains_v_mean
+        updates[self.chains_h_mean] = chains_h_mean
+        updates[self.chains_filled] = chains_filled
+
+        n_chains = tensor.cast(chains_filled, dtype=theano.config.floatX)
+        return [W_stat / n_chains, h_stat / n_chains, v_stat / n_chains]
+
+    def compute_pcd_grad(self, ph_mean, negative_stats, weightcost):
+        """
+        Compute the gradient of the log-likelihood for an RBM trained with
+        PCD with respect to the parameters self.params. The positive
+        statistics are averaged over the samples of the minibatch, whatever
+        its size, while the negative statistics are averaged over the pool
+        of persistent chains.
+
+        :param ph_mean: symbolic variable with p(h_i=1|v0) where v0 is a
+                        training sample for all hidden nodes and for all samples
+        :param negative_stats: list with the averages over the persistent
+                        chains of vk hk^T, p(h_i=1|vk) and p(v_j=1|hk)
+        :param weightcost: scalar used as weight-cost for L1 weight-decay
+        :return: a list with the gradients for each parameter in self.params
+        """
+        n_samples = tensor.cast(self.input.shape[0], dtype=theano.config.floatX)
+        W_grad = dot_maybe_sparse(self.input.T, ph_mean) / n_samples - negative_stats[0] - \
+                 tensor.cast(weightcost, dtype=theano.config.floatX) * self.W
+        hbias_grad = tensor.mean(ph_mean, axis=0) - negative_stats[1]
+        vbias_grad = mean_of_rows(self.input) - negative_stats[2]
+        return [W_grad, hbias_grad, vbias_grad]
+
     def get_pseudo_likelihood_cost(self, updates):
         """Stochastic approximation to the pseudo-likelihood"""
 
@@ -425,7 +650,7 @@ class RBM(object):
         bit_i_idx = theano.shared(value=0, name='bit_i_idx')
 
         # binarize the input image by rounding to nearest integer
-        xi = tensor.round(self.input)
+        xi = tensor.round(as_dense(self.input))
 
         # calculate free energy for the given bit configuration
         fe_xi = self.free_energy(xi)
@@ -446,6 +671,80 @@ class RBM(object):
 
         return cost
 
+    def get_pseudo_likelihood(self, v_sample, bits):
+        """
+        Pseudo-likelihood of the binarized samples v_sample estimated on the
+        visible units of index bits, all of them or a random subset. The
+        free energies of the samples with each of those bits flipped are
+        computed in a single batch.
+
+        Flipping bit j changes the input of the hidden units by
+        (1 - 2 x_j) W_j, therefore the flipped configurations are evaluated
+        on a (samples x bits x hidden units) tensor instead of the
+        (samples x bits x visible units) tensor of the flipped inputs.
+
+        :param v_sample: symbolic matrix with the samples, one per row
+
+        :param bits: symbolic vector with the indexes of the visible units
+                     to flip
+
+        :return: the pseudo-likelihood averaged over the samples, scaled to
+                 the total number of visible units
+        """
+        # binarize the input by rounding to nearest integer
+        xi = tensor.round(as_dense(v_sample))
+
+        wx_b = tensor.dot(xi, self.W) + self.hbias
+        vbias_term = tensor.dot(xi, self.vbias)
+        fe_xi = -tensor.sum(nnet.softplus(wx_b), axis=1) - vbias_term
+
+        # +1 if the bit is flipped from 0 to 1, -1 otherwise
+        delta = 1 - 2 * xi[:, bits]
+        wx_b_flip = wx_b.dimshuffle(0, 'x', 1) + \
+                    delta.dimshuffle(0, 1, 'x') * self.W[bits].dimshuffle('x', 0, 1)
+        fe_xi_flip = -tensor.sum(nnet.softplus(wx_b_flip), axis=2) - \
+                     vbias_term.dimshuffle(0, 'x') - delta * self.vbias[bits]
+
+        # equivalent to e^(-FE(x_i)) / (e^(-FE(x_i)) + e^(-FE(x_{\i})))
+        return - self.n_visible * tensor.mean(
+            tensor.sum(nnet.softplus(fe_xi.dimshuffle(0, 'x') - fe_xi_flip), axis=1) /
+            tensor.cast(bits.shape[0], dtype=theano.config.floatX))
+
+    def pseudo_likelihood_function(self, data_set):
+        """
+        Compile the function monitoring the pseudo-likelihood.
+
+        :param data_set: shared variable with the samples
+
+        :return: a function taking the indexes of the samples and the
+                 indexes of the visible units to flip
+        """
+        indexes = tensor.ivector('indexes')
+        bits = tensor.ivector('bits')
+
+        return theano.function([indexes, bits],
+                               self.get_pseudo_likelihood(data_set[indexes], bits),
+                               name='pl_rbm')
+
+    def pseudo_likelihood_bits(self, n_bits=None):
+        """
+        Draw the indexes of the visible units flipped by the pseudo-likelihood
+        monitor.
+
+        :param n_bits: number of visible units drawn at random without
+                       replacement; None for 5% of the visible units, at
+                       most PL_MAX_BITS, since the cost of an evaluation
+                       grows with samples x bits x hidden units
+
+        :return: a int32 vector of indexes
+        """
+        if n_bits is None:
+            n_bits = min(max(1, self.n_visible // 20), PL_MAX_BITS)
+        if n_bits >= self.n_visible:
+            return numpy.arange(self.n_visible, dtype='int32')
+        return numpy.sort(self.numpy_rng.choice(self.n_visible, n_bits,
+                                                replace=False)).astype('int32')
+
     def get_reconstruction_cost(self, pre_sigmoid_nv):
         """Approximation to the reconstruction error
 
@@ -477,7 +776,7 @@ class RBM(object):
         """
 
         cross_entropy = nnet.binary_crossentropy(
-                            nnet.sigmoid(pre_sigmoid_nv),self.input).sum(axis=1).mean()
+                            nnet.sigmoid(pre_sigmoid_nv),as_dense(self.input)).sum(axis=1).mean()
 
         return cross_entropy
 
@@ -488,16 +787,104 @@ class RBM(object):
                  weightcost = 0.0,
                  lambda_2 = 0.0,
                  persistent = True,
-                 display_fn=None, graph_output=False):
+                 n_chains=None,
+                 chain_block=None,
+                 display_fn=None, graph_output=False,
+                 backend='theano', fused_epochs=0,
+                 pl_frequency=0, pl_bits=None,
+                 monitor_frequency=1, monitor_samples=None,
+                 graph_dir='.', optimizer=None, centering=None):
+        """
+        Train the RBM with CD-k or PCD-k.
+
+        :param n_chains: number of persistent chains (fantasy particles)
+                        used by PCD-k; by default batch_size
+
+        :param chain_block: number of persistent chains advanced at each
+                        update; by default all of them
+
+        :param backend: 'theano' to compile the training function with
+                        Theano, 'numpy' to run the same update rule with
+                        plain numpy BLAS calls (no compilation time,
+                        dense input only)
+
+        :param fused_epochs: if greater than 0, the number of epochs run
+                        with a single call of the training function
+                        (see RBM.fused_training_function)
+
+        :param pl_frequency: if greater than 0, the pseudo-likelihood is
+                        monitored every pl_frequency minibatches
+
+        :param pl_bits: number of visible units on which the
+                        pseudo-likelihood is estimated; None for a small
+                        random subset (see RBM.pseudo_likelihood_bits)
+
+        :param monitor_frequency: number of epochs between two evaluations
+                        of the reconstruction error and of the free energy gap
+
+        :param monitor_samples: number of training and validation samples
+                        used for monitoring; None for the size of the
+                        validation set
+
+        :param graph_dir: the directory where the filters (display_fn) and
+                        the plots (graph_output) are written
+
+        :param optimizer: the rule updating the parameter speeds (see the
+                        optimizers module); None for the momentum. The
+                        numpy backend supports only the momentum.
+
+        :param centering: None, 'data' or 'enhanced' to train the centered
+                        RBM (see RBM.center_gradients); not supported by
+                        the numpy backend
+        """
+
+        if backend == 'numpy':
+            if optimizer is not None and type(optimizer) is not Momentum:
+                raise ValueError('The numpy backend supports only the momentum optimizer')
+            if centering is not None:
+                raise ValueError('The numpy backend does not support centering')
+            trainer = NumpyRBMTrainer(self,
+                                      batch_size=batch_size,
+                                      k=k,
+                                      weightcost=weightcost,
+                                      persistent=persistent,
+                                      n_chains=n_chains,
+                                      chain_block=chain_block,
+                                      numpy_rng=self.numpy_rng)
+            self.learn_model(train_set_x=train_set_x,
+                             validation_set_x=validation_set_x,
+                             training_epochs=training_epochs,
+                             batch_size=batch_size,
+                             initial_momentum=initial_momentum,
+                             final_momentum=final_momentum,
+                             cost=None,
+                             updates=None,
+                             display_fn=display_fn,
+                             graph_output=graph_output,
+                             trainer=trainer,
+                             learning_rate=learning_rate,
+                             fused_epochs=fused_epochs,
+                             pl_frequency=pl_frequency,
+                             pl_bits=pl_bits,
+                             monitor_frequency=monitor_frequency,
+                             monitor_samples=monitor_samples,
+                             graph_dir=graph_dir)
+            return
 
         if persistent:
-            # initialize storage for the persistent chain (state = hidden
+            if n_chains is None:
+                n_chains = batch_size
+            # initialize storage for the persistent chains (state = hidden
             # layer of chain)
-            persistent_chain = theano.shared(numpy.zeros((batch_size, self.n_hidden),
+            persistent_chain = theano.shared(numpy.zeros((n_chains, self.n_hidden),
                                                          dtype=theano.config.floatX),
                                              borrow=True)
         else:
             persistent_chain = None
+        self.persistent_chain = persistent_chain
+
+        if centering is not None:
+            self.init_offsets(train_set_x.get_value(borrow=True))
 
         # get the cost and the gradient corresponding to one step of CD-15
 
@@ -505,7 +892,10 @@ class RBM(object):
                                               k=k,
                                               weightcost=weightcost,
                                               batch_size=batch_size,
-                                              persistent=persistent_chain
+                                              persistent=persistent_chain,
+                                              chain_block=chain_block,
+                                              optimizer=optimizer,
+                                              centering=centering
                                             )
 
         self.learn_model(train_set_x=train_set_x,
@@ -517,13 +907,22 @@ class RBM(object):
                          cost=cost,
                          updates=updates,
                          display_fn=display_fn,
-                         graph_output=graph_output)
+                         graph_output=graph_output,
+                         fused_epochs=fused_epochs,
+                         pl_frequency=pl_frequency,
+                         pl_bits=pl_bits,
+                         monitor_frequency=monitor_frequency,
+                         monitor_samples=monitor_samples,
+                         graph_dir=graph_dir)
+
+    def compile_train_function(self, train_set_x, cost, updates):
+        """
+        Compile the Theano function used by learn_model to train the RBM
+        on a minibatch.
 
-    def learn_model(self, train_set_x, validation_set_x,
-                    training_epochs, batch_size,
-                    initial_momentum, final_momentum,
-                    cost, updates,
-                    display_fn, graph_output):
+        :return: the train_rbm function, taking the minibatch indexes and
+                 the momentum
+        """
         # allocate symbolic variables for the data
         indexes = tensor.vector('indexes', dtype='int32')  # index to a [mini]batch
         momentum = tensor.scalar('momentum', dtype=theano.config.floatX)
@@ -535,86 +934,287 @@ class RBM(object):
             cost,
             updates=updates,
             givens={
-                self.input: train_set_x[indexes],
+                self.input: rows_maybe_sparse(train_set_x, indexes),
                 self.momentum: momentum
             },
+            # optimizers such as Adam do not use the momentum
+            on_unused_input='ignore',
             name='train_rbm'
 # TODO: NanGuardMode should be selected with a flag
 #            ,mode=NanGuardMode(nan_is_error=True, inf_is_error=True, big_is_error=True)
         )
 
-        train_sample = tensor.matrix('train_smaple', dtype=theano.config.floatX)
-        validation_sample = tensor.matrix('validation_smaple', dtype=theano.config.floatX)
+        return train_rbm
+
+    def monitoring_function(self, train_set_x, validation_set_x, n_samples=None):
+        """
+        Compile a single function that computes, in one pass over fixed
+        slices of the training and validation sets, the mean-field
+        reconstruction error of the validation slice, the free energy gap
+        and the hidden activations of both slices. The slices are bounded by
+        n_samples, so the cost of the monitoring does not grow with the size
+        of the data sets.
+
+        :param train_set_x: shared variable with the training set
+
+        :param validation_set_x: shared variable with the validation set
+
+        :param n_samples: number of samples in each slice; None for the
+                          size of the validation set
+
+        :return: a function without arguments returning the reconstruction
+                 error, the free energy gap, the hidden activations of the
+                 validation slice and those of the training slice
+        """
+        n_validation = validation_set_x.get_value(borrow=True).shape[0]
+        if n_samples is None or n_samples > n_validation:
+            n_samples = n_validation
+
+        train_sample = train_set_x[:n_samples]
+        validation_sample = validation_set_x[:n_samples]
+
+        _, h_validation = self.propup(validation_sample)
+        _, h_train = self.propup(train_sample)
+
+        # mean-field reconstruction, without drawing samples
+        pre_sigmoid_nv = self.propdown(h_validation)[0]
+        reconstruction_error = theano.clone(self.get_reconstruction_cost(pre_sigmoid_nv),
+                                            replace={self.input: validation_sample})
 
         feg = self.free_energy_gap(train_sample, validation_sample)
 
-        feg_rbm = theano.function(
-            [indexes],
-            outputs=feg,
-            givens={
-                train_sample: train_set_x[indexes],
-                validation_sample: validation_set_x
+        return theano.function([],
+                               [reconstruction_error, feg, h_validation, h_train],
+                               name='monitor_rbm')
+
+    def fused_training_function(self, train_set_x, cost, updates,
+                                inputs=None, mode=None):
+        """
+        Compile a function that runs a sequence of minibatches, e.g. one or
+        more shuffled epochs, with a single call. The minibatches are scanned
+        inside the compiled graph, therefore there is no Python dispatch
+        between two consecutive updates. Each row of the index matrix is
+        truncated to its size, so the short last minibatch of an epoch is
+        run in its place with the same update of the unfused training.
+
+        :param train_set_x: shared variable with the input of the RBM
+
+        :param cost: the cost returned by get_cost_updates
+
+        :param updates: the updates returned by get_cost_updates
+
+        :param inputs: list of additional symbolic inputs of cost and
+                       updates, e.g. the learning rate
+
+        :param mode: Theano compilation mode
+
+        :return: a function taking a int32 matrix with one minibatch per row
+                 padded to the same length, the int32 vector of the sizes of
+                 the minibatches (see get_fused_minibatches_idx), the
+                 momentum and the additional inputs; it returns the costs of
+                 all the minibatches as an array
+        """
+        if inputs is None:
+            inputs = []
+
+        idx_matrix = tensor.imatrix('idx_matrix')
+        sizes = tensor.ivector('sizes')
+        momentum = tensor.scalar('momentum', dtype=theano.config.floatX)
+
+        # the random states sampled outside of the Gibbs chain, e.g. in the
+        # positive phase of CD, are updated through their default_update,
+        # which depends on the input as well and must be rebuilt in the scan
+        updates = OrderedDict(updates)
+        for variable in theano.gof.graph.inputs([cost] + list(updates.values())):
+            if getattr(variable, 'default_update', None) is not None and \
+                    variable not in updates:
+                updates[variable] = variable.default_update
+
+        update_vars = list(updates.keys())
+        # the symbolic variables of the inputs, which may be given as
+        # theano.In instances
+        input_vars = [getattr(i, 'variable', i) for i in inputs]
+
+        def one_minibatch(batch_indexes, size, inner_momentum, *inner_inputs):
+            # the inner graph depends only on the arguments of the step, the
+            # outer symbolic inputs are passed as non_sequences
+            replace = {
+                self.input: rows_maybe_sparse(train_set_x, batch_indexes[:size]),
+                self.momentum: inner_momentum
             }
-        )
+            replace.update(zip(input_vars, inner_inputs))
+            outputs = theano.clone([cost] + [updates[v] for v in update_vars],
+                                   replace=replace)
+            return outputs[0], OrderedDict(zip(update_vars, outputs[1:]))
+
+        costs, scan_updates = theano.scan(one_minibatch,
+                                          sequences=[idx_matrix, sizes],
+                                          non_sequences=[momentum] + input_vars,
+                                          name='fused_minibatches')
+
+        return theano.function([idx_matrix, sizes, momentum] + inputs,
+                               costs,
+                               updates=scan_updates,
+                               mode=mode,
+                               on_unused_input='ignore',
+                               name='fused_train_rbm')
 
-        if graph_output:
-            v_sample = tensor.matrix('v_sample', dtype=theano.config.floatX)
-            h_out = self.sample_h_given_v(v_sample)
+    def learn_model(self, train_set_x, validation_set_x,
+                    training_epochs, batch_size,
+                    initial_momentum, final_momentum,
+                    cost, updates,
+                    display_fn, graph_output,
+                    trainer=None, learning_rate=None,
+                    fused_epochs=0,
+                    pl_frequency=0, pl_bits=None,
+                    monitor_frequency=1, monitor_samples=None,
+                    graph_dir='.'):
+        """
+        Run the training loop.
+
+        :param trainer: None to compile cost and updates with Theano,
+                        otherwise a NumpyRBMTrainer that performs the
+                        updates without Theano; in this case cost and updates
+                        are ignored and learning_rate must be given
+
+        :param fused_epochs: if greater than 0, the number of epochs run
+                        with a single call of the training function; a call
+                        never goes past an evaluation of the monitoring
+                        function (see monitor_frequency)
+
+        :param pl_frequency: if greater than 0, the pseudo-likelihood of the
+                        last trained minibatch is evaluated every pl_frequency
+                        minibatches (see RBM.get_pseudo_likelihood); not
+                        supported by the GRBM
+
+        :param pl_bits: number of visible units, drawn at random at each
+                        evaluation, on which the pseudo-likelihood is
+                        estimated; None for a small random subset (see
+                        RBM.pseudo_likelihood_bits)
+
+        :param monitor_frequency: number of epochs between two evaluations
+                        of the monitoring function (see
+                        RBM.monitoring_function); the graphical output is
+                        updated at the same frequency
+
+        :param monitor_samples: number of training and validation samples
+                        used for monitoring; None for the size of the
+                        validation set
+
+        :param graph_dir: the directory where the filters (display_fn) and
+                        the plots (graph_output) are written; they are
+                        rendered in the background by a SnapshotWriter
+        """
+        fused_rbm = None
+        pl_rbm = None
+        if trainer is not None:
+            train_rbm = trainer.train_function(train_set_x, learning_rate)
+            monitor_rbm = trainer.monitoring_function(train_set_x,
+                                                      validation_set_x,
+                                                      monitor_samples)
+            if fused_epochs > 0:
+                fused_rbm = trainer.fused_function(train_set_x, learning_rate)
+            if pl_frequency > 0:
+                pl_rbm = trainer.pseudo_likelihood_function(train_set_x)
+        else:
+            train_rbm = self.compile_train_function(train_set_x, cost, updates)
+            monitor_rbm = self.monitoring_function(train_set_x,
+                                                   validation_set_x,
+                                                   monitor_samples)
+            if fused_epochs > 0:
+                fused_rbm = self.fused_training_function(train_set_x, cost, updates)
+            if pl_frequency > 0:
+                pl_rbm = self.pseudo_likelihood_function(train_set_x)
 
-            get_output = theano.function(
-                    [v_sample],
-                    outputs=h_out,
-            )
 
         # compute number of minibatches for training, validation and testing
         n_train_data = train_set_x.get_value(borrow=True).shape[0]
 
         plotting_time = 0.
 
-        if graph_output:
-            fig = plt.figure(1)
-            plt.ion()
+        writer = None
+        if graph_output or display_fn is not None:
+            writer = SnapshotWriter(graph_dir)
 
         start_time = timeit.default_timer()
 
         # go through training epochs
         momentum = initial_momentum
-        for epoch in range(training_epochs):
+        next_epoch = 0
+        n_minibatches = 0
+        while next_epoch < training_epochs:
 
-            if epoch == 6:
+            if next_epoch >= 6:
                 momentum = final_momentum
 
-            _, minibatches = get_minibatches_idx(n_train_data,
-                                                 batch_size,
-                                                 shuffle=True)
-
             # go through the training set
             mean_cost = []
-
-            for batch_indexes in minibatches:
-                mean_cost += [train_rbm(batch_indexes, momentum)]
-
-            feg = feg_rbm(range(validation_set_x.get_value(borrow=True).shape[0]))
+            pseudo_likelihood = []
+
+            if fused_rbm is None:
+                n_epochs = 1
+
+                _, minibatches = get_minibatches_idx(n_train_data,
+                                                     batch_size,
+                                                     shuffle=True)
+
+                for batch_indexes in minibatches:
+                    mean_cost += [train_rbm(batch_indexes, momentum)]
+                    n_minibatches += 1
+                    if pl_rbm is not None and n_minibatches % pl_frequency == 0:
+                        pseudo_likelihood += [pl_rbm(batch_indexes,
+                                                     self.pseudo_likelihood_bits(pl_bits))]
+            else:
+                # a single call never straddles the switch of the momentum
+                # or an evaluation of the monitoring function
+                n_epochs = min(fused_epochs, training_epochs - next_epoch,
+                               monitor_frequency - next_epoch % monitor_frequency)
+                if next_epoch < 6:
+                    n_epochs = min(n_epochs, 6 - next_epoch)
+
+                idx_matrix, sizes = get_fused_minibatches_idx(n_train_data,
+                                                              batch_size,
+                                                              n_epochs=n_epochs)
+                mean_cost += list(fused_rbm(idx_matrix, sizes, momentum))
+
+                # the pseudo-likelihood is evaluated once at the end of the
+                # call if it was due in any of its minibatches
+                n_fused_minibatches = idx_matrix.shape[0]
+                if pl_rbm is not None and \
+                        (n_minibatches + n_fused_minibatches) // pl_frequency > \
+                        n_minibatches // pl_frequency:
+                    last_minibatch = idx_matrix[-1][:sizes[-1]]
+                    pseudo_likelihood += [pl_rbm(last_minibatch,
+                                                 self.pseudo_likelihood_bits(pl_bits))]
+                n_minibatches += n_fused_minibatches
+
+            epoch = next_epoch + n_epochs - 1
+            next_epoch += n_epochs
 
             print('Training epoch %d, cost is ' % epoch, numpy.mean(mean_cost))
-            print('Free energy gap is ', feg)
+            if pseudo_likelihood:
+                print('Pseudo-likelihood is ', numpy.mean(pseudo_likelihood))
+
+            monitor = (next_epoch // monitor_frequency >
+                       (next_epoch - n_epochs) // monitor_frequency) or \
+                      next_epoch == training_epochs
+            if monitor:
+                reconstruction_error, feg, validation_output, training_output = monitor_rbm()
+                print('Reconstruction error is ', reconstruction_error)
+                print('Free energy gap is ', feg)
 
             # Plot filters after each training epoch
             plotting_start = timeit.default_timer()
             if display_fn is not None:
-                # Construct image from the weight matrix
-                Wimg = display_fn(self.W.get_value(borrow=True), self.n_hidden)
-                scipy.misc.imsave('filters_at_epoch_%i.png' % epoch, Wimg)
-            if graph_output:
-                validation_output = get_output(validation_set_x.get_value(borrow=True))
-                plt.clf()
-                plt.subplot(2, 1, 1)
-                plt.imshow(validation_output[1])
-                training_output = get_output(train_set_x.get_value(borrow=True))
-                plt.subplot(2, 1, 2)
-                plt.imshow(training_output[1][range(validation_set_x.get_value(borrow=True).shape[0])])
-                plt.draw()
-                plt.pause(0.05)
+                # the image is constructed from the weight matrix in the
+                # writer thread
+                writer.imsave('filters_at_epoch_%i.png' % epoch,
+                              self.W.get_value(borrow=True),
+                              display_fn=lambda W: display_fn(W, self.n_hidden))
+            if graph_output and monitor:
+                writer.plot('output_at_epoch_%i.png' % epoch,
+                            [validation_output, training_output],
+                            title='epoch %d' % epoch)
 
             plotting_stop = timeit.default_timer()
             plotting_time += (plotting_stop - plotting_start)
@@ -625,8 +1225,8 @@ class RBM(object):
 
         print ('Training took %f minutes' % (pretraining_time / 60.))
 
-        if graph_output:
-            plt.close(fig)
+        if writer is not None:
+            writer.close()
 
 class GRBM(RBM):
     # Implement a Gaussian-Bernoulli Restricted Boltzmann Machine
@@ -698,6 +1298,11 @@ class GRBM(RBM):
 
         return error
 
+    def pseudo_likelihood_function(self, data_set):
+        """The pseudo-likelihood monitor uses the free energy of binary
+        visible units, so it is not defined for the GRBM"""
+        raise ValueError('The pseudo-likelihood is not supported by the GRBM')
+
     def training(self, train_set_x, validation_set_x,
                  training_epochs, batch_size=10,
                  learning_rate=0.01, k=1,
@@ -706,14 +1311,54 @@ class GRBM(RBM):
                  lambda_1 = 0.0,
                  lambda_2 = 0.1,
                  persistent = False,
-                 display_fn=None, graph_output=False):
+                 display_fn=None, graph_output=False,
+                 backend='theano', fused_epochs=0,
+                 monitor_frequency=1, monitor_samples=None,
+                 graph_dir='.', optimizer=None, centering=None):
+
+        if backend == 'numpy':
+            if optimizer is not None and type(optimizer) is not Momentum:
+                raise ValueError('The numpy backend supports only the momentum optimizer')
+            if centering is not None:
+                raise ValueError('The numpy backend does not support centering')
+            trainer = NumpyRBMTrainer(self,
+                                      batch_size=batch_size,
+                                      k=k,
+                                      lambda_1=lambda_1,
+                                      lambda_2=lambda_2,
+                                      weightcost=weightcost,
+                                      gaussian=True,
+                                      error_free=self.error_free,
+                                      numpy_rng=self.numpy_rng)
+            self.learn_model(train_set_x=train_set_x,
+                             validation_set_x=validation_set_x,
+                             training_epochs=training_epochs,
+                             batch_size=batch_size,
+                             initial_momentum=initial_momentum,
+                             final_momentum=final_momentum,
+                             cost=None,
+                             updates=None,
+                             display_fn=display_fn,
+                             graph_output=graph_output,
+                             trainer=trainer,
+                             learning_rate=learning_rate,
+                             fused_epochs=fused_epochs,
+                             monitor_frequency=monitor_frequency,
+                             monitor_samples=monitor_samples,
+                             graph_dir=graph_dir)
+            return
+
+        if centering is not None:
+            self.init_offsets(train_set_x.get_value(borrow=True))
 
         cost, updates = self.get_cost_updates(lr=learning_rate,
                                               k=k,
                                               lambda_1=lambda_1,
                                               lambda_2=lambda_2,
                                               weightcost=weightcost,
-                                              batch_size=batch_size
+                                              batch_size=batch_size,
+                                              optimizer=optimizer,
+                                              centering=centering
                                               )
 
         self.learn_model(train_set_x=train_set_x,
@@ -725,7 +1370,11 @@ class GRBM(RBM):
                          cost=cost,
                          updates=updates,
                          display_fn=display_fn,
-                         graph_output=graph_output)
+                         graph_output=graph_output,
+                         fused_epochs=fused_epochs,
+                         monitor_frequency=monitor_frequency,
+                         monitor_samples=monitor_samples,
+                         graph_dir=graph_dir)
 
 def test(class_to_test=RBM,
          learning_rate=0.1,
@@ -0,0 +1,155 @@
+"""
+Copyright (c) 2016 Gianluca Gerard
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+from __future__ import print_function, division
+
+import os
+import sys
+import threading
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import numpy
+
+# The figures are rendered with the object oriented interface of
+# matplotlib and the Agg backend: pyplot is not thread safe.
+
+
+class SnapshotWriter(object):
+    """
+    Render the snapshots of the activations taken during training to PNG
+    files in a background thread, so that the training loop only pays for
+    copying a downsampled matrix into a bounded queue.
+    """
+    def __init__(self, output_dir='.', max_queue_size=4, max_rows=512, max_cols=512):
+        """
+        :param output_dir: the directory where the PNG files are written
+
+        :param max_queue_size: the number of snapshots waiting to be
+                        rendered; further snapshots are dropped until the
+                        writer catches up
+
+        :param max_rows: the maximum number of rows of a plotted matrix
+        :param max_cols: the maximum number of columns of a plotted matrix
+        """
+        self.output_dir = output_dir
+        self.max_rows = max_rows
+        self.max_cols = max_cols
+        self.dropped = 0
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        self.snapshots = queue.Queue(maxsize=max_queue_size)
+        self.thread = threading.Thread(target=self.run, name='SnapshotWriter')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def row_step(self, n_rows):
+        """The stride that takes at most max_rows out of n_rows rows"""
+        return max(1, -(-n_rows // self.max_rows))
+
+    def downsample(self, image):
+        """
+        Take evenly spaced rows and columns of image so that it is at most
+        max_rows x max_cols. The result is a copy, safe to use after the
+        training has modified image.
+        """
+        if hasattr(image, 'toarray'):
+            image = image[::self.row_step(image.shape[0])].toarray()
+        image = numpy.asarray(image)
+        col_step = max(1, -(-image.shape[1] // self.max_cols))
+        return numpy.array(image[::self.row_step(image.shape[0]), ::col_step])
+
+    def plot(self, filename, images, title=None):
+        """
+        Queue a figure with one panel per matrix in images. The snapshot is
+        dropped if the queue is full.
+
+        :param filename: the name of the PNG file in output_dir
+        :param images: a list of matrices, plotted one below the other
+        :param title: the title of the figure
+        """
+        self.put(('plot', filename, [self.downsample(image) for image in images],
+                  {'title': title}))
+
+    def imsave(self, filename, image, display_fn=None):
+        """
+        Queue image to be saved at full resolution as a grayscale PNG. The
+        snapshot is dropped if the queue is full.
+
+        :param filename: the name of the PNG file in output_dir
+        :param image: a matrix, copied before it is queued
+        :param display_fn: a function turning the copy of image into the
+                        matrix to save, e.g. tiling the filters of an RBM;
+                        it is called in the writer thread
+        """
+        self.put(('image', filename, [numpy.array(image)], {'display_fn': display_fn}))
+
+    def put(self, snapshot):
+        try:
+            self.snapshots.put_nowait(snapshot)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            snapshot = self.snapshots.get()
+            if snapshot is None:
+                return
+            kind, filename, images, options = snapshot
+            try:
+                self.render(kind, filename, images, **options)
+            except Exception as e:
+                print('Cannot write %s: %s' % (filename, e), file=sys.stderr)
+
+    def render(self, kind, filename, images, title=None, display_fn=None):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib import image as mpimg
+
+        path = os.path.join(self.output_dir, filename)
+        if kind == 'image':
+            image = images[0]
+            if display_fn is not None:
+                image = display_fn(image)
+            mpimg.imsave(path, image, cmap='gray')
+            return
+
+        figure = Figure(figsize=(8, 4 * len(images)))
+        FigureCanvasAgg(figure)
+        for n, image in enumerate(images):
+            axes = figure.add_subplot(len(images), 1, n + 1)
+            axes.imshow(image, cmap='gray', aspect='auto', interpolation='nearest')
+        if title is not None:
+            figure.suptitle(title)
+        figure.savefig(path)
+
+    def close(self):
+        """Wait for the queued snapshots to be written and stop the thread"""
+        self.snapshots.put(None)
+        self.thread.join()
+        if self.dropped > 0:
+            print('%d snapshots were dropped while the writer was busy' % self.dropped,
+                  file=sys.stderr)
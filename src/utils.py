@@ -25,64 +25,249 @@ All rights reserved.
 """
 
 import numpy
-from scipy.spatial import distance
 import os
 import gzip
+import re
+import json
+import hashlib
+import tempfile
 from scipy import stats
+import scipy.sparse
 import theano
+from theano import tensor
+from theano import sparse
 
-def import_TCGA_data(file, datadir, dtype):
-    root_dir = os.getcwd()
-    os.chdir(datadir)
+def TCGA_cache_files(file, dtype):
+    """
+    Return the names of the binary cache of a TCGA table: a .npy file with
+    the data and a .json sidecar with the header and the row names. The
+    names depend on the path, the size and the modification time of the
+    table, so that a cache entry is never used for a modified table.
+
+    :param file: the path of the table
+    :param dtype: the dtype of the cached data
+    :return: the name of the data file, the name of the sidecar and a
+             regular expression matching the names of the finished cache
+             entries of the table (and not those of its temporary files
+             or of other tables sharing its name as a prefix)
+    """
+    stat = os.stat(file)
+    key = hashlib.sha1(repr((os.path.abspath(file), stat.st_size,
+                             stat.st_mtime, numpy.dtype(dtype).str)).encode('utf-8')).hexdigest()
+    cache_dir = os.path.join(os.path.dirname(file), '.tcga_cache')
+    prefix = os.path.join(cache_dir, os.path.basename(file))
+    return (prefix + '.' + key + '.npy',
+            prefix + '.' + key + '.json',
+            re.compile(re.escape(os.path.basename(file)) + r'\.[0-9a-f]{40}\.(npy|json)$'))
+
+def write_atomically(file_name, write, binary=True):
+    """
+    Write a file under a unique temporary name in its directory and then
+    rename it, so that a partially written file is never read and that
+    concurrent writers, e.g. processes with the same pid in different
+    containers sharing the directory, do not overwrite each other's
+    temporary files.
+
+    :param file_name: the path of the file
+    :param write: a function writing the content to the open file object
+    :param binary: True to open the temporary file in binary mode
+    """
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_name)),
+                                    prefix=os.path.basename(file_name) + '.',
+                                    suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb' if binary else 'w') as f:
+            write(f)
+        os.rename(tmp_file, file_name)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+def write_TCGA_cache(data, header, row_names, data_file, names_file, pattern):
+    """
+    Save a table in the binary cache, removing the stale entries of the
+    same table, i.e. the names in cache_dir matched by pattern (see
+    TCGA_cache_files). Each file is written with write_atomically, so that
+    a partially written cache is never loaded; the temporary files of
+    concurrent writers are never removed.
+    """
+    cache_dir = os.path.dirname(data_file)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    for name in os.listdir(cache_dir):
+        stale_file = os.path.join(cache_dir, name)
+        if pattern.match(name) and stale_file not in (data_file, names_file):
+            try:
+                os.remove(stale_file)
+            except OSError:
+                # already removed by a concurrent writer
+                if os.path.exists(stale_file):
+                    raise
+
+    write_atomically(data_file, lambda f: numpy.save(f, data))
+    write_atomically(names_file,
+                     lambda f: json.dump({'header': header, 'rows': row_names}, f),
+                     binary=False)
+
+def import_TCGA_data(file, datadir, dtype, cache=True):
+    """
+    Load a tab separated TCGA table with a header line and the row names
+    in the first column.
+
+    :param cache: if True the table is converted once to a .npy file in a
+                  .tcga_cache folder next to the table, and the following
+                  loads memory-map it (read only) instead of parsing the text
+    """
+    path = os.path.join(datadir, file)
+
+    if cache:
+        data_file, names_file, pattern = TCGA_cache_files(path, dtype)
+        if os.path.isfile(data_file) and os.path.isfile(names_file):
+            data = numpy.load(data_file, mmap_mode='r')
+            return (data.shape[1], data.shape[1], data)
 
     if file.endswith('.gz'):
-        with gzip.open(file) as f:
-            ncols = len(f.readline().split('\t'))
+        with gzip.open(path) as f:
+            header = f.readline().rstrip('\n').split('\t')
+            row_names = [line.split('\t', 1)[0] for line in f if line.strip()]
     else:
-        with open(file) as f:
-            ncols = len(f.readline().split('\t'))
+        with open(path) as f:
+            header = f.readline().rstrip('\n').split('\t')
+            row_names = [line.split('\t', 1)[0] for line in f if line.strip()]
+    ncols = len(header)
 
-    data = numpy.loadtxt(file,
+    data = numpy.loadtxt(path,
                        dtype=dtype,
                        delimiter='\t',
                        skiprows=1,
                        usecols=range(1,ncols))
 
-    os.chdir(root_dir)
+    if cache:
+        write_TCGA_cache(data, header, row_names, data_file, names_file, pattern)
+
     return (data.shape[1], ncols-1, data)
 
-def get_minibatches_idx(n, batch_size, shuffle=False):
+def import_TCGA_sparse_data(file, datadir, dtype):
+    """
+    Same as import_TCGA_data but the table is read line by line into a
+    sparse matrix, without building the dense table. Each line of the file
+    is a feature and each column a sample, as in import_TCGA_data, while
+    the returned matrix has one sample per row.
+
+    :return: the number of features, the number of samples and a
+             scipy.sparse.csr_matrix of shape (samples, features)
+    """
+    path = os.path.join(datadir, file)
+    if file.endswith('.gz'):
+        f = gzip.open(path)
+    else:
+        f = open(path)
+
+    rows = []
+    cols = []
+    values = []
+    with f:
+        ncols = len(f.readline().split('\t'))
+        n_features = 0
+        for line in f:
+            record = line.rstrip('\n').split('\t')[1:]
+            for sample, value in enumerate(record):
+                value = float(value)
+                if value != 0.0:
+                    rows.append(sample)
+                    cols.append(n_features)
+                    values.append(value)
+            n_features += 1
+
+    data = scipy.sparse.csr_matrix((numpy.asarray(values, dtype=dtype), (rows, cols)),
+                                   shape=(ncols-1, n_features))
+    return (n_features, ncols-1, data)
+
+def get_minibatches_idx(n, batch_size, shuffle=False, repeats=1):
     """
     Used to shuffle the dataset at each iteration.
+
+    :param repeats: number of times each of the n samples is visited in
+                    an epoch; the samples are repeated through their
+                    indexes, without copying the data
     """
 
-    idx_list = numpy.arange(n, dtype="int32")
+    idx_list = numpy.tile(numpy.arange(n, dtype="int32"), repeats)
 
     if shuffle:
         numpy.random.shuffle(idx_list)
 
     minibatches = []
     minibatch_start = 0
-    for i in range(n // batch_size):
+    for i in range(len(idx_list) // batch_size):
         minibatches.append(idx_list[minibatch_start:
         minibatch_start + batch_size])
         minibatch_start += batch_size
 
-    if (minibatch_start != n):
+    if (minibatch_start != len(idx_list)):
         # Make a minibatch out of what is left
         minibatches.append(idx_list[minibatch_start:])
 
     return range(len(minibatches)), minibatches
 
-def load_n_preprocess_data(datafile,
-                           dtype=theano.config.floatX,
-                           holdout=0.1,
-                           clip=None,
-                           transform_fn=None,
-                           exponent=1.0,
-                           repeats=10,
-                           shuffle=True,
-                           datadir='data'):
+def get_fused_minibatches_idx(n, batch_size, n_epochs=1, shuffle=True, repeats=1):
+    """
+    Used to run n_epochs epochs with a single call of a fused training
+    function. Each epoch is shuffled independently and its minibatches keep
+    the order of get_minibatches_idx, so the last minibatch of an epoch,
+    which can be shorter than batch_size, is run before the next epoch.
+
+    :param repeats: number of times each sample is visited in an epoch
+                    (see get_minibatches_idx)
+
+    :return: a int32 matrix with one minibatch per row, for all the epochs,
+             and a int32 vector with the number of samples of each
+             minibatch; the rows of the short minibatches are padded with
+             zeros up to batch_size
+    """
+    rows = []
+    sizes = []
+    for epoch in range(n_epochs):
+        _, minibatches = get_minibatches_idx(n, batch_size, shuffle=shuffle,
+                                             repeats=repeats)
+        for minibatch in minibatches:
+            row = numpy.zeros(batch_size, dtype="int32")
+            row[:len(minibatch)] = minibatch
+            rows.append(row)
+            sizes.append(len(minibatch))
+
+    return (numpy.asarray(rows, dtype="int32").reshape(-1, batch_size),
+            numpy.asarray(sizes, dtype="int32"))
+
+# Preprocessed datasets, kept for the lifetime of the process so that the
+# projection of a dataset through a trained DBN does not have to parse and
+# normalize it again (see preprocessed_data)
+preprocessed_data_cache = {}
+
+def preprocessed_data(preprocess_fn, datafile, datadir, *args):
+    """
+    Return preprocess_fn(datafile, datadir, *args), computed only the first
+    time for each version of the file and each value of args. The cached
+    arrays are shared by all the callers and must not be modified.
+    """
+    stat = os.stat(os.path.join(datadir, datafile))
+    key = (preprocess_fn.__name__, os.path.abspath(os.path.join(datadir, datafile)),
+           stat.st_size, stat.st_mtime) + args
+    if key not in preprocessed_data_cache:
+        preprocessed_data_cache[key] = preprocess_fn(datafile, datadir, *args)
+    return preprocessed_data_cache[key]
+
+def clear_preprocessed_data_cache():
+    preprocessed_data_cache.clear()
+
+def preprocess_data(datafile, datadir, dtype, clip, transform_fn, exponent):
+    """
+    Load a TCGA table, z-score each feature and drop the features with NaNs.
+
+    :return: the number of samples and a matrix with one sample per row
+    """
     # Load the data, each column is a single person
     # Pass to a row representation, i.e. the data for each person is now on a
     # single row.
@@ -100,9 +285,28 @@ def load_n_preprocess_data(datafile,
     if clip is not None:
         zdata = numpy.clip(zdata, clip[0], clip[1])
 
-    # replicate the samples
-    if repeats > 1:
-        zdata = numpy.repeat(zdata, repeats=repeats, axis=0)
+    zdata.flags.writeable = False
+    return n_cols, zdata
+
+def load_n_preprocess_data(datafile,
+                           dtype=theano.config.floatX,
+                           holdout=0.1,
+                           clip=None,
+                           transform_fn=None,
+                           exponent=1.0,
+                           repeats=1,
+                           shuffle=True,
+                           datadir='data'):
+    # The preprocessing (see preprocess_data) is done once per process for
+    # each file and set of arguments; only the split into training and
+    # validation set is done at every call
+    # repeats > 1 stores repeats copies of each sample: to repeat the samples
+    # during the training without copying them use the repeats parameter
+    # of DBN.training instead
+    if clip is not None:
+        clip = tuple(clip)
+    n_cols, zdata = preprocessed_data(preprocess_data, datafile, datadir,
+                                      dtype, clip, transform_fn, exponent)
 
     validation_set_size = int(n_cols*holdout)
 
@@ -110,6 +314,10 @@ def load_n_preprocess_data(datafile,
     _, indexes = get_minibatches_idx(n_cols, n_cols -
                                      validation_set_size, shuffle = shuffle)
 
+    # replicate the samples
+    if repeats > 1:
+        indexes = [numpy.repeat(idx, repeats) for idx in indexes]
+
     train_set = theano.shared(zdata[indexes[0]], borrow=True)
     if validation_set_size > 0:
         validation_set = theano.shared(zdata[indexes[1]], borrow=True)
@@ -118,60 +326,228 @@ def load_n_preprocess_data(datafile,
 
     return train_set, validation_set
 
+def preprocess_sparse_data(datafile, datadir, dtype, binary):
+    n_features, n_cols, data = import_TCGA_sparse_data(datafile, datadir, dtype)
+
+    if binary:
+        data.data[:] = 1
+
+    return n_features, n_cols, data
+
+def load_n_preprocess_sparse_data(datafile,
+                                  dtype=theano.config.floatX,
+                                  holdout=0.1,
+                                  repeats=1,
+                                  shuffle=True,
+                                  binary=True,
+                                  datadir='data'):
+    """
+    Load a sparse dataset, e.g. the somatic mutations, into sparse shared
+    variables with one sample per row. Differently from
+    load_n_preprocess_data the data is not z-scored, which would make it
+    dense, but it is binarized if binary is True.
+
+    :return: the training set and the validation set (None if holdout
+             is 0) as sparse shared variables
+    """
+    n_features, n_cols, data = preprocessed_data(preprocess_sparse_data, datafile, datadir,
+                                                 dtype, binary)
+
+    validation_set_size = int(n_cols*holdout)
+
+    # pre shuffle the data if we have a validation set
+    _, indexes = get_minibatches_idx(n_cols, n_cols -
+                                     validation_set_size, shuffle = shuffle)
+
+    # replicate the samples
+    if repeats > 1:
+        indexes = [numpy.repeat(idx, repeats) for idx in indexes]
+
+    train_set = sparse.shared(data[indexes[0]], borrow=True)
+    if validation_set_size > 0:
+        validation_set = sparse.shared(data[indexes[1]], borrow=True)
+    else:
+        validation_set = None
+
+    return train_set, validation_set
+
+def is_sparse_variable(x):
+    return isinstance(x.type, sparse.SparseType)
+
+def dot_maybe_sparse(x, y):
+    """
+    tensor.dot(x, y) where x can also be a sparse matrix, in which case
+    the product is computed as a sparse x dense product.
+    """
+    if is_sparse_variable(x):
+        if y.ndim == 1:
+            return sparse.dot(x, y.dimshuffle(0, 'x')).flatten()
+        return sparse.dot(x, y)
+    return tensor.dot(x, y)
+
+def rows_maybe_sparse(x, indexes):
+    """
+    x[indexes] where x can also be a sparse matrix, which does not support
+    advanced indexing
+    """
+    if is_sparse_variable(x):
+        return sparse.basic.get_item_list(x, indexes)
+    return x[indexes]
+
+def as_dense(x):
+    """Convert x to a dense matrix if it is a sparse matrix"""
+    if is_sparse_variable(x):
+        return sparse.dense_from_sparse(x)
+    return x
+
+def mean_of_rows(x):
+    """tensor.mean(x, axis=0) where x can also be a sparse matrix"""
+    if is_sparse_variable(x):
+        return sparse.sp_sum(x, axis=0) / tensor.cast(x.shape[0], dtype=theano.config.floatX)
+    return tensor.mean(x, axis=0)
+
 # The following function help reduce the number of classes based on highest
 # frequency and lowest Hamming distance
 
-def remap_class(classified_samples, distance_matrix, n_classes):
-    def class_by_frequency(a):
-        classes = range(int(numpy.max(a)) + 1)
-        frequency = [numpy.sum(a == idx) for idx in classes]
-        idx_sort0 = reversed(numpy.argsort(frequency).tolist())
-        idx_sort1 = reversed(numpy.argsort(frequency).tolist())
+def remap_class(classified_samples, distance_matrix, n_classes, method='nearest',
+                linkage_method='average'):
+    """
+    Reduce the classes found by find_unique_classes to n_classes.
+
+    With method='nearest' the n_classes most frequent classes are retained,
+    numbered by decreasing frequency, and every other class is merged into
+    the retained class at the lowest Hamming distance.
+
+    With method='linkage' the classes are grouped by hierarchical
+    clustering of distance_matrix, cut to exactly n_classes clusters (see
+    cut_linkage), and the clusters are numbered by decreasing frequency.
+
+    Both methods take the full distance_matrix among the classes, so the
+    memory grows with the square of the number of classes, and the linkage
+    takes quadratic time or more: neither is O(n log n) in the number of
+    classes.
+
+    :param classified_samples: the class of each sample
+    :param distance_matrix: the distances among the classes
+    :param n_classes: the number of classes to retain
+    :param method: 'nearest' or 'linkage'
+    :param linkage_method: the method passed to scipy.cluster.hierarchy.linkage
+    :return: the new class of each sample
+    """
+    classified_samples = numpy.asarray(classified_samples).astype(numpy.int64)
+    n_initial_classes = distance_matrix.shape[0]
+    frequency = numpy.bincount(classified_samples, minlength=n_initial_classes)
+
+    if method == 'nearest':
+        # Order the classes by frequency, the stable sort keeps the lowest
+        # class first among equally frequent ones
+        by_frequency = numpy.argsort(-frequency, kind='mergesort')
+        retained = by_frequency[:n_classes]
+        new_classification = numpy.empty(n_initial_classes, dtype=numpy.int64)
+        new_classification[retained] = numpy.arange(retained.shape[0])
+        merged = by_frequency[n_classes:]
+        if merged.shape[0] > 0:
+            # The columns of the retained classes are in order of frequency,
+            # so the argmin is the new class
+            new_classification[merged] = numpy.argmin(
+                distance_matrix[numpy.ix_(merged, retained)], axis=1)
+    elif method == 'linkage':
+        if n_initial_classes <= n_classes:
+            clusters = numpy.arange(n_initial_classes)
+        else:
+            from scipy.cluster import hierarchy
+            from scipy.spatial.distance import squareform
+            Z = hierarchy.linkage(squareform(distance_matrix, checks=False),
+                                  method=linkage_method)
+            clusters = cut_linkage(Z, n_classes)
+        cluster_frequency = numpy.bincount(clusters, weights=frequency)
+        rank = numpy.empty(cluster_frequency.shape[0], dtype=numpy.int64)
+        rank[numpy.argsort(-cluster_frequency, kind='mergesort')] = \
+            numpy.arange(cluster_frequency.shape[0])
+        new_classification = rank[clusters]
+    else:
+        raise ValueError('Unknown method %s' % method)
 
-        return [{classes[i]: (r, frequency[i]) for r, i in enumerate(idx_sort0)},
-                {r: (classes[i], frequency[i]) for r, i in enumerate(idx_sort1)}]
+    return new_classification[classified_samples]
 
-    def merge_classes(map, D, n_classes):
-        new_map = {}
-        n_initial_classes = D.shape[0]
+def cut_linkage(Z, n_clusters):
+    """
+    Cut a hierarchical clustering to exactly n_clusters clusters by
+    applying its first merges. Unlike scipy.cluster.hierarchy.fcluster with
+    criterion='maxclust', which cuts at a distance and can return fewer
+    clusters when several merges are at the same distance, the number of
+    clusters never depends on the ties.
+
+    :param Z: the linkage matrix returned by scipy.cluster.hierarchy.linkage
+    :param n_clusters: the number of clusters
+    :return: the cluster of each observation, numbered from 0
+    """
+    n = Z.shape[0] + 1
+    # the merged node each node belongs to, after the first n - n_clusters
+    # merges; a merged node has a larger index than its children
+    label = numpy.arange(2 * n - 1)
+    for i in range(n - n_clusters):
+        label[int(Z[i, 0])] = n + i
+        label[int(Z[i, 1])] = n + i
+    for node in range(2 * n - 2, -1, -1):
+        label[node] = label[label[node]]
+    return numpy.unique(label[:n], return_inverse=True)[1]
 
-        for i in range(n_classes):
-            new_map[map[1][i][0]] = i
 
-        to_be_merged_classes = [map[1][i][0] for i in range(n_classes, n_initial_classes)]
-        for c in to_be_merged_classes:
-            for i in numpy.argsort(D[c]):
-                r = map[0][i][0]
-                if r < n_classes and r != c:
-                    new_map[c] = r
+# Number of bits set in each possible byte
+POPCOUNT_TABLE = numpy.array([bin(i).count('1') for i in range(256)], dtype=numpy.uint8)
 
-        return new_map
 
-    # Order the classes by frequency and create an ordered list of those
-    map = class_by_frequency(classified_samples)
+def pack_patterns(dbn_output):
+    """
+    Pack the binary patterns in the rows of dbn_output into bytes, eight
+    nodes per byte. Any non zero node is considered set.
 
-    # Reduce the number of classes to retain only the fist n_classes by frequency
-    # Samples belonging to lower frequency classes will be reassigned to the nearest
-    # permitted class by hamming distance
-    # TODO: evaluate if hierarchical clustering leads to better results
+    :param dbn_output: a (n_samples, n_nodes) matrix of binary patterns
+    :return: a (n_samples, ceil(n_nodes / 8)) numpy.uint8 matrix
+    """
+    return numpy.packbits(numpy.asarray(dbn_output) != 0, axis=1)
 
-    new_classification = merge_classes(map=map,D=distance_matrix,n_classes=n_classes)
-    return numpy.array([new_classification[i] for i in classified_samples])
+
+def packed_hamming_distances(packed_a, packed_b, n_nodes, block_size=1024):
+    """
+    Hamming distances between the bit-packed patterns of packed_a and
+    packed_b, computed by XOR and popcount of the packed bytes. Like
+    scipy.spatial.distance.cdist with metric='hamming', the distance is the
+    fraction of nodes that differ.
+
+    :param packed_a: a (n_a, n_bytes) matrix returned by pack_patterns
+    :param packed_b: a (n_b, n_bytes) matrix returned by pack_patterns
+    :param n_nodes: the number of nodes in the patterns before packing
+    :param block_size: the number of rows of packed_a compared at once
+    :return: a (n_a, n_b) matrix of distances
+    """
+    distances = numpy.empty((packed_a.shape[0], packed_b.shape[0]))
+    for start in range(0, packed_a.shape[0], block_size):
+        block = packed_a[start:start + block_size]
+        differing_bits = POPCOUNT_TABLE[numpy.bitwise_xor(block[:, None, :], packed_b[None, :, :])]
+        distances[start:start + block_size] = numpy.sum(differing_bits, axis=2, dtype=numpy.int64)
+    return distances / n_nodes
 
 
 def find_unique_classes(dbn_output):
-    # Find the unique node patterns present in the output
-    tmp = numpy.ascontiguousarray(dbn_output).view(numpy.dtype(
-        (numpy.void, dbn_output.dtype.itemsize * dbn_output.shape[1])))
-    _, idx = numpy.unique(tmp, return_index=True)
-    class_representation = dbn_output[idx]
+    """
+    Identify the classes as the unique binary patterns in the output of a
+    DBN. The classes are numbered in the lexicographic order of their
+    patterns.
+
+    :param dbn_output: a (n_samples, n_nodes) matrix of binary patterns
+    :return: the class of each sample and the Hamming distances among the classes
+    """
+    n_nodes = dbn_output.shape[1]
+    packed = pack_patterns(dbn_output)
+    # View each packed row as a single opaque value, so that numpy.unique
+    # compares whole patterns
+    rows = numpy.ascontiguousarray(packed).view(
+        numpy.dtype((numpy.void, packed.shape[1]))).ravel()
+    _, idx, classified_samples = numpy.unique(rows, return_index=True, return_inverse=True)
+    class_representation = packed[idx]
     # Find the Hamming distances among all the classes
-    distance_matrix = distance.cdist(class_representation, class_representation, metric='hamming')
-    # Assign each sample to a class
-    classified_samples = numpy.zeros((dbn_output.shape[0]))
-    output_nodes = dbn_output.shape[1]
-    for idx, pattern in enumerate(class_representation):
-        classified_samples = classified_samples + \
-                             (numpy.sum(dbn_output == pattern, axis=1) == output_nodes) * idx
-
-    return classified_samples, distance_matrix
\ No newline at end of file
+    distance_matrix = packed_hamming_distances(class_representation, class_representation, n_nodes)
+
+    return classified_samples.ravel(), distance_matrix
\ No newline at end of file
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules of the package are imported by name, as the scripts in src do
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
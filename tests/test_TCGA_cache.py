@@ -0,0 +1,42 @@
+"""
+Writing the binary cache of a table removes only the stale entries of that
+table: neither the temporary files of concurrent writers nor the entries of
+the tables sharing its name as a prefix.
+"""
+from __future__ import print_function, division
+
+import os
+
+import numpy
+import pytest
+
+pytest.importorskip('theano')
+
+import utils
+
+
+def test_cache_cleanup_keeps_other_files(tmp_path):
+    datadir = str(tmp_path)
+    with open(os.path.join(datadir, 'foo.txt'), 'w') as f:
+        f.write('gene\ts0\ts1\n')
+        f.write('a\t1.0\t2.0\n')
+        f.write('b\t3.0\t4.0\n')
+
+    cache_dir = os.path.join(datadir, '.tcga_cache')
+    os.makedirs(cache_dir)
+    stale_key = '0' * 40
+    other_key = '1' * 40
+    stale = ['foo.txt.%s.npy' % stale_key, 'foo.txt.%s.json' % stale_key]
+    kept = ['foo.txt.gz.%s.npy' % other_key,
+            'foo.txt.gz.%s.json' % other_key,
+            'foo.txt.%s.npy.a1b2c3.tmp' % other_key]
+    for name in stale + kept:
+        open(os.path.join(cache_dir, name), 'w').close()
+
+    _, _, data = utils.import_TCGA_data('foo.txt', datadir, numpy.float32)
+    numpy.testing.assert_array_equal(data, [[1.0, 2.0], [3.0, 4.0]])
+
+    data_file, names_file, _ = utils.TCGA_cache_files(os.path.join(datadir, 'foo.txt'),
+                                                      numpy.float32)
+    assert sorted(os.listdir(cache_dir)) == sorted(kept + [os.path.basename(data_file),
+                                                           os.path.basename(names_file)])
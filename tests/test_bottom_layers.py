@@ -0,0 +1,56 @@
+"""
+The modalities are trained with the same generators, and therefore end
+with the same parameters, whether they run in this process or in worker
+processes.
+"""
+from __future__ import print_function, division
+
+import os
+
+import numpy
+import pytest
+
+theano = pytest.importorskip('theano')
+
+import utils
+from AML import train_GE
+from MDBN import train_bottom_layers
+from MDBN import dbn_to_arrays
+
+
+def write_table(path, n_features=12, n_samples=30, seed=0):
+    rng = numpy.random.RandomState(seed)
+    with open(path, 'w') as f:
+        f.write('\t'.join(['gene'] + ['sample%d' % j for j in range(n_samples)]) + '\n')
+        for i in range(n_features):
+            f.write('\t'.join(['feature%d' % i] +
+                              ['%f' % x for x in rng.randn(n_samples)]) + '\n')
+
+
+def test_worker_processes_match_the_parent(tmp_path):
+    datadir = str(tmp_path)
+    write_table(os.path.join(datadir, 'ge.txt'), seed=0)
+    write_table(os.path.join(datadir, 'me.txt'), seed=1)
+
+    kwargs = dict(batch_size=5, layers_sizes=[3], pretraining_epochs=[2],
+                  pretrain_lr=[0.01], repeats=1, datadir=datadir)
+    jobs = {
+        'GE': (train_GE, 'ge.txt', kwargs),
+        'ME': (train_GE, 'me.txt', kwargs)
+    }
+
+    def trained_arrays(n_jobs):
+        utils.clear_preprocessed_data_cache()
+        # the global generator is left in a different state by each run
+        numpy.random.seed(n_jobs)
+        bottom_layers = train_bottom_layers(jobs, numpy.random.RandomState(123),
+                                            n_jobs=n_jobs, blas_threads=1)
+        return dict((name, dbn_to_arrays(dbn))
+                    for name, (dbn, _, _) in bottom_layers.items())
+
+    in_process = trained_arrays(1)
+    in_workers = trained_arrays(2)
+    for name in ('GE', 'ME'):
+        for param in ('W', 'b', 'vbias'):
+            for expected, actual in zip(in_process[name][param], in_workers[name][param]):
+                numpy.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-7)
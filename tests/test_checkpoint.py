@@ -0,0 +1,62 @@
+"""
+A pretraining interrupted after any of its checkpoints and resumed from
+it must end with the parameters of the uninterrupted run.
+"""
+from __future__ import print_function, division
+
+import os
+
+import numpy
+import pytest
+
+theano = pytest.importorskip('theano')
+
+from dbn import DBN
+
+
+class Interrupted(Exception):
+    pass
+
+
+def pretrain(checkpoint_file=None, interrupt_after=None):
+    floatX = theano.config.floatX
+    data_rng = numpy.random.RandomState(0)
+    train_set = theano.shared(data_rng.randn(45, 8).astype(floatX))
+    validation_set = theano.shared(data_rng.randn(10, 8).astype(floatX))
+
+    dbn = DBN(numpy_rng=numpy.random.RandomState(1), n_ins=8,
+              hidden_layers_sizes=[6], n_outs=3)
+    numpy.random.seed(2)
+
+    if interrupt_after is not None:
+        save_checkpoint = dbn.save_checkpoint
+        n_saved = [0]
+
+        def interrupting_save_checkpoint(*args, **kwargs):
+            save_checkpoint(*args, **kwargs)
+            n_saved[0] += 1
+            if n_saved[0] == interrupt_after:
+                raise Interrupted()
+
+        dbn.save_checkpoint = interrupting_save_checkpoint
+
+    dbn.training(train_set, 10, k=1,
+                 pretraining_epochs=[8, 8],
+                 pretrain_lr=[0.01, 0.01],
+                 validation_set_x=validation_set,
+                 checkpoint_file=checkpoint_file,
+                 checkpoint_frequency=3)
+    return [param.get_value() for param in dbn.params]
+
+
+# checkpoints in the middle of the first layer, at its end and in the
+# middle of the second layer
+@pytest.mark.parametrize('interrupt_after', [1, 3, 4])
+def test_resume_from_checkpoint(tmp_path, interrupt_after):
+    checkpoint_file = os.path.join(str(tmp_path), 'checkpoint.npz')
+    with pytest.raises(Interrupted):
+        pretrain(checkpoint_file, interrupt_after)
+    resumed = pretrain(checkpoint_file)
+
+    for expected, actual in zip(pretrain(), resumed):
+        numpy.testing.assert_allclose(actual, expected, rtol=1e-6, atol=1e-8)
@@ -0,0 +1,67 @@
+"""
+The fused training, which runs several epochs in a single call of a
+compiled scan, must apply the same sequence of updates of the training
+run one minibatch at a time. The 45 samples leave a short minibatch at the
+end of every epoch.
+"""
+from __future__ import print_function, division
+
+import numpy
+import pytest
+
+theano = pytest.importorskip('theano')
+
+from rbm import RBM
+from rbm import GRBM
+from dbn import DBN
+
+
+def rbm_params(cls, fused_epochs, **kwargs):
+    floatX = theano.config.floatX
+    data_rng = numpy.random.RandomState(0)
+    train_set = theano.shared((data_rng.rand(45, 8) > 0.5).astype(floatX))
+    validation_set = theano.shared((data_rng.rand(10, 8) > 0.5).astype(floatX))
+
+    rbm = cls(n_visible=8, n_hidden=5, numpy_rng=numpy.random.RandomState(1))
+    # the minibatches are shuffled with the global generator
+    numpy.random.seed(2)
+    rbm.training(train_set, validation_set,
+                 training_epochs=8,
+                 batch_size=10,
+                 fused_epochs=fused_epochs,
+                 **kwargs)
+    return [param.get_value() for param in rbm.params]
+
+
+@pytest.mark.parametrize('cls, kwargs', [
+    (RBM, dict(persistent=True)),
+    (RBM, dict(persistent=False)),
+    (GRBM, dict())
+], ids=['RBM-PCD', 'RBM-CD', 'GRBM'])
+def test_fused_rbm_training(cls, kwargs):
+    unfused = rbm_params(cls, 0, **kwargs)
+    fused = rbm_params(cls, 3, **kwargs)
+    for expected, actual in zip(unfused, fused):
+        numpy.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-7)
+
+
+def dbn_params(fused_epochs):
+    floatX = theano.config.floatX
+    data_rng = numpy.random.RandomState(0)
+    train_set = theano.shared(data_rng.randn(45, 8).astype(floatX))
+    validation_set = theano.shared(data_rng.randn(10, 8).astype(floatX))
+
+    dbn = DBN(numpy_rng=numpy.random.RandomState(1), n_ins=8,
+              hidden_layers_sizes=[6], n_outs=3)
+    numpy.random.seed(2)
+    dbn.training(train_set, 10, k=1,
+                 pretraining_epochs=[8, 8],
+                 pretrain_lr=[0.01, 0.01],
+                 validation_set_x=validation_set,
+                 fused_epochs=fused_epochs)
+    return [param.get_value() for param in dbn.params]
+
+
+def test_fused_dbn_training():
+    for expected, actual in zip(dbn_params(0), dbn_params(3)):
+        numpy.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-7)
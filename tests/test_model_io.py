@@ -0,0 +1,113 @@
+"""
+Round trip of the model directories and loading of the .npz files written
+by the previous save_network.
+"""
+from __future__ import print_function, division
+
+import os
+import json
+
+import numpy
+
+from model_io import save_model
+from model_io import load_model
+
+
+def dbn_arrays(layer_sizes, gauss=True, seed=0):
+    rng = numpy.random.RandomState(seed)
+    return {
+        'number_of_nodes': layer_sizes,
+        'gauss': gauss,
+        'sparse_input': False,
+        'W': [rng.randn(n_in, n_out) for n_in, n_out in zip(layer_sizes[:-1], layer_sizes[1:])],
+        'b': [rng.randn(n_out) for n_out in layer_sizes[1:]],
+        'vbias': [rng.randn(n_in) for n_in in layer_sizes[:-1]]
+    }
+
+
+def test_save_replaces_the_previous_model(tmp_path):
+    model_dir = os.path.join(str(tmp_path), 'model')
+    save_model(model_dir, {'ge': ({'k': 1}, dbn_arrays([6, 4, 2], seed=0))},
+               arrays={'classes': numpy.arange(3)})
+    save_model(model_dir, {'ge': ({'k': 2}, dbn_arrays([6, 4, 2], seed=1))},
+               arrays={'classes': numpy.arange(5)},
+               metadata={'holdout': 0.1})
+
+    networks, arrays, metadata = load_model(model_dir)
+    config, loaded = networks['ge']
+    expected = dbn_arrays([6, 4, 2], seed=1)
+    assert config == {'k': 2}
+    assert metadata == {'holdout': 0.1}
+    numpy.testing.assert_array_equal(arrays['classes'], numpy.arange(5))
+    for param in ('W', 'b', 'vbias'):
+        for array, expected_array in zip(loaded[param], expected[param]):
+            numpy.testing.assert_array_equal(array, expected_array)
+    # neither the temporary files nor the previous version are left behind
+    assert sorted(os.listdir(str(tmp_path))) == ['model']
+    entries = sorted(os.listdir(model_dir))
+    assert len(entries) == 2 and entries[0] == 'manifest.json'
+    assert entries[1].startswith('version.')
+
+
+def test_save_replaces_a_model_without_versions(tmp_path):
+    # the layout written before the version directories: the arrays next
+    # to the manifest
+    model_dir = os.path.join(str(tmp_path), 'model')
+    save_model(model_dir, {'ge': ({'k': 1}, dbn_arrays([6, 4, 2], seed=0))})
+    manifest_file = os.path.join(model_dir, 'manifest.json')
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    (version,) = [name for name in os.listdir(model_dir) if name != 'manifest.json']
+    for file_name in os.listdir(os.path.join(model_dir, version)):
+        os.rename(os.path.join(model_dir, version, file_name),
+                  os.path.join(model_dir, file_name))
+    os.rmdir(os.path.join(model_dir, version))
+    with open(manifest_file, 'w') as f:
+        json.dump(json.loads(json.dumps(manifest).replace(version + '/', '')), f)
+
+    networks, _, _ = load_model(model_dir)
+    numpy.testing.assert_array_equal(networks['ge'][1]['W'][0],
+                                     dbn_arrays([6, 4, 2], seed=0)['W'][0])
+
+    save_model(model_dir, {'ge': ({'k': 2}, dbn_arrays([6, 4, 2], seed=1))})
+    networks, _, _ = load_model(model_dir)
+    numpy.testing.assert_array_equal(networks['ge'][1]['W'][0],
+                                     dbn_arrays([6, 4, 2], seed=1)['W'][0])
+    assert len(os.listdir(model_dir)) == 2
+
+
+def test_load_npz_model(tmp_path):
+    me = dbn_arrays([6, 3])
+    top = dbn_arrays([3, 4, 2], gauss=False)
+
+    def npz_params(arrays):
+        params = []
+        for W, b in zip(arrays['W'], arrays['b']):
+            params += [{'W': W}, {'b': b}]
+        return params
+
+    # the layout of the previous save_network
+    numpy.savez(os.path.join(str(tmp_path), 'parameters_and_classes'),
+                holdout=0.1,
+                repeats=10,
+                me_config={'number_of_nodes': [6, 3], 'k': 10},
+                top_config={'number_of_nodes': [3, 4, 2], 'k': 1},
+                classes=numpy.arange(4),
+                me_params=npz_params(me),
+                top_params=npz_params(top))
+
+    networks, arrays, metadata = load_model(os.path.join(str(tmp_path),
+                                                         'parameters_and_classes'))
+
+    assert metadata == {'holdout': 0.1, 'repeats': 10}
+    numpy.testing.assert_array_equal(arrays['classes'], numpy.arange(4))
+    for name, expected in [('me', me), ('top', top)]:
+        config, loaded = networks[name]
+        assert loaded['number_of_nodes'] == expected['number_of_nodes']
+        assert loaded['gauss'] == expected['gauss']
+        assert not loaded['sparse_input']
+        for param in ('W', 'b'):
+            for array, expected_array in zip(loaded[param], expected[param]):
+                numpy.testing.assert_array_equal(array, expected_array)
+        for vbias, W in zip(loaded['vbias'], expected['W']):
+            numpy.testing.assert_array_equal(vbias, numpy.zeros(W.shape[0]))
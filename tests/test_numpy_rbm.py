@@ -0,0 +1,58 @@
+"""
+The numpy backend must follow the same trajectory of the Theano one. The
+biases are set to +/-20, so that all the units are saturated and the Gibbs
+samples are the same whatever the random generator: the remaining
+differences are those of the update rule.
+"""
+from __future__ import print_function, division
+
+import numpy
+import pytest
+
+theano = pytest.importorskip('theano')
+
+from rbm import RBM
+from rbm import GRBM
+
+
+def saturated_rbm(cls, n_visible=8, n_hidden=5):
+    rng = numpy.random.RandomState(42)
+    rbm = cls(n_visible=n_visible, n_hidden=n_hidden, numpy_rng=rng)
+    floatX = theano.config.floatX
+    rbm.W.set_value(rng.uniform(-0.1, 0.1, size=(n_visible, n_hidden)).astype(floatX))
+    rbm.hbias.set_value((20 * (-1) ** numpy.arange(n_hidden)).astype(floatX))
+    rbm.vbias.set_value((20 * (-1) ** numpy.arange(n_visible)).astype(floatX))
+    return rbm
+
+
+def train(cls, backend, **kwargs):
+    data_rng = numpy.random.RandomState(0)
+    floatX = theano.config.floatX
+    train_set = theano.shared((data_rng.rand(40, 8) > 0.5).astype(floatX))
+    validation_set = theano.shared((data_rng.rand(10, 8) > 0.5).astype(floatX))
+
+    rbm = saturated_rbm(cls)
+    # the minibatches are shuffled with the global generator
+    numpy.random.seed(1)
+    rbm.training(train_set, validation_set,
+                 training_epochs=8,
+                 batch_size=10,
+                 learning_rate=0.01,
+                 initial_momentum=0.5,
+                 final_momentum=0.9,
+                 weightcost=0.001,
+                 backend=backend,
+                 **kwargs)
+    return [param.get_value() for param in rbm.params + rbm.params_speed]
+
+
+@pytest.mark.parametrize('cls,kwargs', [
+    (RBM, {'persistent': False}),
+    (RBM, {'persistent': True, 'n_chains': 20, 'chain_block': 10}),
+    (GRBM, {}),
+])
+def test_numpy_backend_matches_theano(cls, kwargs):
+    theano_params = train(cls, 'theano', **kwargs)
+    numpy_params = train(cls, 'numpy', **kwargs)
+    for theano_param, numpy_param in zip(theano_params, numpy_params):
+        numpy.testing.assert_allclose(numpy_param, theano_param, rtol=1e-4, atol=1e-6)
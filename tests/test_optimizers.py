@@ -0,0 +1,59 @@
+"""
+Every optimizer must compile and train an RBM and a DBN, with and without
+the fused training, whether or not its speed update uses the momentum.
+"""
+from __future__ import print_function, division
+
+import numpy
+import pytest
+
+theano = pytest.importorskip('theano')
+
+from rbm import RBM
+from dbn import DBN
+from optimizers import Momentum
+from optimizers import RMSprop
+from optimizers import Adam
+
+OPTIMIZERS = [Momentum, RMSprop, Adam]
+
+
+def data_sets(binary):
+    floatX = theano.config.floatX
+    data_rng = numpy.random.RandomState(0)
+    train_data = data_rng.rand(40, 8)
+    validation_data = data_rng.rand(10, 8)
+    if binary:
+        train_data = train_data > 0.5
+        validation_data = validation_data > 0.5
+    return (theano.shared(train_data.astype(floatX)),
+            theano.shared(validation_data.astype(floatX)))
+
+
+@pytest.mark.parametrize('fused_epochs', [0, 2])
+@pytest.mark.parametrize('optimizer', OPTIMIZERS, ids=lambda cls: cls.__name__)
+def test_rbm_optimizer(optimizer, fused_epochs):
+    train_set, validation_set = data_sets(binary=True)
+    rbm = RBM(n_visible=8, n_hidden=5, numpy_rng=numpy.random.RandomState(1))
+    W = rbm.W.get_value().copy()
+    rbm.training(train_set, validation_set,
+                 training_epochs=4,
+                 batch_size=10,
+                 fused_epochs=fused_epochs,
+                 optimizer=optimizer())
+    assert numpy.all(numpy.isfinite(rbm.W.get_value()))
+    assert not numpy.allclose(rbm.W.get_value(), W)
+
+
+@pytest.mark.parametrize('optimizer', OPTIMIZERS, ids=lambda cls: cls.__name__)
+def test_dbn_optimizer(optimizer):
+    train_set, validation_set = data_sets(binary=False)
+    dbn = DBN(numpy_rng=numpy.random.RandomState(1), n_ins=8,
+              hidden_layers_sizes=[6], n_outs=3)
+    dbn.training(train_set, 10, k=1,
+                 pretraining_epochs=[2, 2],
+                 pretrain_lr=[0.01, 0.01],
+                 validation_set_x=validation_set,
+                 optimizer=optimizer())
+    for param in dbn.params:
+        assert numpy.all(numpy.isfinite(param.get_value()))
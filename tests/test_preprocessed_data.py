@@ -0,0 +1,56 @@
+"""
+The modalities trained in worker processes hand their preprocessed
+datasets back to the parent, so that the projection of the datasets
+through the trained DBNs does not parse the tables again.
+"""
+from __future__ import print_function, division
+
+import os
+
+import numpy
+import pytest
+
+theano = pytest.importorskip('theano')
+
+import utils
+from AML import train_GE
+from MDBN import train_bottom_layers
+
+
+def write_table(path, n_features=12, n_samples=30, seed=0):
+    rng = numpy.random.RandomState(seed)
+    with open(path, 'w') as f:
+        f.write('\t'.join(['gene'] + ['sample%d' % j for j in range(n_samples)]) + '\n')
+        for i in range(n_features):
+            f.write('\t'.join(['feature%d' % i] +
+                              ['%f' % x for x in rng.randn(n_samples)]) + '\n')
+
+
+def test_tables_are_parsed_once(tmp_path, monkeypatch):
+    datadir = str(tmp_path)
+    write_table(os.path.join(datadir, 'ge.txt'), seed=0)
+    write_table(os.path.join(datadir, 'me.txt'), seed=1)
+    utils.clear_preprocessed_data_cache()
+
+    kwargs = dict(batch_size=5, layers_sizes=[3], pretraining_epochs=[2],
+                  pretrain_lr=[0.01], repeats=1, datadir=datadir)
+    bottom_layers = train_bottom_layers({
+        'GE': (train_GE, 'ge.txt', kwargs),
+        'ME': (train_GE, 'me.txt', kwargs)
+    }, numpy.random.RandomState(123), n_jobs=2, blas_threads=1)
+
+    parsed = []
+    import_TCGA_data = utils.import_TCGA_data
+
+    def counting_import(file, *args, **kwargs):
+        parsed.append(file)
+        return import_TCGA_data(file, *args, **kwargs)
+
+    monkeypatch.setattr(utils, 'import_TCGA_data', counting_import)
+
+    for name, datafile in [('GE', 'ge.txt'), ('ME', 'me.txt')]:
+        dbn = bottom_layers[name][0]
+        dbn.MLP_output_from_datafile(datafile, holdout=0.1, datadir=datadir)
+        dbn.MLP_output_from_datafile(datafile, datadir=datadir)
+
+    assert parsed == []
@@ -0,0 +1,43 @@
+"""
+The snapshots are rendered in the writer thread and the training never
+waits for it: when the queue is full the snapshots are dropped.
+"""
+from __future__ import print_function, division
+
+import os
+import threading
+
+import numpy
+import pytest
+
+pytest.importorskip('matplotlib')
+
+from snapshot_writer import SnapshotWriter
+
+
+def test_imsave_does_not_block(tmp_path):
+    writer = SnapshotWriter(str(tmp_path), max_queue_size=2)
+    started = threading.Event()
+    release = threading.Event()
+    threads = []
+
+    def display_fn(image):
+        threads.append(threading.current_thread())
+        started.set()
+        release.wait(10)
+        return image
+
+    image = numpy.random.RandomState(0).rand(8, 8)
+    # the first snapshot keeps the writer busy, two fill the queue and the
+    # last two are dropped
+    writer.imsave('image_0.png', image, display_fn=display_fn)
+    assert started.wait(10)
+    for n in range(1, 5):
+        writer.imsave('image_%d.png' % n, image, display_fn=display_fn)
+    assert writer.dropped == 2
+
+    release.set()
+    writer.close()
+    assert threads and all(thread is writer.thread for thread in threads)
+    assert sorted(os.listdir(str(tmp_path))) == ['image_0.png', 'image_1.png',
+                                                 'image_2.png']
@@ -0,0 +1,56 @@
+"""
+The RBMs and the DBNs are trained on sparse CSR training sets, whose
+minibatches are selected with get_item_list instead of advanced indexing.
+"""
+from __future__ import print_function, division
+
+import numpy
+import pytest
+
+theano = pytest.importorskip('theano')
+scipy_sparse = pytest.importorskip('scipy.sparse')
+
+from theano import sparse
+
+from rbm import RBM
+from dbn import DBN
+
+
+def sparse_data_sets(n_features=8):
+    floatX = theano.config.floatX
+    data_rng = numpy.random.RandomState(0)
+    train_data = (data_rng.rand(45, n_features) > 0.7).astype(floatX)
+    validation_data = (data_rng.rand(10, n_features) > 0.7).astype(floatX)
+    return (theano.shared(scipy_sparse.csr_matrix(train_data)),
+            theano.shared(scipy_sparse.csr_matrix(validation_data)))
+
+
+@pytest.mark.parametrize('fused_epochs', [0, 3])
+def test_sparse_rbm_training(fused_epochs):
+    train_set, validation_set = sparse_data_sets()
+    rbm = RBM(input=sparse.csr_matrix('input', dtype=theano.config.floatX),
+              n_visible=8, n_hidden=5, numpy_rng=numpy.random.RandomState(1))
+    W = rbm.W.get_value().copy()
+    rbm.training(train_set, validation_set,
+                 training_epochs=4,
+                 batch_size=10,
+                 fused_epochs=fused_epochs)
+    assert numpy.all(numpy.isfinite(rbm.W.get_value()))
+    assert not numpy.allclose(rbm.W.get_value(), W)
+
+
+@pytest.mark.parametrize('fused_epochs', [0, 3])
+def test_sparse_dbn_training(fused_epochs):
+    train_set, validation_set = sparse_data_sets()
+    dbn = DBN(numpy_rng=numpy.random.RandomState(1), n_ins=8,
+              hidden_layers_sizes=[6], n_outs=3,
+              gauss=False, sparse_input=True)
+    W = dbn.params[0].get_value().copy()
+    dbn.training(train_set, 10, k=1,
+                 pretraining_epochs=[4, 4],
+                 pretrain_lr=[0.01, 0.01],
+                 validation_set_x=validation_set,
+                 fused_epochs=fused_epochs)
+    for param in dbn.params:
+        assert numpy.all(numpy.isfinite(param.get_value()))
+    assert not numpy.allclose(dbn.params[0].get_value(), W)
@@ -0,0 +1,36 @@
+"""
+The joint layer is loaded from the stage cache only if it was trained on
+the same datasets with the same hyperparameters.
+"""
+from __future__ import print_function, division
+
+import os
+
+import numpy
+import pytest
+
+theano = pytest.importorskip('theano')
+
+from MDBN import StageCache
+from MDBN import train_top_cached
+
+
+def test_top_hyperparameters_are_in_the_key(tmp_path):
+    cache = StageCache(os.path.join(str(tmp_path), 'cache'))
+    data_rng = numpy.random.RandomState(0)
+    joint_train_set = theano.shared(
+        (data_rng.rand(20, 6) > 0.5).astype(theano.config.floatX))
+
+    def top_nodes(**kwargs):
+        top_DBN = train_top_cached(cache, 10, False, joint_train_set, None,
+                                   numpy.random.RandomState(1),
+                                   pretraining_epochs=[1, 1], **kwargs)
+        return top_DBN.number_of_nodes()
+
+    assert top_nodes(hidden_layers_sizes=[4]) == [6, 4, 3]
+    assert top_nodes(hidden_layers_sizes=[5]) == [6, 5, 3]
+    assert top_nodes(hidden_layers_sizes=[4], n_outs=2) == [6, 4, 2]
+    # the first configuration is loaded from the cache
+    assert top_nodes(hidden_layers_sizes=[4]) == [6, 4, 3]
+    assert len([name for name in os.listdir(cache.cache_dir)
+                if name.endswith('.npz')]) == 3